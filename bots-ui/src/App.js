@@ -50,6 +50,19 @@ const MODEL_OPTIONS = [
 
 ];
 
+// условный GET: ETag прошлого ответа уходит в If-None-Match, на 304 отдаём сохранённое тело
+const httpCache = new Map(); // url -> { etag, body }
+async function cachedFetch(url) {
+  const hit = httpCache.get(url);
+  const res = await fetch(url, { cache: "no-store", headers: hit ? { "If-None-Match": hit.etag } : {} });
+  if (res.status === 304 && hit) {
+    return new Response(hit.body, { status: 200, headers: { "Content-Type": "application/json" } });
+  }
+  const etag = res.headers.get("ETag");
+  if (res.ok && etag) httpCache.set(url, { etag, body: await res.clone().text() });
+  return res;
+}
+
 function classNames(...xs) {
   return xs.filter(Boolean).join(" ");
 }
@@ -89,6 +102,9 @@ export default function App() {
 
   const [editingPersona, setEditingPersona] = useState(false);
   const threadIdRef = useRef(uuidv4());
+  const [activeThreadId, setActiveThreadId] = useState(threadIdRef.current); // тред чата для push-канала
+  const [typing, setTyping] = useState(false); // «печатает» по событию сервера (или до deliver_at ответа)
+  const lastMessageIdRef = useRef(0); // последний полученный id — для ?after= при переподключении
   const endRef = useRef(null);
   const botsRunningRef = useRef(false);
   const botsListRef = useRef(null);
@@ -129,12 +145,12 @@ export default function App() {
 
   async function continueThread(tid) {
     try {
-      const tr = await fetch(`${apiBase}/threads/${tid}`).then(r => {
+      const tr = await cachedFetch(`${apiBase}/threads/${tid}`).then(r => {
         if (!r.ok) throw new Error(`HTTP ${r.status}`);
         return r.json(); // {id, persona_id, summary}
       });
 
-      const msgs = await fetch(`${apiBase}/threads/${tid}/messages`).then(r => {
+      const msgs = await cachedFetch(`${apiBase}/threads/${tid}/messages`).then(r => {
         if (!r.ok) throw new Error(`HTTP ${r.status}`);
         return r.json(); // [{id,role,content,created_at}]
       });
@@ -142,11 +158,13 @@ export default function App() {
       setPersonaId(tr.persona_id);
       setModel(tr.model);
       threadIdRef.current = tid;
+      lastMessageIdRef.current = msgs.reduce((mx, m) => Math.max(mx, m.id || 0), 0);
+      setActiveThreadId(tid);
 
 
       setActiveTab("chat");
 
-      const compact = msgs.map(m => ({ role: m.role, content: m.content }));
+      const compact = msgs.map(m => ({ id: m.id, role: m.role, content: m.content }));
       setMessages(compact);
 
 
@@ -159,7 +177,7 @@ export default function App() {
 
   async function loadMessages(tid) {
     try {
-      const res = await fetch(`${apiBase}/threads/${tid}/messages`);
+      const res = await cachedFetch(`${apiBase}/threads/${tid}/messages`);
       if (!res.ok) throw new Error(`HTTP ${res.status}`);
       setThreadMessages(await res.json());
     } catch (e) {
@@ -217,7 +235,7 @@ export default function App() {
   const fetchSystemPrompt = useCallback(async (pid = personaId) => {
     if (!pid || !apiBase) return;
     try {
-      const res = await fetch(`${apiBase}/personas/${pid}/system_prompt`);
+      const res = await cachedFetch(`${apiBase}/personas/${pid}/system_prompt`);
       if (!res.ok) throw new Error(`HTTP ${res.status}`);
       const data = await res.json();
       setSystemPreview(data.prompt || "");
@@ -239,7 +257,7 @@ export default function App() {
 
   useEffect(() => {
     endRef.current?.scrollIntoView({ behavior: "smooth" });
-  }, [messages, loading]);
+  }, [messages, loading, typing]);
 
   useEffect(() => {
     fetchSystemPrompt(personaId);
@@ -260,7 +278,7 @@ export default function App() {
   useEffect(() => {
     async function fetchPersonas() {
       try {
-        const res = await fetch(`${apiBase}/personas`);
+        const res = await cachedFetch(`${apiBase}/personas`);
         if (!res.ok) return; // оставим дефолты, если бэк ещё не поднят
         const list = await res.json(); // [{id,name,bio,style,boundaries,goals}]
         const byId = {};
@@ -298,7 +316,7 @@ export default function App() {
   useEffect(() => {
     (async () => {
       try {
-        const r = await fetch(`${apiBase}/system`);
+        const r = await cachedFetch(`${apiBase}/system`);
         if (!r.ok) throw new Error(`HTTP ${r.status}`);
         const data = await r.json();
         setGlobalPrompt(data.global_prompt || "");
@@ -349,10 +367,13 @@ export default function App() {
 
   function startNewThread({ persona, modelValue } = {}) {
     threadIdRef.current = uuidv4();
+    lastMessageIdRef.current = 0;
+    setActiveThreadId(threadIdRef.current);
 
     setMessages([]);
     setInput("");
     setLoading(false);
+    setTyping(false);
 
 
     setSelectedThread(null);
@@ -375,6 +396,87 @@ export default function App() {
   }
 
 
+  // POST /chat с ключом идемпотентности: повтор после сетевой ошибки/5xx не создаст дубль на сервере
+  async function postChat(body, retries = 2) {
+    const payload = JSON.stringify({ ...body, idempotencyKey: uuidv4() });
+    for (let attempt = 0; ; attempt++) {
+      try {
+        const res = await fetch(`${apiBase}/chat`, {
+          method: "POST",
+          headers: { "Content-Type": "application/json" },
+          body: payload,
+        });
+        // 502 — роутер уже перебрал все модели цепочки: повтор даст тот же отказ
+        if (res.status >= 500 && res.status !== 502 && attempt < retries) continue;
+        if (!res.ok) throw new Error(`HTTP ${res.status}`);
+        return await res.json();
+      } catch (e) {
+        if (attempt >= retries || !(e instanceof TypeError)) throw e;
+      }
+    }
+  }
+
+  // сообщение из ответа API или push-канала: по id не дублируем; своё сообщение пользователя
+  // (добавлено локально без id) получает id из события сервера
+  function addMessage(msg) {
+    if (msg.id) lastMessageIdRef.current = Math.max(lastMessageIdRef.current, msg.id);
+    setMessages((m) => {
+      if (msg.id && m.some((x) => x.id === msg.id)) return m;
+      if (msg.role === "user") {
+        const i = m.findIndex((x) => !x.id && x.role === "user" && x.content === msg.content);
+        if (i >= 0) return m.map((x, j) => (j === i ? { ...x, id: msg.id } : x));
+      }
+      return [...m, msg];
+    });
+  }
+
+  function threadSocketUrl(tid, after) {
+    // apiBase вида /api или http://host:8000/api — сокет живёт рядом: /ws/threads/{id}
+    const url = new URL(apiBase, window.location.href);
+    url.protocol = url.protocol === "https:" ? "wss:" : "ws:";
+    url.pathname = `${url.pathname.replace(/\/api\/?$/, "")}/ws/threads/${encodeURIComponent(tid)}`;
+    url.search = after ? `?after=${after}` : "";
+    return url.toString();
+  }
+
+  // push-канал активного треда: новые сообщения (в т.ч. из других вкладок и фоновых задач),
+  // «печатает» и summary; при обрыве переподключаемся и дочитываем пропущенное по ?after=
+  useEffect(() => {
+    const tid = activeThreadId;
+    let ws = null;
+    let retry = null;
+    let closed = false;
+
+    function connect() {
+      ws = new WebSocket(threadSocketUrl(tid, lastMessageIdRef.current));
+      ws.onmessage = (e) => {
+        let ev;
+        try { ev = JSON.parse(e.data); } catch { return; }
+        if (ev.type === "message") {
+          const m = ev.message;
+          addMessage({ id: m.id, role: m.role, content: m.content });
+        } else if (ev.type === "typing") {
+          setTyping(!!ev.active);
+        } else if (ev.type === "message_deleted") {
+          setMessages((m) => m.filter((x) => x.id !== ev.id));
+        } else if (ev.type === "summary") {
+          setThreads((ts) => ts.map((t) => (t.id === tid ? { ...t, summary: ev.summary } : t)));
+        }
+      };
+      ws.onclose = () => {
+        if (!closed) retry = setTimeout(connect, 1000);
+      };
+    }
+
+    connect();
+    return () => {
+      closed = true;
+      clearTimeout(retry);
+      if (ws) ws.close();
+    };
+    // eslint-disable-next-line react-hooks/exhaustive-deps
+  }, [activeThreadId, apiBase]);
+
   async function sendMessage() {
     const text = input.trim();
     if (!text || loading) return;
@@ -382,25 +484,32 @@ export default function App() {
     const newMsgs = [...messages, { role: "user", content: text }];
     setMessages(newMsgs);
     setLoading(true);
+    const tid = threadIdRef.current;
     try {
       let replyText = "";
 
-      const res = await fetch(`${apiBase}/chat`, {
-        method: "POST",
-        headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({
-          model,
-          personaId,
-          message: text,
-          threadId: threadIdRef.current,
-          temperature,
-          simulateTyping: true,
-        }),
+      const data = await postChat({
+        model,
+        personaId,
+        message: text,
+        threadId: tid,
+        temperature,
+        simulateTyping: true,
       });
-      if (!res.ok) throw new Error(`HTTP ${res.status}`);
-      const data = await res.json();
       replyText = data.text || "(пустой ответ)";
-      setMessages((m) => [...m, { role: "assistant", content: replyText }]);
+      const reply = { id: data.id, role: "assistant", content: replyText };
+      const wait = data.deliver_at ? Date.parse(data.deliver_at + "Z") - Date.now() : 0;
+      if (wait > 0) {
+        // ответ «печатается» до deliver_at: обычно его пришлёт push-канал, таймер — на случай, если сокет закрыт
+        setTyping(true);
+        setTimeout(() => {
+          if (threadIdRef.current !== tid) return;
+          addMessage(reply);
+          setTyping(false);
+        }, wait);
+      } else {
+        addMessage(reply);
+      }
     } catch (e) {
       setMessages((m) => [
         ...m,
@@ -440,13 +549,7 @@ export default function App() {
       threadId: agent.threadId,      // важен локальный threadId
       temperature: agent.temperature,
     };
-    const res = await fetch(`${apiBase}/chat`, {
-      method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify(body),
-    });
-    if (!res.ok) throw new Error(`HTTP ${res.status}`);
-    const data = await res.json();
+    const data = await postChat(body);
     return (data.text || "").trim();
   }
 
@@ -734,7 +837,7 @@ export default function App() {
                 {messages.map((m, i) => (
                   <Bubble key={i} role={m.role} content={m.content} />
                 ))}
-                {loading && (
+                {(loading || typing) && (
                   <div className="flex gap-2 items-center text-gray-500 text-sm">
                     <div className="animate-pulse">ИИ печатает…</div>
                   </div>
@@ -0,0 +1,264 @@
+from __future__ import annotations
+import os
+import re
+import gzip
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import argparse
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Optional
+from sqlalchemy import delete, insert, or_, select, text, tuple_, update
+
+from db import DB_PATH, run_db
+from models import ArchivedMessage, Message, Thread
+
+# Ретеншн: старые сообщения уезжают из SQLite в сжатые архивы по тредам (JSONL.gz), горячая таблица
+# и её индексы остаются маленькими. Архив треда — всегда самый старый префикс истории (по (created_at, id)),
+# поэтому get_messages понимает, когда дочитывать архив, по одному threads.archived_count.
+# Освободившиеся страницы возвращает инкрементальный VACUUM малыми порциями с паузами.
+#
+#   python archive.py            # один проход архивации + vacuum
+#   python archive.py --vacuum   # только vacuum
+
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "archive"))
+RETENTION_DAYS = float(os.getenv("RETENTION_DAYS", "0"))  # сообщения старше — в архив; 0 — выключено
+ARCHIVE_IDLE_DAYS = float(os.getenv("ARCHIVE_IDLE_DAYS", "0"))  # тред без активности дольше — в архив целиком
+ARCHIVE_KEEP_LAST = int(os.getenv("ARCHIVE_KEEP_LAST", "50"))  # последние N сообщений треда всегда горячие
+# архивировать только свёрнутое в summary (id <= summary_upto): иначе контекст модели потеряет эти ходы
+ARCHIVE_REQUIRE_SUMMARY = os.getenv("ARCHIVE_REQUIRE_SUMMARY", "1") == "1"
+ARCHIVE_INTERVAL_S = float(os.getenv("ARCHIVE_INTERVAL_S", "3600"))
+ARCHIVE_THREADS_PER_RUN = int(os.getenv("ARCHIVE_THREADS_PER_RUN", "100"))
+ARCHIVE_ROWS_PER_THREAD = int(os.getenv("ARCHIVE_ROWS_PER_THREAD", "5000"))  # за одну транзакцию
+
+VACUUM_ENABLED = os.getenv("VACUUM_ENABLED", "1") == "1"
+VACUUM_PAGES = int(os.getenv("VACUUM_PAGES", "256"))  # страниц за шаг — короткая блокировка писателя
+VACUUM_PAUSE_MS = int(os.getenv("VACUUM_PAUSE_MS", "50"))
+VACUUM_MAX_STEPS = int(os.getenv("VACUUM_MAX_STEPS", "200"))  # за один проход планировщика
+
+log = logging.getLogger(__name__)
+
+
+def archive_path(thread_id: str) -> str:
+    # имя файла — безопасная часть id плюс хэш (id произвольные строки с фронта)
+    digest = hashlib.sha1(thread_id.encode()).hexdigest()
+    safe = re.sub(r"[^\w.-]", "_", thread_id)[:64]
+    return os.path.join(ARCHIVE_DIR, digest[:2], f"{safe}-{digest[:12]}.jsonl.gz")
+
+
+def _row(m: Message) -> dict:
+    return {
+        "id": m.id, "role": m.role, "content": m.content, "tokens": m.tokens, "persona_id": m.persona_id,
+        "created_at": m.created_at.isoformat(),
+    }
+
+
+def _append(thread_id: str, rows: list[dict]):
+    # каждый проход дописывает отдельный gzip-member: старые данные не перепаковываются
+    path = archive_path(thread_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "ab") as f:
+        f.write(gzip.compress("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in rows).encode()))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+@lru_cache(maxsize=16)
+def _load(path: str, mtime: float, size: int) -> tuple[dict, ...]:
+    # ключ кэша включает mtime/size: дописанный архив перечитается
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    for r in rows:
+        r["created_at"] = datetime.fromisoformat(r["created_at"])
+    return tuple(rows)
+
+
+def read_archive(t: Thread) -> list[dict]:
+    # строки архива треда в хронологическом порядке; берутся только закоммиченные в threads —
+    # хвост, дописанный перед упавшей транзакцией, ещё лежит в messages и будет заархивирован повторно
+    if not t.archived_count:
+        return []
+    path = archive_path(t.id)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        log.error("archive for thread %s is missing: %s", t.id, path)
+        return []
+    bound = (t.archived_until, t.archived_until_id)
+    seen: dict[int, dict] = {}
+    for r in _load(path, st.st_mtime, st.st_size):
+        if (r["created_at"], r["id"]) <= bound:
+            seen[r["id"]] = r
+    return sorted(seen.values(), key=lambda r: (r["created_at"], r["id"]))
+
+
+def drop_archive(thread_id: str):
+    try:
+        os.remove(archive_path(thread_id))
+    except FileNotFoundError:
+        pass
+
+
+def retention_enabled() -> bool:
+    return RETENTION_DAYS > 0 or ARCHIVE_IDLE_DAYS > 0
+
+
+def _cutoffs() -> tuple[Optional[datetime], Optional[datetime]]:
+    now = datetime.utcnow()
+    old = now - timedelta(days=RETENTION_DAYS) if RETENTION_DAYS > 0 else None
+    idle = now - timedelta(days=ARCHIVE_IDLE_DAYS) if ARCHIVE_IDLE_DAYS > 0 else None
+    return old, idle
+
+
+def candidate_threads(s, limit: int = ARCHIVE_THREADS_PER_RUN) -> list[str]:
+    old, idle = _cutoffs()
+    conds = []
+    if idle is not None:
+        conds.append(Thread.updated_at < idle)
+    if old is not None:
+        # самое старое горячее сообщение треда — одна проба по индексу (thread_id, created_at, id)
+        oldest = select(Message.created_at).where(Message.thread_id == Thread.id) \
+            .order_by(Message.created_at, Message.id).limit(1).scalar_subquery()
+        conds.append(oldest < old)
+    if not conds:
+        return []
+    stmt = select(Thread.id).where(Thread.message_count > ARCHIVE_KEEP_LAST, or_(*conds)).limit(limit)
+    return list(s.execute(stmt).scalars())
+
+
+def archive_thread(s, thread_id: str, max_rows: int = ARCHIVE_ROWS_PER_THREAD) -> int:
+    t = s.get(Thread, thread_id)
+    if t is None:
+        return 0
+    old, idle = _cutoffs()
+    is_idle = idle is not None and t.updated_at is not None and t.updated_at < idle
+    key = tuple_(Message.created_at, Message.id)
+    # граница: последние ARCHIVE_KEEP_LAST сообщений не трогаем
+    keep_from = s.execute(
+        select(Message.created_at, Message.id).where(Message.thread_id == thread_id)
+        .order_by(Message.created_at.desc(), Message.id.desc()).offset(max(ARCHIVE_KEEP_LAST - 1, 0)).limit(1)
+    ).first()
+    if keep_from is None:
+        return 0
+    stmt = select(Message).where(Message.thread_id == thread_id)
+    stmt = stmt.where(key < tuple_(*keep_from)) if ARCHIVE_KEEP_LAST > 0 else stmt.where(key <= tuple_(*keep_from))
+    rows = s.execute(stmt.order_by(Message.created_at, Message.id).limit(max_rows)).scalars().all()
+
+    # архив — строго префикс истории: берём подряд идущие подходящие строки до первой неподходящей
+    batch = []
+    for m in rows:
+        if ARCHIVE_REQUIRE_SUMMARY and m.id > (t.summary_upto or 0):
+            break
+        if not is_idle and (old is None or m.created_at >= old):
+            break
+        batch.append(m)
+    if not batch:
+        return 0
+
+    _append(thread_id, [_row(m) for m in batch])
+    last = batch[-1]
+    # отметка до удаления: по ней триггер messages_fts_ad оставляет строки в поиске (search.py)
+    s.execute(insert(ArchivedMessage), [
+        {"id": m.id, "thread_id": thread_id, "role": m.role, "created_at": m.created_at} for m in batch
+    ])
+    s.execute(
+        delete(Message).where(Message.thread_id == thread_id, key <= tuple_(last.created_at, last.id)),
+        execution_options={"synchronize_session": False},
+    )
+    s.execute(
+        update(Thread).where(Thread.id == thread_id).values(
+            archived_count=Thread.archived_count + len(batch),
+            archived_until=last.created_at,
+            archived_until_id=last.id,
+        ),
+        execution_options={"synchronize_session": False},
+    )
+    return len(batch)
+
+
+def _vacuum_step(s, pages: int) -> int:
+    s.execute(text(f"PRAGMA incremental_vacuum({int(pages)})"))
+    return s.execute(text("PRAGMA freelist_count")).scalar() or 0
+
+
+async def vacuum(max_steps: int = VACUUM_MAX_STEPS) -> int:
+    # работает только при auto_vacuum=INCREMENTAL (init_db.py); иначе freelist просто копится до VACUUM
+    mode = await run_db(lambda s: s.execute(text("PRAGMA auto_vacuum")).scalar())
+    if mode != 2:
+        return 0
+    steps = 0
+    free = await run_db(lambda s: s.execute(text("PRAGMA freelist_count")).scalar() or 0)
+    while free > 0 and steps < max_steps:
+        free = await run_db(_vacuum_step, VACUUM_PAGES)
+        steps += 1
+        await asyncio.sleep(VACUUM_PAUSE_MS / 1000.0)
+    if steps:
+        await run_db(lambda s: s.execute(text("PRAGMA wal_checkpoint(PASSIVE)")).fetchall())
+    return steps
+
+
+class Archiver:
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+
+    async def run_once(self) -> dict:
+        archived = threads = 0
+        if retention_enabled():
+            for tid in await run_db(candidate_threads):
+                n = await run_db(archive_thread, tid)
+                if n:
+                    archived += n
+                    threads += 1
+        steps = await vacuum() if VACUUM_ENABLED else 0
+        return {"archived": archived, "threads": threads, "vacuum_steps": steps}
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(ARCHIVE_INTERVAL_S)
+            started = time.monotonic()
+            try:
+                stats = await self.run_once()
+            except Exception:
+                log.exception("archive run failed")
+                continue
+            if stats["archived"] or stats["vacuum_steps"]:
+                log.info("archive: %s in %.1fs", stats, time.monotonic() - started)
+
+    async def start(self):
+        if self._task is None and (retention_enabled() or VACUUM_ENABLED):
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+archiver = Archiver()
+
+
+async def _main(args):
+    from db import shutdown_db
+
+    try:
+        if args.vacuum:
+            print({"vacuum_steps": await vacuum(max_steps=args.max_steps)})
+        else:
+            print(await archiver.run_once())
+    finally:
+        shutdown_db()
+
+
+def main():
+    p = argparse.ArgumentParser(description="Архивация старых сообщений и инкрементальный VACUUM")
+    p.add_argument("--vacuum", action="store_true", help="только vacuum")
+    p.add_argument("--max-steps", type=int, default=VACUUM_MAX_STEPS)
+    asyncio.run(_main(p.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+from __future__ import annotations
+import os
+import sys
+import json
+import time
+import uuid
+import asyncio
+import argparse
+from typing import AsyncIterable, AsyncIterator, Awaitable, Callable, Dict, Iterable, Optional, Union
+
+# Массовый прогон промптов через тот же конвейер, что /api/chat (контекст, роутер, writer).
+# Вход — JSONL: {"id": "...", "model": "groq:...", "personaId": "...", "message": "...", "threadId"?: "...", "temperature"?: 0.7}
+# Выход — JSONL с результатами в порядке готовности. Чекпоинт — сам выходной файл: при --resume
+# уже записанные id пропускаются.
+#
+#   python batch.py prompts.jsonl -o results.jsonl --resume --limit groq=8 --limit gemini=4
+
+BATCH_CONCURRENCY_DEFAULT = int(os.getenv("BATCH_CONCURRENCY_DEFAULT", "4"))
+# {"groq": 8, "openrouter": 2} — одновременных запросов на провайдера
+BATCH_CONCURRENCY: Dict[str, int] = json.loads(os.getenv("BATCH_CONCURRENCY", "{}") or "{}")
+BATCH_MAX_INFLIGHT = int(os.getenv("BATCH_MAX_INFLIGHT", "256"))  # сколько строк входа держать в памяти
+
+Item = Dict[str, object]
+Reply = Callable[[Item], Awaitable[dict]]
+
+
+class BatchProgress:
+    def __init__(self, total: Optional[int] = None):
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.skipped = 0
+        self.started = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        elapsed = time.monotonic() - self.started
+        return self.done / elapsed if elapsed > 0 else 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "done": self.done,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "total": self.total,
+            "rate": round(self.rate, 2),
+        }
+
+    def line(self) -> str:
+        total = f"/{self.total}" if self.total is not None else ""
+        return f"done {self.done}{total}, failed {self.failed}, skipped {self.skipped}, {self.rate:.1f}/s"
+
+
+def item_id(item: Item, n: int) -> str:
+    return str(item.get("id") or n)
+
+
+def provider_of(item: Item) -> str:
+    return str(item.get("model") or "").split("->")[0].split(":", 1)[0].strip()
+
+
+async def _aiter(items: Union[Iterable[Item], AsyncIterable[Item]]) -> AsyncIterator[Item]:
+    if hasattr(items, "__aiter__"):
+        async for it in items:
+            yield it
+    else:
+        for it in items:
+            yield it
+
+
+async def run_batch(
+    items: Union[Iterable[Item], AsyncIterable[Item]],
+    reply: Reply,
+    limits: Optional[Dict[str, int]] = None,
+    skip: frozenset[str] = frozenset(),
+    progress: Optional[BatchProgress] = None,
+    run_id: Optional[str] = None,
+) -> AsyncIterator[dict]:
+    # run_id уходит в reply вместе со строкой: id строк повторяются между файлами и прогонами,
+    # и всё, что строится из id (треды батча), должно быть своим у каждого прогона
+    run_id = run_id or uuid.uuid4().hex[:12]
+    limits = {**BATCH_CONCURRENCY, **(limits or {})}
+    sems: Dict[str, asyncio.Semaphore] = {}
+    progress = progress or BatchProgress()
+
+    async def one(n: int, item: Item) -> dict:
+        provider = provider_of(item)
+        sem = sems.get(provider)
+        if sem is None:
+            sem = sems[provider] = asyncio.Semaphore(max(1, int(limits.get(provider, BATCH_CONCURRENCY_DEFAULT))))
+        rid = item_id(item, n)
+        async with sem:
+            started = time.monotonic()
+            try:
+                out = await reply({**item, "id": rid, "runId": run_id})
+            except Exception as e:
+                progress.failed += 1
+                return {"id": rid, "ok": False, "error": str(getattr(e, "detail", None) or e)}
+            finally:
+                progress.done += 1
+            # id строки последним: у ответа может быть свой "id" (id сообщения), а по id строки работает --resume
+            return {**out, "id": rid, "ok": True, "ms": int((time.monotonic() - started) * 1000)}
+
+    pending: set[asyncio.Task] = set()
+    try:
+        n = 0
+        async for item in _aiter(items):
+            n += 1
+            if item_id(item, n) in skip:
+                progress.skipped += 1
+                continue
+            pending.add(asyncio.create_task(one(n, item)))
+            # не читаем вход дальше, пока в полёте слишком много строк
+            if len(pending) >= BATCH_MAX_INFLIGHT:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    yield t.result()
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                yield t.result()
+    finally:
+        for t in pending:
+            t.cancel()
+
+
+# === CLI ===
+def _read_jsonl(path: str) -> Iterable[Item]:
+    f = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    with f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def _done_ids(path: str) -> frozenset[str]:
+    # успешные строки прошлого запуска; упавшие при --resume пойдут заново
+    if not os.path.exists(path):
+        return frozenset()
+    ids = set()
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except ValueError:
+                continue  # оборванная последняя строка после падения
+            if row.get("ok"):
+                ids.add(str(row.get("id")))
+    return frozenset(ids)
+
+
+def _count_lines(path: str) -> Optional[int]:
+    if path == "-":
+        return None
+    with open(path, encoding="utf-8") as f:
+        return sum(1 for line in f if line.strip())
+
+
+async def _main(args):
+    import server  # конвейер чата; импорт здесь, чтобы server мог импортировать этот модуль
+
+    limits = {}
+    for spec in args.limit:
+        provider, _, n = spec.partition("=")
+        limits[provider] = int(n)
+    skip = _done_ids(args.output) if args.resume else frozenset()
+    progress = BatchProgress(_count_lines(args.input))
+
+    async with server.lifespan(server.app):
+        with open(args.output, "a" if args.resume else "w", encoding="utf-8") as out:
+            last_report = 0.0
+            async for row in run_batch(_read_jsonl(args.input), server.batch_reply, limits, skip, progress):
+                out.write(json.dumps(row, ensure_ascii=False) + "\n")
+                out.flush()
+                if time.monotonic() - last_report >= 1:
+                    last_report = time.monotonic()
+                    print(progress.line(), file=sys.stderr)
+    print(progress.line(), file=sys.stderr)
+
+
+def main():
+    p = argparse.ArgumentParser(description="Массовый прогон промптов через конвейер чата")
+    p.add_argument("input", help="JSONL с промптами ('-' — stdin)")
+    p.add_argument("-o", "--output", required=True, help="JSONL с результатами (он же чекпоинт)")
+    p.add_argument("--resume", action="store_true", help="пропустить id, уже успешно записанные в output")
+    p.add_argument("--limit", action="append", default=[], metavar="PROVIDER=N", help="параллельность на провайдера")
+    asyncio.run(_main(p.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+from __future__ import annotations
+import os
+import sys
+import json
+import math
+import time
+import random
+import socket
+import asyncio
+import sqlite3
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+import httpx
+
+from context import estimate_tokens
+
+# Нагрузочный бенчмарк API на локальном mock_llm.py: p50/p95/p99 и RPS для чата,
+# листинга сообщений и листинга тредов на базах разного размера.
+#
+#   python bench.py --sizes 1000,100000 --requests 500 --concurrency 32 --json bench.json
+#   python bench.py --baseline bench.json --max-regression 0.2   # exit 1, если p95/RPS просели
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ("chat", "messages", "threads")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    # nearest-rank: ceil, а не round — банковское округление сдвигало p50 на нечётных выборках
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q * len(ordered)) - 1))]
+
+
+def seed_db(path: str, messages: int, per_thread: int, env: dict) -> list[str]:
+    subprocess.run([sys.executable, "init_db.py"], cwd=HERE, env=env, check=True, stdout=subprocess.DEVNULL)
+    threads = [f"bench-{i}" for i in range(max(1, messages // per_thread))]
+    now = datetime.utcnow() - timedelta(days=30)
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany(
+            "INSERT INTO threads (id, persona_id, model, summary, summary_upto, created_at, updated_at) "
+            "VALUES (?, 'friendly', 'groq:mock', '', 0, ?, ?)",
+            [(t, now.isoformat(" "), now.isoformat(" ")) for t in threads],
+        )
+        texts = ["привет, как дела?", "ага", "нормально, вот на работе завал, а у тебя что нового?", "ясно"]
+        rows = (
+            (
+                threads[i % len(threads)],
+                "user" if i % 2 == 0 else "assistant",
+                texts[i % len(texts)],
+                estimate_tokens(texts[i % len(texts)]),
+                (now + timedelta(seconds=i)).isoformat(" "),
+            )
+            for i in range(messages)
+        )
+        conn.executemany(
+            "INSERT INTO messages (thread_id, role, content, tokens, created_at) VALUES (?, ?, ?, ?, ?)", rows
+        )
+    conn.close()
+    return threads
+
+
+async def wait_ready(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as cli:
+        while time.monotonic() < deadline:
+            try:
+                if (await cli.get(url)).status_code < 500:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"не поднялся: {url}")
+
+
+async def run_scenario(base: str, scenario: str, threads: list[str], requests: int, concurrency: int, args) -> dict:
+    latencies: list[float] = []
+    errors = 0
+    sent = 0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base, limits=limits, timeout=120) as cli:
+        async def one(i: int):
+            tid = random.choice(threads)
+            if scenario == "chat":
+                # --fresh-threads: отдельный тред на запрос, без очереди и склейки ходов одного треда
+                return await cli.post("/api/chat", json={
+                    "model": args.model, "personaId": "friendly", "message": f"bench {i}",
+                    "threadId": f"{tid}-{i}" if args.fresh_threads else tid, "simulateTyping": False,
+                })
+            if scenario == "messages":
+                return await cli.get(f"/api/threads/{tid}/messages", params={"limit": args.page})
+            return await cli.get("/api/threads", params={"limit": args.page, "lite": 1})
+
+        async def worker():
+            nonlocal errors, sent
+            while sent < requests:
+                i = sent
+                sent += 1
+                started = time.perf_counter()
+                try:
+                    r = await one(i)
+                    ok = r.status_code < 400
+                except httpx.HTTPError:
+                    ok = False
+                latencies.append((time.perf_counter() - started) * 1000)
+                errors += 0 if ok else 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return {
+        "scenario": scenario,
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50": round(percentile(latencies, 0.50), 1),
+        "p95": round(percentile(latencies, 0.95), 1),
+        "p99": round(percentile(latencies, 0.99), 1),
+    }
+
+
+async def bench_size(size: int, args, mock_url: str) -> list[dict]:
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        port = free_port()
+        env = {
+            **os.environ,
+            "DB_PATH": db_path,
+            "GEMINI_API_KEY": "mock", "GROQ_API_KEY": "mock", "OPENROUTER_API_KEY": "mock",
+            "GEMINI_URL": mock_url, "GROQ_URL": f"{mock_url}/openai/v1",
+            "OPENROUTER_URL": f"{mock_url}/api/v1", "OLLAMA_URL": mock_url,
+            "TYPE_SIM_ENABLED": "0", "SUMMARY_ENABLED": "0", "HTTP_PREWARM": "0",
+        }
+        threads = seed_db(db_path, size, args.per_thread, env)
+        proc = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "server:app", "--port", str(port), "--log-level", "warning",
+             "--workers", str(args.workers)],
+            cwd=HERE, env=env,
+        )
+        try:
+            base = f"http://127.0.0.1:{port}"
+            await wait_ready(f"{base}/api/personas")
+            results = []
+            for scenario in args.scenarios:
+                res = await run_scenario(base, scenario, threads, args.requests, args.concurrency, args)
+                results.append({"size": size, **res})
+                print(format_row(results[-1]), flush=True)
+            return results
+        finally:
+            proc.terminate()
+            proc.wait(timeout=10)
+
+
+def format_row(r: dict) -> str:
+    return (
+        f"{r['size']:>9} {r['scenario']:>9} {r['requests']:>7} {r['errors']:>6} "
+        f"{r['rps']:>8} {r['p50']:>8} {r['p95']:>8} {r['p99']:>8}"
+    )
+
+
+def compare(results: list[dict], baseline_path: str, max_regression: float) -> list[str]:
+    with open(baseline_path, encoding="utf-8") as f:
+        base = {(r["size"], r["scenario"]): r for r in json.load(f)}
+    problems = []
+    for r in results:
+        b = base.get((r["size"], r["scenario"]))
+        if not b:
+            continue
+        if b["p95"] and r["p95"] > b["p95"] * (1 + max_regression):
+            problems.append(f"{r['scenario']}@{r['size']}: p95 {b['p95']} -> {r['p95']} ms")
+        if b["rps"] and r["rps"] < b["rps"] * (1 - max_regression):
+            problems.append(f"{r['scenario']}@{r['size']}: rps {b['rps']} -> {r['rps']}")
+    return problems
+
+
+async def _main(args):
+    mock_port = free_port()
+    mock_env = {**os.environ, "MOCK_LATENCY_MS": str(args.mock_latency_ms)}
+    mock = subprocess.Popen([sys.executable, "mock_llm.py", "--port", str(mock_port)], cwd=HERE, env=mock_env)
+    try:
+        mock_url = f"http://127.0.0.1:{mock_port}"
+        await wait_ready(f"{mock_url}/__mock/config")
+        print(f"{'size':>9} {'scenario':>9} {'reqs':>7} {'errors':>6} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8}")
+        results = []
+        for size in args.sizes:
+            results += await bench_size(size, args, mock_url)
+    finally:
+        mock.terminate()
+        mock.wait(timeout=10)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        problems = compare(results, args.baseline, args.max_regression)
+        for p in problems:
+            print("REGRESSION", p, file=sys.stderr)
+        if problems:
+            sys.exit(1)
+
+
+def main():
+    p = argparse.ArgumentParser(description="Бенчмарк API чата на mock-провайдерах")
+    p.add_argument("--sizes", type=lambda v: [int(x) for x in v.split(",")], default=[1000, 100000],
+                   help="размеры базы, сообщений (через запятую)")
+    p.add_argument("--per-thread", type=int, default=200, help="сообщений на тред при наполнении")
+    p.add_argument("--scenarios", type=lambda v: v.split(","), default=list(SCENARIOS))
+    p.add_argument("--requests", type=int, default=300)
+    p.add_argument("--concurrency", type=int, default=16)
+    p.add_argument("--workers", type=int, default=1, help="воркеров uvicorn")
+    p.add_argument("--model", default="groq:mock")
+    p.add_argument("--page", type=int, default=50, help="limit для листинга сообщений")
+    p.add_argument("--fresh-threads", action="store_true", help="каждый chat-запрос в новый тред")
+    p.add_argument("--mock-latency-ms", type=int, default=200)
+    p.add_argument("--json", help="сохранить результаты")
+    p.add_argument("--baseline", help="сравнить с сохранёнными результатами")
+    p.add_argument("--max-regression", type=float, default=0.2)
+    asyncio.run(_main(p.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
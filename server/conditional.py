@@ -0,0 +1,51 @@
+from __future__ import annotations
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Optional
+from fastapi import Request, Response
+
+# Условные GET: эндпоинт сначала читает дешёвый валидатор (threads.version, версия кэша персон/настроек),
+# и если клиент прислал тот же ETag (или Last-Modified не новее If-Modified-Since) — отвечает 304,
+# не читая и не сериализуя сами данные. Cache-Control: no-cache — браузер хранит ответ, но всегда сверяется.
+
+
+def etag(*parts) -> str:
+    raw = "|".join("" if p is None else str(p) for p in parts)
+    return '"' + hashlib.sha1(raw.encode()).hexdigest()[:20] + '"'
+
+
+def _http_date(ts: datetime) -> str:
+    # в базе naive UTC
+    return format_datetime(ts.replace(tzinfo=timezone.utc, microsecond=0), usegmt=True)
+
+
+def _matches(header: str, tag: str) -> bool:
+    if header.strip() == "*":
+        return True
+    # слабое сравнение (RFC 9110, 13.1.2): W/ не учитываем
+    return any(t.strip().removeprefix("W/") == tag for t in header.split(","))
+
+
+def _not_modified_since(header: str, modified: datetime) -> bool:
+    try:
+        since = parsedate_to_datetime(header)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    return modified.replace(tzinfo=timezone.utc, microsecond=0) <= since
+
+
+def conditional(request: Request, response: Response, tag: str, modified: Optional[datetime] = None) -> Optional[Response]:
+    # валидаторы уходят и в 200, и в 304; вернулся Response — отдать его вместо данных
+    headers = {"ETag": tag, "Cache-Control": "no-cache"}
+    if modified is not None:
+        headers["Last-Modified"] = _http_date(modified)
+    inm = request.headers.get("if-none-match")
+    ims = request.headers.get("if-modified-since")
+    # If-Modified-Since учитывается, только если If-None-Match нет
+    if (inm is not None and _matches(inm, tag)) or (inm is None and ims and modified is not None and _not_modified_since(ims, modified)):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
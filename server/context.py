@@ -0,0 +1,75 @@
+from __future__ import annotations
+import os
+import re
+import json
+import math
+from sqlalchemy import select
+
+from models import Message
+
+# Сборка контекста под бюджет токенов модели.
+# Каждое сообщение хранит оценку токенов (Message.tokens), посчитанную один раз при вставке;
+# в контекст берётся столько последних реплик, сколько влезает после системного промпта и summary;
+# реплики, уже свёрнутые в summary (id <= threads.summary_upto), повторно не отправляются.
+
+CONTEXT_BUDGET_DEFAULT = int(os.getenv("CONTEXT_BUDGET_DEFAULT", "6000"))
+# {"gemini": 30000, "groq:qwen/qwen3-32b": 8000} — ключ: провайдер или полный spec, берётся самый длинный совпавший
+CONTEXT_BUDGETS: dict[str, int] = json.loads(os.getenv("CONTEXT_BUDGETS", "{}") or "{}")
+REPLY_RESERVE_TOKENS = int(os.getenv("REPLY_RESERVE_TOKENS", "512"))
+CONTEXT_MAX_TURNS = int(os.getenv("CONTEXT_MAX_TURNS", "60"))
+MESSAGE_OVERHEAD_TOKENS = 4  # роль и разметка сообщения
+
+_CYRILLIC = re.compile(r"[Ѐ-ӿ]")
+_SPACE = re.compile(r"\s")
+
+
+def estimate_tokens(text: str) -> int:
+    # грубая оценка без токенизатора: кириллица ~2.5 символа на токен, латиница и прочее ~4
+    if not text:
+        return MESSAGE_OVERHEAD_TOKENS
+    cyr = len(_CYRILLIC.findall(text))
+    spaces = len(_SPACE.findall(text))
+    other = len(text) - cyr - spaces
+    return math.ceil(cyr / 2.5 + other / 4 + spaces / 8) + MESSAGE_OVERHEAD_TOKENS
+
+
+def context_budget(spec: str) -> int:
+    best, best_len = CONTEXT_BUDGET_DEFAULT, -1
+    vendor = spec.split(":", 1)[0]
+    for key, value in CONTEXT_BUDGETS.items():
+        if (spec == key or spec.startswith(key + ":") or key == vendor) and len(key) > best_len:
+            best, best_len = int(value), len(key)
+    return best
+
+
+def shared_history(s, thread_id: str, budget: int, max_turns: int = CONTEXT_MAX_TURNS, after_id: int = 0) -> list[tuple]:
+    # строки истории с метаданными: (role, content, tokens, persona_id, id); одно чтение можно
+    # дорезать под меньший бюджет через fit_history (fan-out, место под долгую память).
+    # after_id — threads.summary_upto: свёрнутое в summary уже есть в голове контекста.
+    # Идём от новых к старым курсором по индексу (thread_id, created_at, id) и останавливаемся,
+    # как только следующее сообщение не влезает — старше ничего не читается
+    if budget <= 0 or max_turns <= 0:
+        return []
+    stmt = (
+        select(Message.role, Message.content, Message.tokens, Message.persona_id, Message.id)
+        .where(Message.thread_id == thread_id, Message.id > after_id)
+        .order_by(Message.created_at.desc(), Message.id.desc())
+        .limit(max_turns)
+        .execution_options(yield_per=16)
+    )
+    picked, used = [], 0
+    for role, content, tokens, persona_id, mid in s.execute(stmt):
+        cost = tokens or estimate_tokens(content)
+        if used + cost > budget:
+            break
+        used += cost
+        picked.append((role, content, cost, persona_id, mid))
+    return picked[::-1]
+
+
+def fit_history(rows: list[tuple], budget: int) -> list[tuple]:
+    used, start = 0, len(rows)
+    while start > 0 and used + rows[start - 1][2] <= budget:
+        start -= 1
+        used += rows[start][2]
+    return rows[start:]
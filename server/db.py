@@ -1,13 +1,56 @@
 from __future__ import annotations
 import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from sqlalchemy import create_engine
+from functools import partial
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
 
 DB_PATH = os.getenv("DB_PATH", "chat.db")
-engine = create_engine(f"sqlite:///{DB_PATH}", echo=False, future=True)
+# потоков под синхронный SQLAlchemy; SQLite всё равно пишет в один поток, читать можно параллельно
+DB_WORKERS = int(os.getenv("DB_WORKERS", "4"))
+
+# продакшн-режим SQLite: WAL (читатели не ждут писателя), ослабленный fsync, busy_timeout вместо "database is locked"
+SQLITE_TUNING = os.getenv("SQLITE_TUNING", "1") == "1"
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")  # OFF | NORMAL | FULL | EXTRA
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))
+# INCREMENTAL — освобождённые страницы возвращает archive.py порциями (PRAGMA incremental_vacuum);
+# для новой базы действует сразу, существующую init_db.py переводит одним полным VACUUM
+SQLITE_AUTO_VACUUM = os.getenv("SQLITE_AUTO_VACUUM", "INCREMENTAL")  # NONE | FULL | INCREMENTAL
+
+engine = create_engine(
+    f"sqlite:///{DB_PATH}",
+    echo=False,
+    future=True,
+    pool_size=DB_WORKERS,
+    connect_args={"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000.0},
+)
+
+@event.listens_for(engine, "connect")
+def _sqlite_pragmas(dbapi_conn, _record):
+    if not SQLITE_TUNING:
+        return
+    cur = dbapi_conn.cursor()
+    try:
+        # до journal_mode: на пустом файле режим фиксируется при создании первой таблицы
+        cur.execute(f"PRAGMA auto_vacuum={SQLITE_AUTO_VACUUM}")
+        cur.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+        cur.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        cur.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cur.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        # отрицательное значение — размер в KiB, а не в страницах
+        cur.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+        cur.execute("PRAGMA temp_store=MEMORY")
+    finally:
+        cur.close()
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
 
+_executor: ThreadPoolExecutor | None = None
+
 @contextmanager
 def session_scope():
     session = SessionLocal()
@@ -18,4 +61,26 @@ def session_scope():
         session.rollback()
         raise
     finally:
-        session.close()
\ No newline at end of file
+        session.close()
+
+def _run_in_session(fn, *args, **kwargs):
+    with session_scope() as s:
+        return fn(s, *args, **kwargs)
+
+def db_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
+    return _executor
+
+async def run_db(fn, *args, **kwargs):
+    # fn(session, ...) выполняется в отдельном пуле потоков, event loop не блокируется
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor(), partial(_run_in_session, fn, *args, **kwargs))
+
+def shutdown_db():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+    engine.dispose()
@@ -0,0 +1,375 @@
+from __future__ import annotations
+import os
+import sys
+import json
+import zlib
+import asyncio
+import argparse
+from datetime import datetime, timezone
+from typing import AsyncIterable, AsyncIterator, Callable, Optional
+from sqlalchemy import func, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from db import run_db
+from models import Message, Persona, Setting, Thread
+from archive import read_archive
+from context import estimate_tokens
+from prompt_cache import PromptCache, VERSION_KEY
+
+# Резервная копия и перенос данных потоком NDJSON: одна запись на строку, {"type": ..., ...поля}.
+# Порядок — meta, setting, persona, thread, message: при импорте треды всегда раньше своих сообщений
+# (статистику тредов считают триггеры на вставку сообщений). Архивные сообщения (archive.py) выгружаются
+# вместе с горячими и при импорте становятся обычными строками messages.
+# Выгрузка идёт keyset-страницами по EXPORT_CHUNK_ROWS, ничего целиком в память не собирается;
+# это не снимок на момент времени — сообщения ограничены максимальным id на старте выгрузки.
+# since — инкрементальная копия: треды, изменённые с since (threads.modified_at: его сдвигают триггеры
+# и на сообщения, и на правку summary/модели/персоны), и сообщения с created_at >= since.
+#
+#   python dump.py export -o backup.ndjson.gz [--since 2025-01-01T00:00:00]
+#   python dump.py import backup.ndjson.gz [--on-conflict skip|update|fail]
+
+FORMAT_VERSION = 1
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "2000"))
+EXPORT_FLUSH_BYTES = int(os.getenv("EXPORT_FLUSH_BYTES", str(64 * 1024)))
+IMPORT_BATCH_ROWS = int(os.getenv("IMPORT_BATCH_ROWS", "5000"))  # строк на транзакцию импорта
+CONFLICT_MODES = ("skip", "update", "fail")
+
+THREAD_COLUMNS = (
+    Thread.id, Thread.persona_id, Thread.model, Thread.summary, Thread.summary_upto,
+    Thread.created_at, Thread.updated_at,
+)
+MESSAGE_COLUMNS = (
+    Message.id, Message.thread_id, Message.role, Message.content, Message.tokens, Message.persona_id, Message.created_at,
+    Message.deliver_at,
+)
+PERSONA_COLUMNS = (Persona.id, Persona.name, Persona.bio, Persona.style, Persona.boundaries, Persona.goals)
+DATETIME_FIELDS = ("created_at", "updated_at", "deliver_at")
+NOW_IF_EMPTY = ("created_at", "updated_at")  # deliver_at пустой — сообщение уже показано
+
+
+def naive_utc(ts: Optional[datetime]) -> Optional[datetime]:
+    # в базе время хранится наивным UTC
+    if ts is not None and ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts
+
+
+def _record(kind: str, row: dict) -> dict:
+    rec = {"type": kind}
+    for k, v in row.items():
+        rec[k] = v.isoformat() if isinstance(v, datetime) else v
+    return rec
+
+
+# === Export ===
+def _page(s, stmt, key, after, limit: int) -> list[dict]:
+    if after is not None:
+        stmt = stmt.where(key > after)
+    return [r._asdict() for r in s.execute(stmt.order_by(key).limit(limit))]
+
+
+async def _pages(stmt, key) -> AsyncIterator[dict]:
+    after = None
+    while True:
+        rows = await run_db(_page, stmt, key, after, EXPORT_CHUNK_ROWS)
+        for r in rows:
+            yield r
+        if len(rows) < EXPORT_CHUNK_ROWS:
+            return
+        after = rows[-1][key.key]
+
+
+async def export_records(since: Optional[datetime] = None) -> AsyncIterator[dict]:
+    since = naive_utc(since)
+    top = await run_db(lambda s: s.execute(select(func.max(Message.id))).scalar() or 0)
+    yield {
+        "type": "meta", "version": FORMAT_VERSION,
+        "exported_at": datetime.utcnow().isoformat(), "since": since.isoformat() if since else None,
+    }
+
+    # настройки и персоны — маленькие и без отметок времени, выгружаются всегда
+    stmt = select(Setting.key, Setting.value).where(Setting.key != VERSION_KEY)
+    async for r in _pages(stmt, Setting.key):
+        yield _record("setting", r)
+    async for r in _pages(select(*PERSONA_COLUMNS), Persona.id):
+        yield _record("persona", r)
+
+    stmt = select(*THREAD_COLUMNS)
+    if since is not None:
+        # updated_at двигают только сообщения; правка summary или модели видна лишь в modified_at
+        stmt = stmt.where(func.coalesce(Thread.modified_at, Thread.updated_at) >= since)
+    async for r in _pages(stmt, Thread.id):
+        yield _record("thread", r)
+
+    stmt = select(*MESSAGE_COLUMNS).where(Message.id <= top)
+    if since is not None:
+        stmt = stmt.where(Message.created_at >= since)
+    async for r in _pages(stmt, Message.id):
+        yield _record("message", r)
+
+    # архивный префикс тредов: файл читается целиком, по одному треду за раз
+    stmt = select(Thread.id, Thread.archived_count, Thread.archived_until, Thread.archived_until_id) \
+        .where(Thread.archived_count > 0)
+    if since is not None:
+        stmt = stmt.where(Thread.archived_until >= since)
+    async for t in _pages(stmt, Thread.id):
+        rows = await asyncio.to_thread(read_archive, Thread(**t))
+        for r in rows:
+            if since is None or r["created_at"] >= since:
+                yield _record("message", {**r, "thread_id": t["id"]})
+
+
+async def export_ndjson(since: Optional[datetime] = None, compress: bool = False) -> AsyncIterator[bytes]:
+    # строки копятся до EXPORT_FLUSH_BYTES, чтобы не отдавать по чанку на запись
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buf: list[bytes] = []
+    size = 0
+    async for rec in export_records(since):
+        line = (json.dumps(rec, ensure_ascii=False) + "\n").encode()
+        buf.append(line)
+        size += len(line)
+        if size >= EXPORT_FLUSH_BYTES:
+            data = b"".join(buf)
+            buf, size = [], 0
+            data = gz.compress(data) if gz else data
+            if data:
+                yield data
+    data = b"".join(buf)
+    if gz:
+        data = gz.compress(data) + gz.flush()
+    if data:
+        yield data
+
+
+# === Import ===
+def _prepare(kind: str, rec: dict) -> dict:
+    row = {k: v for k, v in rec.items() if k != "type"}
+    for k in DATETIME_FIELDS:
+        if isinstance(row.get(k), str):
+            row[k] = datetime.fromisoformat(row[k])
+        elif k in NOW_IF_EMPTY and k in row and row[k] is None:
+            row[k] = datetime.utcnow()
+    if kind == "message" and not row.get("tokens"):
+        row["tokens"] = estimate_tokens(row.get("content") or "")
+    return row
+
+
+def _write(s, model, rows: list[dict], columns, keys: tuple[str, ...], update: Callable, on_conflict: str) -> int:
+    stmt = sqlite_insert(model.__table__)
+    if on_conflict == "skip":
+        stmt = stmt.on_conflict_do_nothing(index_elements=list(keys))
+    elif on_conflict == "update":
+        stmt = stmt.on_conflict_do_update(index_elements=list(keys), set_=update(stmt.excluded))
+    # executemany требует одинаковый набор полей: записи без части полей (нет id и т.п.) идут отдельной группой.
+    # INSERT OR REPLACE не годится — его удаление не видят триггеры
+    names = [c.key for c in columns]
+    groups: dict[tuple[str, ...], list[dict]] = {}
+    for r in rows:
+        row = {n: r[n] for n in names if n in r}
+        groups.setdefault(tuple(row), []).append(row)
+    conn = s.connection()
+    return sum(conn.execute(stmt, group).rowcount for group in groups.values())
+
+
+def _skip_archived(s, rows: list[dict]) -> list[dict]:
+    # строки, которые в этой базе уже лежат в архиве треда, обратно в messages не вставляются
+    tids = {r["thread_id"] for r in rows}
+    bounds = {
+        tid: (until, until_id) for tid, until, until_id in s.execute(
+            select(Thread.id, Thread.archived_until, Thread.archived_until_id)
+            .where(Thread.id.in_(tids), Thread.archived_count > 0)
+        )
+    }
+    if not bounds:
+        return rows
+    return [r for r in rows if r["thread_id"] not in bounds or (r["created_at"], r.get("id") or 0) > bounds[r["thread_id"]]]
+
+
+def _flush(s, batch: dict[str, list[dict]], on_conflict: str) -> dict[str, int]:
+    written = {}
+    if batch["setting"]:
+        written["setting"] = _write(
+            s, Setting, batch["setting"], (Setting.key, Setting.value), ("key",),
+            lambda ex: {"value": ex.value}, on_conflict,
+        )
+    if batch["persona"]:
+        written["persona"] = _write(
+            s, Persona, batch["persona"], PERSONA_COLUMNS, ("id",),
+            lambda ex: {c.key: getattr(ex, c.key) for c in PERSONA_COLUMNS[1:]}, on_conflict,
+        )
+    if written:
+        PromptCache.bump(s)
+    if batch["thread"]:
+        # счётчики, превью и архивные поля не импортируются: их поддерживают триггеры и archive.py
+        written["thread"] = _write(
+            s, Thread, batch["thread"], THREAD_COLUMNS, ("id",),
+            lambda ex: {
+                "persona_id": ex.persona_id, "model": ex.model, "summary": ex.summary,
+                "summary_upto": ex.summary_upto, "updated_at": func.max(Thread.updated_at, ex.updated_at),
+            },
+            on_conflict,
+        )
+    rows = _skip_archived(s, batch["message"]) if batch["message"] else []
+    if rows:
+        # меняется только содержимое: перенос между тредами триггеры статистики не отслеживают
+        written["message"] = _write(
+            s, Message, rows, MESSAGE_COLUMNS, ("id",),
+            lambda ex: {
+                "role": ex.role, "content": ex.content, "tokens": ex.tokens,
+                "persona_id": ex.persona_id, "deliver_at": ex.deliver_at,
+            },
+            on_conflict,
+        )
+    return written
+
+
+class Importer:
+    KINDS = ("setting", "persona", "thread", "message")
+
+    def __init__(self, on_conflict: str = "skip"):
+        if on_conflict not in CONFLICT_MODES:
+            raise ValueError(f"on_conflict must be one of {', '.join(CONFLICT_MODES)}")
+        self.on_conflict = on_conflict
+        self.batch: dict[str, list[dict]] = {k: [] for k in self.KINDS}
+        self.pending = 0
+        self.lines = 0
+        self.read = {k: 0 for k in self.KINDS}
+        self.written = {k: 0 for k in self.KINDS}
+        self.ignored = 0
+
+    async def add(self, rec: dict):
+        kind = rec.get("type")
+        if kind == "meta":
+            if int(rec.get("version") or 0) > FORMAT_VERSION:
+                raise ValueError(f"unsupported export version {rec.get('version')}")
+            return
+        if kind not in self.batch or (kind == "setting" and rec.get("key") == VERSION_KEY):
+            self.ignored += 1
+            return
+        self.batch[kind].append(_prepare(kind, rec))
+        self.read[kind] += 1
+        self.pending += 1
+        if self.pending >= IMPORT_BATCH_ROWS:
+            await self.flush()
+
+    async def flush(self):
+        if not self.pending:
+            return
+        # все типы пачки пишутся одной транзакцией в порядке KINDS
+        batch, self.batch, self.pending = self.batch, {k: [] for k in self.KINDS}, 0
+        for kind, n in (await run_db(_flush, batch, self.on_conflict)).items():
+            self.written[kind] += n
+
+    async def feed(self, chunks: AsyncIterable[bytes]):
+        tail = b""
+        async for data in _gunzip(chunks):
+            lines = (tail + data).split(b"\n")
+            tail = lines.pop()
+            for line in lines:
+                await self._line(line)
+        await self._line(tail)
+        await self.flush()
+
+    async def _line(self, line: bytes):
+        if not line.strip():
+            return
+        self.lines += 1
+        try:
+            rec = json.loads(line)
+        except ValueError:
+            raise ValueError(f"line {self.lines}: invalid JSON")
+        if not isinstance(rec, dict):
+            raise ValueError(f"line {self.lines}: expected an object")
+        try:
+            await self.add(rec)
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"line {self.lines}: bad {rec.get('type')} record: {e!r}")
+
+    def as_dict(self) -> dict:
+        return {"lines": self.lines, "read": self.read, "written": self.written, "ignored": self.ignored}
+
+
+async def _gunzip(chunks: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+    # gzip определяется по сигнатуре; поддерживаются файлы из нескольких gzip-member
+    d = None
+    first = True
+    partial = False  # member начат, но не дочитан
+    async for data in chunks:
+        if first and data:
+            first = False
+            if data[:2] == b"\x1f\x8b":
+                d = zlib.decompressobj(31)
+        if d is None:
+            yield data
+            continue
+        while data:
+            try:
+                out = d.decompress(data)
+            except zlib.error as e:
+                raise ValueError(f"bad gzip stream: {e}")
+            if out:
+                yield out
+            partial = not d.eof
+            data = d.unused_data if d.eof else b""
+            if d.eof:
+                d = zlib.decompressobj(31)
+    if partial:
+        raise ValueError("truncated gzip stream")
+
+
+async def import_ndjson(chunks: AsyncIterable[bytes], on_conflict: str = "skip") -> dict:
+    importer = Importer(on_conflict)
+    await importer.feed(chunks)
+    return importer.as_dict()
+
+
+# === CLI ===
+async def _read_file(f, size: int = 1 << 20) -> AsyncIterator[bytes]:
+    while True:
+        data = await asyncio.to_thread(f.read, size)
+        if not data:
+            return
+        yield data
+
+
+async def _main(args):
+    from db import shutdown_db
+
+    try:
+        if args.cmd == "export":
+            since = datetime.fromisoformat(args.since) if args.since else None
+            compress = args.gzip or args.output.endswith(".gz")
+            out = sys.stdout.buffer if args.output == "-" else open(args.output, "wb")
+            try:
+                async for data in export_ndjson(since, compress):
+                    out.write(data)
+            finally:
+                if out is not sys.stdout.buffer:
+                    out.close()
+        else:
+            f = sys.stdin.buffer if args.input == "-" else open(args.input, "rb")
+            try:
+                print(json.dumps(await import_ndjson(_read_file(f), args.on_conflict), ensure_ascii=False))
+            finally:
+                if f is not sys.stdin.buffer:
+                    f.close()
+    finally:
+        shutdown_db()
+
+
+def main():
+    p = argparse.ArgumentParser(description="Выгрузка и загрузка тредов, сообщений, персон и настроек в NDJSON")
+    sub = p.add_subparsers(dest="cmd", required=True)
+    e = sub.add_parser("export", help="выгрузить базу")
+    e.add_argument("-o", "--output", default="-", help="файл ('-' — stdout); *.gz — со сжатием")
+    e.add_argument("--since", help="только изменённое начиная с ISO-времени (UTC)")
+    e.add_argument("--gzip", action="store_true", help="сжимать gzip")
+    i = sub.add_parser("import", help="загрузить выгрузку")
+    i.add_argument("input", help="NDJSON или NDJSON.gz ('-' — stdin)")
+    i.add_argument("--on-conflict", choices=CONFLICT_MODES, default="skip",
+                   help="существующие записи: пропустить, обновить или прервать импорт")
+    asyncio.run(_main(p.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
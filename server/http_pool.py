@@ -0,0 +1,77 @@
+from __future__ import annotations
+import os
+import asyncio
+import importlib.util
+from typing import Dict, Optional
+import httpx
+
+# Общий пул HTTP-соединений к LLM-провайдерам.
+# Один httpx.AsyncClient на провайдера: keep-alive, без TLS-рукопожатия на каждый ход чата.
+
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "0") == "1"
+HTTP_PREWARM = os.getenv("HTTP_PREWARM", "1") == "1"
+HTTP_PREWARM_TIMEOUT = float(os.getenv("HTTP_PREWARM_TIMEOUT", "5"))
+
+# HTTP/2 в httpx требует пакет h2 — если его нет, тихо остаёмся на HTTP/1.1
+_H2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+class ProviderPool:
+    def __init__(self):
+        # provider -> (base_url, read timeout, prewarm)
+        self._specs: Dict[str, tuple[str, float, bool]] = {}
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+
+    def register(self, provider: str, base_url: str, timeout: float = 60, prewarm: bool = True):
+        self._specs[provider] = (base_url.rstrip("/"), timeout, prewarm)
+
+    def _make_client(self, provider: str) -> httpx.AsyncClient:
+        base_url, timeout, _ = self._specs.get(provider, ("", 60, False))
+        # лимиты можно переопределить на провайдера: HTTP_MAX_CONNECTIONS_GROQ=...
+        suffix = provider.upper()
+        limits = httpx.Limits(
+            max_connections=int(os.getenv(f"HTTP_MAX_CONNECTIONS_{suffix}", HTTP_MAX_CONNECTIONS)),
+            max_keepalive_connections=int(os.getenv(f"HTTP_MAX_KEEPALIVE_{suffix}", HTTP_MAX_KEEPALIVE)),
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        )
+        return httpx.AsyncClient(
+            base_url=base_url,
+            limits=limits,
+            timeout=httpx.Timeout(timeout, connect=HTTP_CONNECT_TIMEOUT),
+            http2=HTTP2_ENABLED and _H2_AVAILABLE,
+        )
+
+    def client(self, provider: str) -> httpx.AsyncClient:
+        # лениво создаём клиент, если пул не был поднят через lifespan (скрипты, тесты)
+        cli = self._clients.get(provider)
+        if cli is None or cli.is_closed:
+            cli = self._make_client(provider)
+            self._clients[provider] = cli
+        return cli
+
+    async def _prewarm_one(self, provider: str):
+        base_url, _, prewarm = self._specs[provider]
+        if not base_url or not prewarm:
+            return
+        try:
+            # любой ответ (хоть 404) означает, что TCP+TLS уже установлены и соединение в пуле
+            await self.client(provider).head("/", timeout=HTTP_PREWARM_TIMEOUT)
+        except Exception:
+            pass
+
+    async def start(self, prewarm: Optional[bool] = None):
+        for provider in self._specs:
+            self.client(provider)
+        if HTTP_PREWARM if prewarm is None else prewarm:
+            await asyncio.gather(*(self._prewarm_one(p) for p in self._specs))
+
+    async def close(self):
+        clients, self._clients = list(self._clients.values()), {}
+        await asyncio.gather(*(c.aclose() for c in clients), return_exceptions=True)
+
+
+pool = ProviderPool()
@@ -0,0 +1,75 @@
+from __future__ import annotations
+import os
+import json
+import asyncio
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, Optional
+from sqlalchemy import delete
+
+from db import run_db
+from models import IdempotencyKey
+
+# Идемпотентность /api/chat: повтор с тем же ключом не пишет новых сообщений и не зовёт провайдера.
+# Дубликаты, пришедшие пока первый запрос выполняется, ждут тот же future (singleflight);
+# пришедшие после — получают сохранённый ответ из таблицы idempotency_keys.
+# Неудачный ход не запоминается, но записанное им сообщение пользователя помечается отдельным ключом
+# (once): повтор после 5xx отвечает на то же сообщение, а не пишет его копию.
+
+IDEMPOTENCY_TTL_S = int(os.getenv("IDEMPOTENCY_TTL_S", str(24 * 3600)))
+
+
+def _load(s, key: str) -> Optional[dict]:
+    row = s.get(IdempotencyKey, key)
+    if row is None or row.created_at < datetime.utcnow() - timedelta(seconds=IDEMPOTENCY_TTL_S):
+        return None
+    return json.loads(row.response)
+
+
+def _store(s, key: str, response: dict):
+    s.merge(IdempotencyKey(key=key, response=json.dumps(response, ensure_ascii=False), created_at=datetime.utcnow()))
+
+
+def purge_expired(s) -> int:
+    cutoff = datetime.utcnow() - timedelta(seconds=IDEMPOTENCY_TTL_S)
+    return s.execute(delete(IdempotencyKey).where(IdempotencyKey.created_at < cutoff)).rowcount
+
+
+class IdempotencyStore:
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    async def run(self, key: str, fn: Callable[[], Awaitable[dict]]) -> dict:
+        fut = self._inflight.get(key)
+        if fut is None:
+            # ход идёт отдельной задачей, не привязанной к запросу: уход клиента (отмена ведущего)
+            # не отменяет ни его, ни дубликаты — результат сохранится и достанется повтору
+            fut = self._inflight[key] = asyncio.create_task(self._compute(key, fn))
+            fut.add_done_callback(lambda f: f.cancelled() or f.exception())  # без "exception was never retrieved"
+        return await asyncio.shield(fut)
+
+    async def _compute(self, key: str, fn: Callable[[], Awaitable[dict]]) -> dict:
+        try:
+            result = await run_db(_load, key)
+            if result is None:
+                # неудачный ход не запоминаем: повтор с тем же ключом выполнится заново
+                result = await fn()
+                await run_db(_store, key, result)
+            return result
+        finally:
+            self._inflight.pop(key, None)
+
+    async def once(self, key: str, fn: Callable[[], Awaitable[Optional[dict]]]) -> bool:
+        # побочный эффект, который не должен повторяться при ретраях упавшего хода (запись сообщения
+        # пользователя): после успеха fn ключ помечается, повтор fn не вызывает. False — уже выполнялось
+        if await run_db(_load, key) is not None:
+            return False
+        result = await fn()
+        await run_db(_store, key, result or {})
+        return True
+
+    @property
+    def inflight(self) -> int:
+        return len(self._inflight)
+
+
+idempotency = IdempotencyStore()
@@ -6,11 +6,14 @@ from sqlalchemy import create_engine
 from sqlalchemy.engine import Engine
 from sqlalchemy import inspect
 
-from db import engine, session_scope
+from db import engine, session_scope, SQLITE_AUTO_VACUUM
 from models import Base, Persona, Thread, Setting
+from context import estimate_tokens
+from search import ensure_fts
 
 # Можно задать дефолтную модель для новых/мигрируемых тредов через .env
 DEFAULT_MODEL = os.getenv("DEFAULT_MODEL", "gemini:gemini-1.5-flash")
+THREAD_PREVIEW_CHARS = int(os.getenv("THREAD_PREVIEW_CHARS", "200"))
 
 DEFAULT_PERSONAS = [
     # {
@@ -115,6 +118,134 @@ def ensure_threads_model_column(e: Engine):
             # заполняем дефолтом
             conn.execute(text("UPDATE threads SET model = :m WHERE model = '' OR model IS NULL"), {"m": DEFAULT_MODEL})
 
+def add_column_if_missing(e: Engine, table: str, column: str, ddl: str):
+    insp = inspect(e)
+    try:
+        cols = {c["name"] for c in insp.get_columns(table)}
+    except Exception:
+        return False
+    if column not in cols:
+        with e.begin() as conn:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+        return True
+    return False
+
+def ensure_messages_thread_created_index(e: Engine):
+    # составной индекс (thread_id, created_at, id) для истории и keyset-пагинации;
+    # старый одноколоночный индекс по thread_id — его префикс, удаляем
+    with e.begin() as conn:
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_messages_thread_created ON messages (thread_id, created_at, id)"
+        ))
+        conn.execute(text("DROP INDEX IF EXISTS ix_messages_thread_id"))
+
+def backfill_message_tokens(e: Engine, chunk: int = 5000):
+    # оценка токенов для сообщений, вставленных до появления колонки tokens
+    last_id = 0
+    while True:
+        with e.begin() as conn:
+            rows = conn.execute(
+                text("SELECT id, content FROM messages WHERE tokens = 0 AND id > :last ORDER BY id LIMIT :n"),
+                {"last": last_id, "n": chunk},
+            ).all()
+            if not rows:
+                return
+            conn.execute(
+                text("UPDATE messages SET tokens = :t WHERE id = :id"),
+                [{"t": estimate_tokens(content or ""), "id": mid} for mid, content in rows],
+            )
+        last_id = rows[-1][0]
+
+def ensure_thread_stats(e: Engine, backfill: bool):
+    # threads.message_count / last_message_preview / updated_at ведут триггеры на messages:
+    # листингу тредов не нужно ни считать сообщения, ни читать их
+    latest = (
+        "SELECT substr(content, 1, {n}) FROM messages WHERE thread_id = {tid} "
+        "ORDER BY created_at DESC, id DESC LIMIT 1"
+    )
+    with e.begin() as conn:
+        if backfill:
+            conn.execute(text(f"""
+                UPDATE threads SET
+                    message_count = (SELECT count(*) FROM messages WHERE thread_id = threads.id),
+                    last_message_preview = coalesce(({latest.format(n=THREAD_PREVIEW_CHARS, tid="threads.id")}), ''),
+                    updated_at = max(updated_at, coalesce(
+                        (SELECT max(created_at) FROM messages WHERE thread_id = threads.id), updated_at))
+            """))
+        # превью меняем, только если вставка новее последнего сообщения (импорт старой истории его не трогает)
+        conn.execute(text(f"""
+            CREATE TRIGGER IF NOT EXISTS threads_stats_ai AFTER INSERT ON messages BEGIN
+                UPDATE threads SET
+                    message_count = message_count + 1,
+                    last_message_preview = CASE WHEN new.created_at >= updated_at
+                        THEN substr(new.content, 1, {THREAD_PREVIEW_CHARS}) ELSE last_message_preview END,
+                    updated_at = max(updated_at, new.created_at)
+                WHERE id = new.thread_id;
+            END
+        """))
+        # updated_at при удалении не трогаем: удаление — не активность в треде
+        conn.execute(text(f"""
+            CREATE TRIGGER IF NOT EXISTS threads_stats_ad AFTER DELETE ON messages BEGIN
+                UPDATE threads SET
+                    message_count = max(message_count - 1, 0),
+                    last_message_preview = coalesce(({latest.format(n=THREAD_PREVIEW_CHARS, tid="old.thread_id")}), '')
+                WHERE id = old.thread_id;
+            END
+        """))
+        conn.execute(text(f"""
+            CREATE TRIGGER IF NOT EXISTS threads_stats_au AFTER UPDATE OF content ON messages BEGIN
+                UPDATE threads SET
+                    last_message_preview = coalesce(({latest.format(n=THREAD_PREVIEW_CHARS, tid="new.thread_id")}), '')
+                WHERE id = new.thread_id;
+            END
+        """))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_threads_updated ON threads (updated_at, id)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_threads_created ON threads (created_at, id)"))
+
+def ensure_thread_version(e: Engine):
+    # threads.version/modified_at — валидатор условных GET (conditional.py): меняются при любой записи
+    # в сообщения треда и при правке полей, которые видны в ответах API
+    now = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+    bump = "UPDATE threads SET version = version + 1, modified_at = " + now + " WHERE id {cond};"
+    with e.begin() as conn:
+        conn.execute(text(f"""
+            CREATE TRIGGER IF NOT EXISTS threads_version_msg_ai AFTER INSERT ON messages BEGIN
+                {bump.format(cond="= new.thread_id")}
+            END
+        """))
+        conn.execute(text(f"""
+            CREATE TRIGGER IF NOT EXISTS threads_version_msg_ad AFTER DELETE ON messages BEGIN
+                {bump.format(cond="= old.thread_id")}
+            END
+        """))
+        conn.execute(text(f"""
+            CREATE TRIGGER IF NOT EXISTS threads_version_msg_au AFTER UPDATE ON messages BEGIN
+                {bump.format(cond="IN (old.thread_id, new.thread_id)")}
+            END
+        """))
+        # счётчики сообщений правят триггеры выше (и сами поднимают версию) — здесь только поля треда
+        conn.execute(text(f"""
+            CREATE TRIGGER IF NOT EXISTS threads_version_au
+            AFTER UPDATE OF persona_id, model, summary, summary_upto, archived_count ON threads BEGIN
+                {bump.format(cond="= new.id")}
+            END
+        """))
+        conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_messages_pending ON messages (thread_id, deliver_at) "
+            "WHERE deliver_at IS NOT NULL"
+        ))
+
+def ensure_auto_vacuum(e: Engine):
+    # auto_vacuum существующей базы меняется только полным VACUUM (переписывает файл целиком, один раз)
+    modes = {"NONE": 0, "FULL": 1, "INCREMENTAL": 2}
+    want = modes.get(SQLITE_AUTO_VACUUM.upper())
+    with e.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if want is None or conn.exec_driver_sql("PRAGMA auto_vacuum").scalar() == want:
+            return
+        print(f"auto_vacuum -> {SQLITE_AUTO_VACUUM}: VACUUM ...")
+        conn.exec_driver_sql(f"PRAGMA auto_vacuum={want}")
+        conn.exec_driver_sql("VACUUM")
+
 def seed_personas():
     with session_scope() as s:
         for p in DEFAULT_PERSONAS:
@@ -141,6 +272,33 @@ def main():
 
     ensure_threads_model_column(engine)
 
+    ensure_messages_thread_created_index(engine)
+
+    add_column_if_missing(engine, "threads", "summary_upto", "INTEGER NOT NULL DEFAULT 0")
+
+    add_column_if_missing(engine, "messages", "tokens", "INTEGER NOT NULL DEFAULT 0")
+    backfill_message_tokens(engine)
+
+    added = add_column_if_missing(engine, "threads", "message_count", "INTEGER NOT NULL DEFAULT 0")
+    added |= add_column_if_missing(engine, "threads", "last_message_preview", "TEXT NOT NULL DEFAULT ''")
+    ensure_thread_stats(engine, backfill=added)
+
+    add_column_if_missing(engine, "threads", "archived_count", "INTEGER NOT NULL DEFAULT 0")
+    add_column_if_missing(engine, "threads", "archived_until", "DATETIME")
+    add_column_if_missing(engine, "threads", "archived_until_id", "INTEGER")
+
+    add_column_if_missing(engine, "messages", "deliver_at", "DATETIME")
+    add_column_if_missing(engine, "messages", "persona_id", "TEXT")
+
+    add_column_if_missing(engine, "threads", "version", "INTEGER NOT NULL DEFAULT 0")
+    add_column_if_missing(engine, "threads", "modified_at", "DATETIME")
+    ensure_thread_version(engine)
+
+    with engine.begin() as conn:
+        ensure_fts(conn)
+
+    ensure_auto_vacuum(engine)
+
     seed_personas()
 
     backfill_threads_model_if_empty()
@@ -0,0 +1,312 @@
+from __future__ import annotations
+import os
+import json
+import uuid
+import socket
+import asyncio
+import logging
+import argparse
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, Optional
+from sqlalchemy import and_, delete, func, or_, select, update
+
+from db import run_db
+from models import Job, Message
+from metrics import registry
+
+# Долговечная очередь ходов чата в SQLite: POST /api/chat?mode=async пишет сообщение пользователя и задачу
+# одной транзакцией и сразу отвечает 202 с id задачи; ответ модели считают воркеры (задачи asyncio в этом
+# или других процессах). Задача захватывается атомарным UPDATE ... RETURNING с арендой (lease): пока воркер
+# жив, он её продлевает; упавший воркер перестаёт продлевать, и после lease_until задачу берёт другой.
+# Ходы одного треда не выполняются параллельно ни в одном процессе; ответ на ход закрывает и задачи
+# на сообщения треда, которые уже попали в его контекст (как склейка в turns.py).
+#
+#   python jobs.py --workers 8   # процесс-воркер без HTTP (в API-процессах можно JOB_WORKERS=0)
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))  # воркеров в процессе; 0 — процесс только ставит задачи
+JOB_LEASE_S = float(os.getenv("JOB_LEASE_S", "60"))  # продлевается каждые JOB_LEASE_S/3, пока ход идёт
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_BACKOFF_S = float(os.getenv("JOB_BACKOFF_S", "5"))
+JOB_BACKOFF_MAX_S = float(os.getenv("JOB_BACKOFF_MAX_S", "300"))
+JOB_POLL_MS = int(os.getenv("JOB_POLL_MS", "500"))  # опрос базы: задачи других процессов и long-poll
+JOB_WAIT_MAX_S = float(os.getenv("JOB_WAIT_MAX_S", "30"))
+JOB_TTL_S = int(os.getenv("JOB_TTL_S", str(24 * 3600)))  # сколько хранить завершённые задачи
+
+TERMINAL = ("done", "failed")
+
+log = logging.getLogger(__name__)
+
+job_outcomes = registry.counter("jobs_total", "Background chat jobs by outcome", ("outcome",))
+
+Handler = Callable[[dict], Awaitable[dict]]
+
+
+class JobFailed(Exception):
+    # ошибка, повтор которой бессмыслен (нет персоны и т.п.): задача сразу становится failed
+    pass
+
+
+def enqueue(s, thread_id: str, payload: dict, message_id: Optional[int] = None, key: Optional[str] = None, kind: str = "chat") -> Job:
+    job = Job(
+        id=uuid.uuid4().hex, kind=kind, thread_id=thread_id, key=key, message_id=message_id,
+        payload=json.dumps(payload, ensure_ascii=False), status="queued",
+    )
+    s.add(job)
+    s.flush()
+    return job
+
+
+def job_by_key(s, key: str) -> Optional[Job]:
+    return s.execute(select(Job).where(Job.key == key)).scalar_one_or_none()
+
+
+def _claimable(now: datetime):
+    # в очереди и пора, либо аренда истекла (воркер умер); тред без живого хода
+    busy = select(Job.thread_id).where(Job.status == "running", Job.lease_until >= now)
+    return and_(
+        or_(
+            and_(Job.status == "queued", Job.available_at <= now),
+            and_(Job.status == "running", Job.lease_until < now),
+        ),
+        Job.thread_id.not_in(busy),
+    )
+
+
+def _claim(s, owner: str) -> Optional[dict]:
+    now = datetime.utcnow()
+    # сначала чтение без блокировки: пустой опрос не берёт write-lock базы
+    jid = s.execute(
+        select(Job.id).where(_claimable(now)).order_by(Job.available_at, Job.id).limit(1)
+    ).scalar()
+    if jid is None:
+        return None
+    row = s.execute(
+        update(Job).where(Job.id == jid, _claimable(now)).values(
+            status="running", attempts=Job.attempts + 1, lease_owner=owner,
+            lease_until=now + timedelta(seconds=JOB_LEASE_S), updated_at=now,
+        ).returning(Job.id, Job.kind, Job.thread_id, Job.payload, Job.attempts, Job.message_id),
+        execution_options={"synchronize_session": False},
+    ).first()
+    # {} — задачу перехватил другой воркер между чтением и UPDATE
+    return row._asdict() if row else {}
+
+
+def _owned(job_id: str, owner: str):
+    return and_(Job.id == job_id, Job.status == "running", Job.lease_owner == owner)
+
+
+def _extend(s, job_id: str, owner: str) -> bool:
+    until = datetime.utcnow() + timedelta(seconds=JOB_LEASE_S)
+    return s.execute(update(Job).where(_owned(job_id, owner)).values(lease_until=until)).rowcount > 0
+
+
+def _last_user_message(s, thread_id: str) -> Optional[int]:
+    return s.execute(
+        select(func.max(Message.id)).where(Message.thread_id == thread_id, Message.role == "user")
+    ).scalar()
+
+
+def _finish(s, job: dict, owner: str, result: dict, upto: Optional[int]) -> int:
+    now = datetime.utcnow()
+    values = dict(status="done", result=json.dumps(result, ensure_ascii=False), error=None,
+                  lease_owner=None, lease_until=None, updated_at=now)
+    if s.execute(update(Job).where(_owned(job["id"], owner)).values(**values)).rowcount == 0:
+        return -1  # аренду потеряли — задачу уже ведёт другой воркер
+    if upto is None:
+        return 0
+    # сообщения треда, попавшие в контекст этого хода, отдельного ответа не получат
+    return s.execute(
+        update(Job).where(
+            Job.thread_id == job["thread_id"], Job.status == "queued", Job.message_id <= upto,
+        ).values(**values)
+    ).rowcount
+
+
+def _fail(s, job: dict, owner: str, error: str, retry: bool):
+    now = datetime.utcnow()
+    if retry and job["attempts"] < JOB_MAX_ATTEMPTS:
+        delay = min(JOB_BACKOFF_S * 2 ** (job["attempts"] - 1), JOB_BACKOFF_MAX_S)
+        values = dict(status="queued", available_at=now + timedelta(seconds=delay))
+    else:
+        values = dict(status="failed")
+    s.execute(update(Job).where(_owned(job["id"], owner)).values(
+        error=error[:2000], lease_owner=None, lease_until=None, updated_at=now, **values
+    ))
+    return values["status"]
+
+
+def _release(s, job_id: str, owner: str):
+    # штатная остановка процесса: задача возвращается в очередь, попытка не засчитывается
+    s.execute(update(Job).where(_owned(job_id, owner)).values(
+        status="queued", attempts=Job.attempts - 1, lease_owner=None, lease_until=None,
+        available_at=datetime.utcnow(),
+    ))
+
+
+def get_job(s, job_id: str) -> Optional[dict]:
+    row = s.execute(select(
+        Job.id, Job.thread_id, Job.status, Job.attempts, Job.result, Job.error, Job.created_at, Job.updated_at,
+    ).where(Job.id == job_id)).first()
+    return row._asdict() if row else None
+
+
+def purge_finished(s) -> int:
+    cutoff = datetime.utcnow() - timedelta(seconds=JOB_TTL_S)
+    return s.execute(delete(Job).where(Job.status.in_(TERMINAL), Job.updated_at < cutoff)).rowcount
+
+
+class JobQueue:
+    def __init__(self, workers: int = JOB_WORKERS):
+        self.workers = workers
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.handler: Optional[Handler] = None
+        self._tasks: list[asyncio.Task] = []
+        self._wake: Optional[asyncio.Event] = None  # создаётся в start(), в цикле событий воркеров
+        self._done: Dict[str, asyncio.Event] = {}  # job_id -> событие для long-poll в этом процессе
+        self._waiters: Dict[str, int] = {}  # job_id -> сколько long-poll ждут; последний убирает событие
+        self.running = 0
+
+    def notify(self):
+        # новая задача в этом процессе — воркеры не ждут следующего опроса
+        if self._wake is not None:
+            self._wake.set()
+
+    def _finished(self, job_id: str):
+        ev = self._done.pop(job_id, None)
+        if ev is not None:
+            ev.set()
+
+    async def wait(self, job_id: str, timeout: float) -> Optional[dict]:
+        # long-poll: готовность в своём процессе — сразу по событию, из других — опросом раз в JOB_POLL_MS
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        self._waiters[job_id] = self._waiters.get(job_id, 0) + 1
+        try:
+            while True:
+                job = await run_db(get_job, job_id)
+                left = deadline - loop.time()
+                if job is None or job["status"] in TERMINAL or left <= 0:
+                    return job
+                ev = self._done.setdefault(job_id, asyncio.Event())
+                try:
+                    await asyncio.wait_for(ev.wait(), min(left, JOB_POLL_MS / 1000.0))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            # задачу мог выполнить другой процесс — тогда _finished здесь не вызовется и событие не уберёт
+            n = self._waiters.pop(job_id) - 1
+            if n:
+                self._waiters[job_id] = n
+            else:
+                self._done.pop(job_id, None)
+
+    async def _heartbeat(self, job_id: str):
+        while True:
+            await asyncio.sleep(JOB_LEASE_S / 3)
+            if not await run_db(_extend, job_id, self.owner):
+                log.warning("job %s: аренда потеряна", job_id)
+                return
+
+    async def _execute(self, job: dict):
+        beat = asyncio.create_task(self._heartbeat(job["id"]))
+        self.running += 1
+        coalesced = 0
+        try:
+            upto = await run_db(_last_user_message, job["thread_id"])
+            try:
+                result = await self.handler(job)
+            except asyncio.CancelledError:
+                await asyncio.shield(run_db(_release, job["id"], self.owner))
+                job_outcomes.inc(outcome="released")
+                raise
+            except JobFailed as e:
+                status = await run_db(_fail, job, self.owner, str(e), False)
+            except Exception as e:
+                log.warning("job %s (попытка %s) не выполнена: %s", job["id"], job["attempts"], e)
+                status = await run_db(_fail, job, self.owner, str(e) or type(e).__name__, True)
+            else:
+                coalesced = await run_db(_finish, job, self.owner, result, upto)
+                status = "done" if coalesced >= 0 else "lost"
+                if coalesced > 0:
+                    job_outcomes.inc(coalesced, outcome="coalesced")
+            job_outcomes.inc(outcome="retry" if status == "queued" else status)
+        finally:
+            self.running -= 1
+            beat.cancel()
+        self._finished(job["id"])
+        if coalesced > 0:
+            # ждущие закрытых вместе задач узнают об этом опросом; будим всех в этом процессе
+            for jid in list(self._done):
+                self._finished(jid)
+
+    async def _worker(self):
+        while True:
+            try:
+                job = await run_db(_claim, self.owner)
+            except Exception:
+                log.exception("job claim failed")
+                job = None
+            if job is None:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), JOB_POLL_MS / 1000.0)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            if not job:
+                continue  # гонка за задачу — сразу следующую
+            if job["attempts"] > JOB_MAX_ATTEMPTS:
+                # аренда истекала слишком часто (воркер падает на этой задаче)
+                await run_db(_fail, job, self.owner, "lease expired too many times", False)
+                job_outcomes.inc(outcome="failed")
+                self._finished(job["id"])
+                continue
+            try:
+                await self._execute(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # сбой записи статуса: задача останется running и вернётся в очередь по истечении аренды
+                log.exception("job %s: не удалось сохранить результат", job["id"])
+
+    async def start(self, handler: Handler):
+        self.handler = handler
+        if self._tasks:
+            return
+        self._wake = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+jobs = JobQueue()
+
+
+async def _main(args):
+    # воркер без HTTP: тот же lifespan, что у API (пулы, writer, summarizer), только с воркерами очереди.
+    # Очередь берётся из импортированного модуля jobs — этот файл запущен как __main__
+    from jobs import jobs as queue
+    from server import app, lifespan
+
+    queue.workers = args.workers
+    async with lifespan(app):
+        log.info("job worker %s: %d воркеров", queue.owner, queue.workers)
+        await asyncio.Event().wait()
+
+
+def main():
+    p = argparse.ArgumentParser(description="Процесс-воркер очереди фоновых ходов чата")
+    p.add_argument("--workers", type=int, default=max(JOB_WORKERS, 1))
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(_main(p.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
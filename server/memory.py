@@ -0,0 +1,353 @@
+from __future__ import annotations
+import os
+import re
+import math
+import zlib
+import asyncio
+import hashlib
+import logging
+import argparse
+import importlib
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Optional, Protocol
+import numpy as np
+from sqlalchemy import func, select
+
+from db import DB_PATH, run_db
+from models import Message, Thread
+from metrics import registry, phase
+from archive import read_archive
+
+try:
+    import fcntl
+except ImportError:  # Windows: блокировки нет, индексатор держите в одном процессе
+    fcntl = None
+
+# Долгая память треда: векторный индекс по старым сообщениям, которые уже не влезают в окно контекста.
+# Векторы лежат в файлах по тредам — матрица float32 (N x dim) и id сообщений (int64), только дописываются
+# и читаются через np.memmap; поиск — одно матрично-векторное умножение и argpartition.
+# Индексатор дописывает новые сообщения фоном по курсору messages.id (как push.py), поэтому индекс строится
+# инкрементально и видит записи всех процессов. Дописывание файлов и сдвиг курсора идут под flock на
+# MEMORY_DIR.lock, так что индексаторы нескольких воркеров не портят друг другу файлы; лишней работы
+# меньше, если оставить индексатор в одном процессе (в остальных MEMORY_INDEXER=0, поиск работает везде).
+#
+#   python memory.py            # догнать индекс (например, после включения на существующей базе)
+#   python memory.py --rebuild  # перестроить с нуля (смена эмбеддера/размерности)
+
+MEMORY_ENABLED = os.getenv("MEMORY_ENABLED", "1") == "1"
+MEMORY_INDEXER = os.getenv("MEMORY_INDEXER", "1") == "1"
+MEMORY_DIR = os.getenv("MEMORY_DIR", os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "memory"))
+# "hashing" или "module:factory" — factory() возвращает объект с name, dim и embed(texts) -> (n, dim)
+MEMORY_EMBEDDER = os.getenv("MEMORY_EMBEDDER", "hashing")
+MEMORY_DIM = int(os.getenv("MEMORY_DIM", "256"))  # размерность хэширующего эмбеддера; поиск ~ N*dim*4 байт чтения
+MEMORY_TOP_K = int(os.getenv("MEMORY_TOP_K", "4"))
+MEMORY_MIN_SCORE = float(os.getenv("MEMORY_MIN_SCORE", "0.25"))  # косинус; ниже — не вспоминаем
+MEMORY_MAX_TOKENS = int(os.getenv("MEMORY_MAX_TOKENS", "600"))  # сколько контекста отдавать воспоминаниям
+MEMORY_MIN_CHARS = int(os.getenv("MEMORY_MIN_CHARS", "20"))  # короткие реплики ("ок", "ага") не индексируем
+MEMORY_BATCH = int(os.getenv("MEMORY_BATCH", "500"))  # сообщений за проход индексатора
+MEMORY_POLL_S = float(os.getenv("MEMORY_POLL_S", "5"))
+MEMORY_CACHE_THREADS = int(os.getenv("MEMORY_CACHE_THREADS", "64"))  # открытых memmap-индексов
+
+RECALL_LABELS = {"user": "Собеседник", "assistant": "Ты"}
+
+log = logging.getLogger(__name__)
+
+memory_indexed = registry.counter("memory_indexed_total", "Messages added to the semantic memory index")
+
+
+class Embedder(Protocol):
+    name: str  # входит в имя файлов индекса: векторы разных эмбеддеров не смешиваются
+    dim: int
+
+    def embed(self, texts: list[str]) -> np.ndarray: ...
+
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+class HashingEmbedder:
+    # локальный, без модели и словаря: слова и их 5-символьные префиксы (грубая замена стемминга
+    # для русской морфологии) хэшируются в dim корзин со знаком, tf сублинейный, вектор L2-нормирован
+    def __init__(self, dim: int = MEMORY_DIM):
+        self.dim = dim
+        self.name = f"hash{dim}"
+
+    def _features(self, text: str) -> dict[int, float]:
+        counts: dict[str, int] = {}
+        for w in _WORD.findall(text.lower()):
+            if len(w) < 2 or w.isdigit():
+                continue
+            counts[w] = counts.get(w, 0) + 1
+            if len(w) > 5:
+                counts[w[:5] + "~"] = counts.get(w[:5] + "~", 0) + 1
+        out: dict[int, float] = {}
+        for tok, n in counts.items():
+            # crc32, а не hash(): hash строк солится на процесс
+            h = zlib.crc32(tok.encode())
+            idx = h % self.dim
+            out[idx] = out.get(idx, 0.0) + (1.0 + math.log(n)) * (1.0 if h & 0x80000000 else -1.0)
+        return out
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        m = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for idx, v in self._features(text or "").items():
+                m[i, idx] = v
+        norms = np.linalg.norm(m, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return m / norms
+
+
+def load_embedder(spec: str = MEMORY_EMBEDDER) -> Embedder:
+    if spec == "hashing":
+        return HashingEmbedder()
+    module, _, attr = spec.partition(":")
+    return getattr(importlib.import_module(module), attr or "embedder")()
+
+
+embedder: Embedder = load_embedder()
+
+
+# === файлы индекса ===
+def index_paths(thread_id: str) -> tuple[str, str]:
+    digest = hashlib.sha1(thread_id.encode()).hexdigest()
+    safe = re.sub(r"[^\w.-]", "_", thread_id)[:64]
+    base = os.path.join(MEMORY_DIR, digest[:2], f"{safe}-{digest[:12]}.{embedder.name}")
+    return base + ".vec", base + ".ids"
+
+
+def _rows(vec_path: str, ids_path: str) -> int:
+    # после сбоя между двумя дописываниями файлы могут разойтись — верим меньшему
+    try:
+        return min(os.path.getsize(vec_path) // (4 * embedder.dim), os.path.getsize(ids_path) // 8)
+    except FileNotFoundError:
+        return 0
+
+
+@lru_cache(maxsize=MEMORY_CACHE_THREADS)
+def _open(vec_path: str, ids_path: str, n: int) -> tuple[np.ndarray, np.ndarray]:
+    # ключ включает число строк: дописанный индекс откроется заново
+    vecs = np.memmap(vec_path, dtype=np.float32, mode="r", shape=(n, embedder.dim))
+    ids = np.fromfile(ids_path, dtype=np.int64, count=n)
+    return vecs, ids
+
+
+def _load(thread_id: str) -> Optional[tuple[np.ndarray, np.ndarray]]:
+    vec_path, ids_path = index_paths(thread_id)
+    n = _rows(vec_path, ids_path)
+    return _open(vec_path, ids_path, n) if n else None
+
+
+@contextmanager
+def _locked():
+    # межпроцессная блокировка индекса; файл рядом с MEMORY_DIR, чтобы --rebuild мог удалить каталог под ней
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(MEMORY_DIR) or ".", exist_ok=True)
+    with open(MEMORY_DIR + ".lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _append(thread_id: str, ids: list[int], vecs: np.ndarray):
+    vec_path, ids_path = index_paths(thread_id)
+    os.makedirs(os.path.dirname(vec_path), exist_ok=True)
+    n = _rows(vec_path, ids_path)
+    if n:
+        # повторный проход после сбоя: уже проиндексированное пропускаем
+        last = int(np.fromfile(ids_path, dtype=np.int64, count=1, offset=(n - 1) * 8)[0])
+        keep = [i for i, mid in enumerate(ids) if mid > last]
+        if not keep:
+            return 0
+        ids, vecs = [ids[i] for i in keep], vecs[keep]
+    for path, size in ((vec_path, n * 4 * embedder.dim), (ids_path, n * 8)):
+        with open(path, "ab") as f:
+            f.truncate(size)
+    with open(vec_path, "ab") as f:
+        f.write(np.ascontiguousarray(vecs, dtype=np.float32).tobytes())
+    with open(ids_path, "ab") as f:
+        f.write(np.asarray(ids, dtype=np.int64).tobytes())
+    return len(ids)
+
+
+def drop_memory(thread_id: str):
+    with _locked():
+        for path in index_paths(thread_id):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def index_rows(rows: list[tuple[int, str, str]]) -> int:
+    # (id, thread_id, content) по возрастанию id; эмбеддинг — одним вызовом на всю пачку
+    rows = [r for r in rows if len((r[2] or "").strip()) >= MEMORY_MIN_CHARS]
+    if not rows:
+        return 0
+    vecs = embedder.embed([r[2] for r in rows])
+    by_thread: dict[str, list[int]] = {}
+    for i, (_, tid, _) in enumerate(rows):
+        by_thread.setdefault(tid, []).append(i)
+    added = 0
+    for tid, pos in by_thread.items():
+        added += _append(tid, [rows[i][0] for i in pos], vecs[pos])
+    return added
+
+
+# === поиск ===
+def search(thread_id: str, query: str, before_id: int, k: int = MEMORY_TOP_K) -> list[tuple[int, float]]:
+    # (id, score) k самых похожих сообщений треда с id < before_id (старше окна контекста)
+    idx = _load(thread_id)
+    if idx is None or k <= 0:
+        return []
+    vecs, ids = idx
+    # ids отсортированы (дописываются по возрастанию) — окно контекста отрезается срезом, без маски
+    cut = int(np.searchsorted(ids, before_id))
+    if cut == 0:
+        return []
+    scores = vecs[:cut] @ embedder.embed([query])[0]
+    k = min(k, cut)
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+    return [(int(ids[i]), float(scores[i])) for i in top if scores[i] >= MEMORY_MIN_SCORE]
+
+
+def recall(s, thread_id: str, query: str, before_id: Optional[int]) -> Optional[str]:
+    # системная вставка с найденными старыми репликами (хронологически, не больше MEMORY_MAX_TOKENS);
+    # тексты берутся из messages, вынесенные в архив — из архива треда; удалённые просто выпадают
+    if not MEMORY_ENABLED or before_id is None or not query.strip():
+        return None
+    with phase("memory"):
+        hits = search(thread_id, query, before_id)
+    if not hits:
+        return None
+    wanted = {mid for mid, _ in hits}
+    rows = [tuple(r) for r in s.execute(
+        select(Message.id, Message.role, Message.content, Message.tokens).where(Message.id.in_(wanted))
+    )]
+    if len(rows) < len(wanted):
+        t = s.get(Thread, thread_id)
+        missing = wanted - {r[0] for r in rows}
+        if t is not None and t.archived_count:
+            rows += [(r["id"], r["role"], r["content"], r["tokens"]) for r in read_archive(t) if r["id"] in missing]
+    rank = {mid: i for i, (mid, _) in enumerate(hits)}
+    picked, used = [], 0
+    for mid, role, content, tokens in sorted(rows, key=lambda r: rank[r[0]]):
+        if used + (tokens or 0) > MEMORY_MAX_TOKENS:
+            continue
+        used += tokens or 0
+        picked.append((mid, role, content))
+    if not picked:
+        return None
+    lines = [f"- {RECALL_LABELS.get(role, role)}: {content}" for _, role, content in sorted(picked)]
+    return "Из давних сообщений этого диалога:\n" + "\n".join(lines)
+
+
+# === индексатор ===
+def _cursor_path() -> str:
+    return os.path.join(MEMORY_DIR, f"cursor.{embedder.name}")
+
+
+def _read_cursor() -> int:
+    try:
+        with open(_cursor_path()) as f:
+            return int(f.read().strip() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+def _write_cursor(value: int):
+    os.makedirs(MEMORY_DIR, exist_ok=True)
+    tmp = _cursor_path() + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(str(value))
+    os.replace(tmp, _cursor_path())
+
+
+def _batch(s, after: int, limit: int) -> list[tuple[int, str, str]]:
+    return [tuple(r) for r in s.execute(
+        select(Message.id, Message.thread_id, Message.content)
+        .where(Message.id > after, Message.role.in_(("user", "assistant")))
+        .order_by(Message.id).limit(limit)
+    )]
+
+
+def _index_batch(rows: list[tuple[int, str, str]]) -> tuple[int, int]:
+    # под блокировкой: курсор мог сдвинуть индексатор другого процесса — его часть пачки пропускаем
+    with _locked():
+        cursor = _read_cursor()
+        added = index_rows([r for r in rows if r[0] > cursor])
+        cursor = max(cursor, rows[-1][0])
+        _write_cursor(cursor)
+    return added, cursor
+
+
+class MemoryIndexer:
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+
+    async def run_once(self) -> int:
+        cursor = _read_cursor()
+        total = 0
+        while True:
+            rows = await run_db(_batch, cursor, MEMORY_BATCH)
+            if not rows:
+                return total
+            added, cursor = await asyncio.to_thread(_index_batch, rows)
+            memory_indexed.inc(added)
+            total += added
+            if len(rows) < MEMORY_BATCH:
+                return total
+
+    async def _run(self):
+        # спешить некуда: вспоминаются только сообщения старше окна контекста
+        while True:
+            await asyncio.sleep(MEMORY_POLL_S)
+            try:
+                await self.run_once()
+            except Exception:
+                log.exception("memory indexing failed")
+
+    async def start(self):
+        if self._task is None and MEMORY_ENABLED and MEMORY_INDEXER:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+memory = MemoryIndexer()
+
+
+async def _main(args):
+    import shutil
+    from db import shutdown_db
+
+    try:
+        if args.rebuild:
+            with _locked():
+                shutil.rmtree(MEMORY_DIR, ignore_errors=True)
+            _open.cache_clear()
+        n = await memory.run_once()
+        last = await run_db(lambda s: s.execute(select(func.max(Message.id))).scalar() or 0)
+        print({"indexed": n, "cursor": _read_cursor(), "max_id": last})
+    finally:
+        shutdown_db()
+
+
+def main():
+    p = argparse.ArgumentParser(description="Индекс долгой памяти тредов (векторный поиск по старым сообщениям)")
+    p.add_argument("--rebuild", action="store_true", help="удалить индекс и построить заново")
+    asyncio.run(_main(p.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
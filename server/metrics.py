@@ -0,0 +1,240 @@
+from __future__ import annotations
+import os
+import json
+import time
+import random
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Optional, Tuple
+
+# Встроенные метрики в формате Prometheus (text exposition 0.0.4) без внешних зависимостей
+# и выборочные span-логи запросов: фазы chat() с длительностями, всегда — для медленных.
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))  # доля запросов со span-логом
+TRACE_SLOW_MS = int(os.getenv("TRACE_SLOW_MS", "5000"))  # медленные логируются всегда; 0 — выключено
+# модели, у которых в метриках провайдеров своя метка; остальные — "other". Модель приходит от клиента:
+# без белого списка число серий в /metrics ничем не ограничено
+METRICS_MODELS = frozenset(m.strip() for m in os.getenv("METRICS_MODELS", "").split(",") if m.strip())
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+log = logging.getLogger("trace")
+
+LabelKey = Tuple[str, ...]
+
+
+def _fmt_labels(names: Tuple[str, ...], values: LabelKey, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(v: str) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _fmt_value(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if not float(v).is_integer() else str(int(v))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, doc: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelKey:
+        return tuple(str(labels.get(n, "")) for n in self.labels)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw)
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def render(self) -> list[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_fmt_labels(self.labels, k)} {_fmt_value(v)}" for k, v in items]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, *a, fn: Optional[Callable[[], float]] = None, **kw):
+        super().__init__(*a, **kw)
+        self._values: Dict[LabelKey, float] = {}
+        self._fn = fn  # значение снимается в момент скрейпа
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def dec(self, value: float = 1, **labels):
+        self.inc(-value, **labels)
+
+    def render(self) -> list[str]:
+        if self._fn is not None:
+            try:
+                return [f"{self.name} {_fmt_value(self._fn())}"]
+            except Exception:
+                return []
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_fmt_labels(self.labels, k)} {_fmt_value(v)}" for k, v in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, *a, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, **kw):
+        super().__init__(*a, **kw)
+        self.buckets = tuple(sorted(buckets))
+        # key -> [counts по корзинам..., sum, count]
+        self._values: Dict[LabelKey, list[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            if i < len(self.buckets):
+                row[i] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    def render(self) -> list[str]:
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._values.items()]
+        out = []
+        for key, row in items:
+            acc = 0
+            for bound, n in zip(self.buckets, row):
+                acc += n
+                le = 'le="%s"' % _fmt_value(bound)
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labels, key, le)} {acc}")
+            inf = 'le="+Inf"'
+            out.append(f"{self.name}_bucket{_fmt_labels(self.labels, key, inf)} {int(row[-1])}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labels, key)} {row[-2]}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labels, key)} {int(row[-1])}")
+        return out
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, doc: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, doc, labels))
+
+    def gauge(self, name: str, doc: str, labels: Tuple[str, ...] = (), fn: Optional[Callable[[], float]] = None) -> Gauge:
+        return self.register(Gauge(name, doc, labels, fn=fn))
+
+    def histogram(self, name: str, doc: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, doc, labels, buckets=buckets))
+
+    def render(self) -> str:
+        lines = []
+        for m in self._metrics:
+            lines += m.header() + m.render()
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.histogram("http_request_duration_seconds", "HTTP request latency", ("method", "route", "status"))
+http_in_flight = registry.gauge("http_requests_in_flight", "HTTP requests being served")
+chat_phase = registry.histogram("chat_phase_duration_seconds", "Time spent in each chat() phase", ("phase",))
+provider_latency = registry.histogram(
+    "provider_request_duration_seconds", "LLM provider call latency", ("provider", "model", "outcome")
+)
+provider_ttfb = registry.histogram("provider_stream_first_delta_seconds", "Time to first streamed delta", ("provider", "model"))
+provider_errors = registry.counter("provider_errors_total", "LLM provider errors", ("provider", "kind"))
+blocked_responses = registry.counter("provider_blocked_total", "Responses blocked by provider safety filters", ("provider",))
+prefix_cache = registry.counter(
+    "provider_prefix_cache_total", "Provider-side prompt prefix cache: hit | create | inline | stale", ("provider", "result")
+)
+
+
+# === Spans ===
+class Span:
+    def __init__(self, name: str, sampled: bool):
+        self.name = name
+        self.sampled = sampled
+        self.started = time.perf_counter()
+        self.phases: list[tuple[str, float]] = []
+        self.attrs: Dict[str, object] = {}
+
+    def finish(self, **attrs):
+        total_ms = (time.perf_counter() - self.started) * 1000
+        slow = TRACE_SLOW_MS > 0 and total_ms >= TRACE_SLOW_MS
+        if not (self.sampled or slow):
+            return
+        record = {
+            "span": self.name,
+            "ms": round(total_ms, 1),
+            "slow": slow,
+            "phases": {name: round(sec * 1000, 1) for name, sec in self.phases},
+            **self.attrs,
+            **attrs,
+        }
+        (log.warning if slow else log.info)(json.dumps(record, ensure_ascii=False))
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+def start_span(name: str) -> Span:
+    span = Span(name, sampled=TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE)
+    _current_span.set(span)
+    return span
+
+
+def model_label(model: str) -> str:
+    return model if model in METRICS_MODELS else "other"
+
+
+def observe_phase(name: str, seconds: float):
+    chat_phase.observe(seconds, phase=name)
+    span = _current_span.get()
+    if span is not None:
+        span.phases.append((name, seconds))
+
+
+@contextmanager
+def phase(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_phase(name, time.perf_counter() - started)
@@ -0,0 +1,172 @@
+from __future__ import annotations
+import os
+import json
+import random
+import asyncio
+import argparse
+from typing import Optional
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel
+
+# Локальный mock LLM-провайдеров для бенчмарков и нагрузочных тестов без реальных счетов.
+# Понимает протоколы Gemini (generateContent / streamGenerateContent?alt=sse), OpenAI-chat
+# (Groq, OpenRouter; stream=true) и Ollama (/api/chat, NDJSON).
+#
+#   python mock_llm.py --port 8088
+#   GEMINI_URL=http://127.0.0.1:8088 GROQ_URL=http://127.0.0.1:8088/openai/v1 \
+#   OPENROUTER_URL=http://127.0.0.1:8088/api/v1 OLLAMA_URL=http://127.0.0.1:8088 uvicorn server:app
+#
+# Задержки и ошибки меняются на лету: PATCH /__mock/config {"latency_ms": 800, "error_rate": 0.1}
+
+class MockConfig(BaseModel):
+    latency_ms: int = int(os.getenv("MOCK_LATENCY_MS", "200"))  # до первого байта
+    jitter_ms: int = int(os.getenv("MOCK_JITTER_MS", "50"))
+    tokens_per_s: float = float(os.getenv("MOCK_TOKENS_PER_S", "200"))  # темп стриминга
+    error_rate: float = float(os.getenv("MOCK_ERROR_RATE", "0"))
+    error_status: int = int(os.getenv("MOCK_ERROR_STATUS", "503"))
+    reply: str = os.getenv("MOCK_REPLY", "ну да, понимаю тебя. а ты сам как думаешь?")
+
+
+class MockConfigPatch(BaseModel):
+    latency_ms: Optional[int] = None
+    jitter_ms: Optional[int] = None
+    tokens_per_s: Optional[float] = None
+    error_rate: Optional[float] = None
+    error_status: Optional[int] = None
+    reply: Optional[str] = None
+
+
+app = FastAPI(title="Mock LLM providers")
+cfg = MockConfig()
+stats = {"requests": 0, "errors": 0}
+
+
+async def _first_byte_delay():
+    stats["requests"] += 1
+    delay = cfg.latency_ms + random.uniform(-cfg.jitter_ms, cfg.jitter_ms)
+    await asyncio.sleep(max(0.0, delay) / 1000.0)
+
+
+def _injected_error() -> Optional[JSONResponse]:
+    if cfg.error_rate > 0 and random.random() < cfg.error_rate:
+        stats["errors"] += 1
+        return JSONResponse({"error": {"message": "mock: injected error"}}, status_code=cfg.error_status)
+    return None
+
+
+def _chunks() -> list[str]:
+    # «токены» — слова с пробелом, как у настоящих стримов
+    words = cfg.reply.split(" ")
+    return [w + (" " if i < len(words) - 1 else "") for i, w in enumerate(words)]
+
+
+async def _paced(chunks: list[str]):
+    pause = 1.0 / cfg.tokens_per_s if cfg.tokens_per_s > 0 else 0
+    for c in chunks:
+        if pause:
+            await asyncio.sleep(pause)
+        yield c
+
+
+@app.get("/__mock/config", response_model=MockConfig)
+def get_config():
+    return cfg
+
+
+@app.patch("/__mock/config", response_model=MockConfig)
+def patch_config(patch: MockConfigPatch):
+    global cfg
+    cfg = cfg.model_copy(update=patch.model_dump(exclude_none=True))
+    return cfg
+
+
+@app.get("/__mock/stats")
+def get_stats():
+    return stats
+
+
+@app.head("/")
+@app.get("/")
+def root():
+    return {"ok": True}
+
+
+# === Gemini ===
+@app.post("/v1beta/models/{model_action}")
+async def gemini(model_action: str, request: Request):
+    _, _, action = model_action.partition(":")
+    await _first_byte_delay()
+    err = _injected_error()
+    if err:
+        return err
+    if action == "streamGenerateContent":
+        async def sse():
+            async for c in _paced(_chunks()):
+                chunk = {"candidates": [{"content": {"role": "model", "parts": [{"text": c}]}}]}
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\r\n\r\n"
+        return StreamingResponse(sse(), media_type="text/event-stream")
+    return {
+        "candidates": [{"content": {"role": "model", "parts": [{"text": cfg.reply}]}, "finishReason": "STOP"}],
+    }
+
+
+# === OpenAI-chat (Groq, OpenRouter) ===
+@app.post("/chat/completions")
+@app.post("/{prefix:path}/chat/completions")
+async def openai_chat(request: Request, prefix: str = ""):
+    body = await request.json()
+    await _first_byte_delay()
+    err = _injected_error()
+    if err:
+        return err
+    model = body.get("model", "mock")
+    if body.get("stream"):
+        async def sse():
+            async for c in _paced(_chunks()):
+                chunk = {"model": model, "choices": [{"index": 0, "delta": {"content": c}}]}
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+            yield "data: [DONE]\n\n"
+        return StreamingResponse(sse(), media_type="text/event-stream")
+    return {
+        "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": cfg.reply}, "finish_reason": "stop"}],
+    }
+
+
+# === Ollama ===
+@app.post("/api/chat")
+async def ollama_chat(request: Request):
+    body = await request.json()
+    await _first_byte_delay()
+    err = _injected_error()
+    if err:
+        return err
+    model = body.get("model", "mock")
+    if body.get("stream", True):
+        async def ndjson():
+            async for c in _paced(_chunks()):
+                yield json.dumps({"model": model, "message": {"role": "assistant", "content": c}, "done": False}, ensure_ascii=False) + "\n"
+            yield json.dumps({"model": model, "message": {"role": "assistant", "content": ""}, "done": True}) + "\n"
+        return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+    return {"model": model, "message": {"role": "assistant", "content": cfg.reply}, "done": True}
+
+
+@app.post("/api/generate")
+async def ollama_generate(request: Request):
+    body = await request.json()
+    return {"model": body.get("model", "mock"), "response": "", "done": True}
+
+
+def main():
+    import uvicorn
+
+    p = argparse.ArgumentParser(description="Mock LLM providers (Gemini / OpenAI-chat / Ollama)")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8088)
+    args = p.parse_args()
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
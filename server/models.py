@@ -1,7 +1,7 @@
 from __future__ import annotations
 from datetime import datetime
 from typing import Optional
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, String, Text
+from sqlalchemy import Column, DateTime, ForeignKey, Index, Integer, String, Text, text
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
 class Base(DeclarativeBase):
@@ -19,12 +19,28 @@ class Persona(Base):
 
 class Thread(Base):
     __tablename__ = "threads"
+    # листинг «последние треды» — keyset по (updated_at, id) без сортировки всей таблицы
+    __table_args__ = (
+        Index("ix_threads_updated", "updated_at", "id"),
+        Index("ix_threads_created", "created_at", "id"),
+    )
     id: Mapped[str] = mapped_column(String, primary_key=True)  # ваш threadId из фронта
     persona_id: Mapped[str] = mapped_column(ForeignKey("personas.id"), nullable=False)
     model: Mapped[str] = mapped_column(String, nullable=False, default="")  # ← НОВОЕ
     summary: Mapped[str] = mapped_column(Text, default="")
+    summary_upto: Mapped[int] = mapped_column(Integer, nullable=False, default=0)  # id последнего сообщения, свёрнутого в summary
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
-    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)  # время последнего сообщения (триггеры)
+    # денормализация для листинга, поддерживается триггерами на messages (см. init_db.py)
+    message_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")
+    last_message_preview: Mapped[str] = mapped_column(Text, nullable=False, default="", server_default="")
+    # самый старый префикс истории вынесен в архив (archive.py): сколько сообщений и по какой ключ (created_at, id)
+    archived_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")
+    archived_until: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    archived_until_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    # валидатор для ETag/Last-Modified: растёт (триггеры, init_db.py) при любом изменении треда или его сообщений
+    version: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")
+    modified_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True, default=datetime.utcnow)
 
     persona: Mapped[Persona] = relationship(back_populates="threads")
     messages: Mapped[list[Message]] = relationship(back_populates="thread", order_by="Message.created_at")
@@ -32,15 +48,65 @@ class Thread(Base):
 
 class Message(Base):
     __tablename__ = "messages"
+    # история треда читается одним упорядоченным проходом по индексу; отдельный индекс на thread_id не нужен
+    __table_args__ = (
+        Index("ix_messages_thread_created", "thread_id", "created_at", "id"),
+        # ближайший невыпущенный ответ треда (deliver_at) — часть ETag истории
+        Index("ix_messages_pending", "thread_id", "deliver_at", sqlite_where=text("deliver_at IS NOT NULL")),
+    )
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
-    thread_id: Mapped[str] = mapped_column(ForeignKey("threads.id"), index=True)
+    thread_id: Mapped[str] = mapped_column(ForeignKey("threads.id"))
     role: Mapped[str] = mapped_column(String)  # 'user' | 'assistant' | 'system'
     content: Mapped[str] = mapped_column(Text)
+    tokens: Mapped[int] = mapped_column(Integer, nullable=False, default=0)  # оценка токенов, считается при вставке
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+    # автор реплики ассистента в общем треде (fan-out на несколько персон); None — персона треда
+    persona_id: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    # ответ с имитацией печати: до этого момента сообщение не показывается, в срок его выпускает push.py
+    deliver_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
 
     thread: Mapped[Thread] = relationship(back_populates="messages")
 
+class ArchivedMessage(Base):
+    __tablename__ = "archived_messages"
+    # где лежит сообщение, вынесенное в архив (archive.py): его строка в messages_fts остаётся,
+    # и поиск по этой таблице находит тред, а текст для сниппета — в архиве треда
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=False)  # id бывшей строки messages
+    thread_id: Mapped[str] = mapped_column(String, index=True)
+    role: Mapped[str] = mapped_column(String)
+    created_at: Mapped[datetime] = mapped_column(DateTime)
+
 class Setting(Base):
     __tablename__ = "settings"
     key: Mapped[str] = mapped_column(String, primary_key=True)
-    value: Mapped[Optional[str]] = mapped_column(Text, default="")
\ No newline at end of file
+    value: Mapped[Optional[str]] = mapped_column(Text, default="")
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+    key: Mapped[str] = mapped_column(String, primary_key=True)  # "<threadId>:<idempotencyKey>"
+    response: Mapped[str] = mapped_column(Text, nullable=False)  # JSON ChatOut
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+
+class Job(Base):
+    __tablename__ = "jobs"
+    # очередь фоновых ходов (jobs.py): захват — UPDATE ... RETURNING по (status, available_at)
+    __table_args__ = (
+        Index("ix_jobs_claim", "status", "available_at"),
+        Index("ix_jobs_thread", "thread_id", "status"),
+    )
+    id: Mapped[str] = mapped_column(String, primary_key=True)
+    kind: Mapped[str] = mapped_column(String, nullable=False, default="chat")
+    thread_id: Mapped[str] = mapped_column(String, nullable=False)
+    key: Mapped[Optional[str]] = mapped_column(String, unique=True, nullable=True)  # "<threadId>:<idempotencyKey>"
+    message_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)  # сообщение пользователя, на которое ход отвечает
+    payload: Mapped[str] = mapped_column(Text, nullable=False)  # JSON ChatIn
+    status: Mapped[str] = mapped_column(String, nullable=False, default="queued")  # queued | running | done | failed
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    available_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)  # раньше не захватывать (backoff)
+    lease_owner: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    lease_until: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)  # после — задачу заберёт другой воркер
+    result: Mapped[Optional[str]] = mapped_column(Text, nullable=True)  # JSON ChatOut
+    error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    updated_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
@@ -0,0 +1,141 @@
+from __future__ import annotations
+import os
+import time
+import hashlib
+import threading
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, Dict, Optional
+from sqlalchemy import Integer, String, cast, select, update
+
+from models import Persona, Setting
+
+# Кэш персон, настроек и собранных системных промптов в памяти процесса.
+# Персоны и global_prompt меняются редко, а читаются на каждом сообщении.
+# Межпроцессная согласованность: счётчик версии в settings[VERSION_KEY], который
+# увеличивает каждая запись; воркеры сверяют его не чаще раза в CACHE_VERSION_CHECK_S.
+
+CACHE_VERSION_CHECK_S = float(os.getenv("CACHE_VERSION_CHECK_S", "2"))
+VERSION_KEY = "cache_version"
+
+
+def prefix_key(persona_id: str, prompt: str) -> str:
+    # ключ стабильного префикса для кэша на стороне провайдера: меняется вместе с текстом персоны
+    # или global_prompt, поэтому устаревший кэш никогда не используется, даже в соседнем процессе
+    return f"persona:{persona_id}:{hashlib.sha256(prompt.encode()).hexdigest()[:16]}"
+
+
+@dataclass(frozen=True)
+class PersonaSnapshot:
+    id: str
+    name: str
+    bio: str
+    style: str
+    boundaries: str
+    goals: str
+
+
+class _Snapshot:
+    # всё содержимое кэша заменяется одним присваиванием, чтобы потоки run_db не видели смесь версий
+    __slots__ = ("version", "personas", "settings", "prompts", "loaded_at")
+
+    def __init__(self, version: str, personas: Dict[str, PersonaSnapshot], settings: Dict[str, str]):
+        self.version = version
+        self.personas = personas
+        self.settings = settings
+        self.prompts: Dict[str, str] = {}
+        self.loaded_at = datetime.utcnow()  # не раньше изменения, давшего эту версию — годится в Last-Modified
+
+
+class PromptCache:
+    def __init__(self, render: Callable[[PersonaSnapshot, str], str]):
+        self._render = render
+        self._lock = threading.Lock()
+        self._snap: Optional[_Snapshot] = None
+        self._checked_at = 0.0
+        self._listeners: list[Callable[[], None]] = []
+
+    @property
+    def version(self) -> Optional[str]:
+        snap = self._snap
+        return snap.version if snap else None
+
+    @staticmethod
+    def _db_version(s) -> str:
+        st = s.get(Setting, VERSION_KEY)
+        return st.value if st and st.value else "0"
+
+    @staticmethod
+    def _load(s, version: str) -> _Snapshot:
+        personas = {
+            p.id: PersonaSnapshot(p.id, p.name, p.bio or "", p.style or "", p.boundaries or "", p.goals or "")
+            for p in s.execute(select(Persona)).scalars()
+        }
+        settings = {
+            st.key: st.value or ""
+            for st in s.execute(select(Setting)).scalars()
+            if st.key != VERSION_KEY
+        }
+        return _Snapshot(version, personas, settings)
+
+    def _fresh(self, s) -> _Snapshot:
+        now = time.monotonic()
+        snap = self._snap
+        if snap is not None and now - self._checked_at < CACHE_VERSION_CHECK_S:
+            return snap
+        with self._lock:
+            snap = self._snap
+            if snap is not None and now - self._checked_at < CACHE_VERSION_CHECK_S:
+                return snap
+            version = self._db_version(s)
+            if snap is None or version != snap.version:
+                snap = self._snap = self._load(s, version)
+            self._checked_at = now
+            return snap
+
+    def validator(self, s) -> tuple[str, datetime]:
+        # (версия, время загрузки) снимка персон и настроек — для ETag/Last-Modified без чтения данных
+        snap = self._fresh(s)
+        return snap.version, snap.loaded_at
+
+    def personas(self, s) -> list[PersonaSnapshot]:
+        return list(self._fresh(s).personas.values())
+
+    def persona(self, s, pid: str) -> Optional[PersonaSnapshot]:
+        return self._fresh(s).personas.get(pid)
+
+    def setting(self, s, key: str, default: str = "") -> str:
+        return self._fresh(s).settings.get(key, default)
+
+    def system_prompt(self, s, pid: str) -> Optional[str]:
+        snap = self._fresh(s)
+        prompt = snap.prompts.get(pid)
+        if prompt is None:
+            persona = snap.personas.get(pid)
+            if persona is None:
+                return None
+            prompt = self._render(persona, snap.settings.get("global_prompt", ""))
+            snap.prompts[pid] = prompt
+        return prompt
+
+    @staticmethod
+    def bump(s):
+        # вызывается в той же транзакции, что и изменение персоны/настроек; инкремент атомарный на стороне SQLite
+        res = s.execute(
+            update(Setting)
+            .where(Setting.key == VERSION_KEY)
+            .values(value=cast(cast(Setting.value, Integer) + 1, String))
+        )
+        if res.rowcount == 0:
+            s.add(Setting(key=VERSION_KEY, value="1"))
+
+    def on_invalidate(self, fn: Callable[[], None]):
+        self._listeners.append(fn)
+
+    def invalidate(self):
+        # после коммита: следующий доступ перечитает версию и данные
+        with self._lock:
+            self._snap = None
+            self._checked_at = 0.0
+        for fn in self._listeners:
+            fn()
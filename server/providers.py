@@ -0,0 +1,577 @@
+from __future__ import annotations
+import os
+import re
+import json
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional
+import httpx
+
+from http_pool import pool
+from router import ProviderError
+from context import estimate_tokens
+from metrics import prefix_cache
+
+# Реестр LLM-провайдеров с общим интерфейсом: complete() / stream() по спецификации "provider:model".
+# Общие части — нормализация ролей, разбор ошибок HTTP и сети в ProviderError, чистка <think>.
+# Первое системное сообщение контекста (персона + global_prompt) может нести cache_key — это стабильный
+# префикс: OpenAI-совместимые провайдеры кэшируют его сами по совпадению байт, для Gemini префикс
+# выносится в cachedContents и переиспользуется, пока жив.
+
+# базовые URL провайдеров настраиваются — например, на локальный mock_llm.py для бенчмарков
+GEMINI_URL = os.getenv("GEMINI_URL", "https://generativelanguage.googleapis.com")
+GROQ_URL = os.getenv("GROQ_URL", "https://api.groq.com/openai/v1")
+OPENROUTER_URL = os.getenv("OPENROUTER_URL", "https://openrouter.ai/api/v1")
+OLLAMA_URL = os.getenv("OLLAMA_URL", "http://127.0.0.1:11434")
+
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")  # сколько Ollama держит модель в памяти; "" — по умолчанию сервера
+OLLAMA_PRELOAD_MODELS = [m.strip() for m in os.getenv("OLLAMA_PRELOAD_MODELS", "").split(",") if m.strip()]
+OLLAMA_KEEP_WARM_S = float(os.getenv("OLLAMA_KEEP_WARM_S", "0"))  # период пинга простаивающих моделей; 0 — выключено
+
+GEMINI_CACHE_ENABLED = os.getenv("GEMINI_CACHE_ENABLED", "1") == "1"
+GEMINI_CACHE_TTL_S = int(os.getenv("GEMINI_CACHE_TTL_S", "3600"))
+GEMINI_CACHE_REFRESH_S = int(os.getenv("GEMINI_CACHE_REFRESH_S", "120"))  # за столько до истечения создаётся новый
+# меньше минимума API кэш не создаёт (1024 токена у flash, 4096 у pro) — такие промпты сразу идут inline
+GEMINI_CACHE_MIN_TOKENS = int(os.getenv("GEMINI_CACHE_MIN_TOKENS", "1024"))
+GEMINI_CACHE_RETRY_S = float(os.getenv("GEMINI_CACHE_RETRY_S", "600"))  # после отказа создать кэш — inline столько
+
+log = logging.getLogger(__name__)
+
+
+def clamp_temperature(temperature: float) -> float:
+    return max(0.0, min(2.0, float(temperature)))
+
+
+def to_openai_style(messages: list[dict[str, str]]) -> list[dict[str, str]]:
+    out = []
+    for m in messages:
+        role = (m.get("role") or "user").lower()
+        # допустим только system/user/assistant
+        if role not in ("system", "user", "assistant"):
+            role = "user"
+        out.append({"role": role, "content": m.get("content", "")})
+    return out
+
+
+def clean_model_output(text: str) -> str:
+    # убираем блоки <think>…</think>
+    cleaned = re.sub(r"<think>.*?</think>", "", text, flags=re.DOTALL)
+    return cleaned.strip()
+
+
+def split_provider(spec: str) -> tuple[str, str]:
+    vendor, sep, model = spec.partition(":")
+    if not sep or not model.strip():
+        raise ProviderError(vendor.strip() or "router", f"ожидается provider:model, получено {spec!r}", "config")
+    return vendor.strip(), model.strip()
+
+
+def _detail(r: httpx.Response):
+    try:
+        return r.json()
+    except ValueError:
+        return r.text
+
+
+async def sse_data_lines(r: httpx.Response) -> AsyncIterator[str]:
+    async for line in r.aiter_lines():
+        if line.startswith("data:"):
+            yield line[5:].strip()
+
+
+class Provider:
+    name = ""
+    key_env = ""  # переменная с API-ключом; пусто — ключ не нужен
+    timeout = 60.0
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+
+    @property
+    def key(self) -> str:
+        return os.getenv(self.key_env, "") if self.key_env else ""
+
+    @property
+    def prewarm(self) -> bool:
+        # TLS-прогрев при старте — только тем, кем реально можно пользоваться
+        return bool(self.key)
+
+    def check(self):
+        if self.key_env and not self.key:
+            raise ProviderError(self.name, f"не задан {self.key_env}", "config")
+
+    def network_error(self, e: httpx.HTTPError) -> ProviderError:
+        return ProviderError(self.name, f"ошибка сети: {e}", "network", retryable=True)
+
+    async def post_json(self, url: str, **kwargs) -> dict:
+        try:
+            r = await pool.client(self.name).post(url, **kwargs)
+        except httpx.HTTPError as e:
+            raise self.network_error(e)
+        if r.is_error:
+            raise ProviderError.from_status(self.name, r.status_code, _detail(r))
+        try:
+            return r.json()
+        except ValueError:
+            raise ProviderError(self.name, f"неожиданный ответ {r.text[:300]}", "empty")
+
+    @asynccontextmanager
+    async def open_stream(self, url: str, **kwargs) -> AsyncIterator[httpx.Response]:
+        # обрыв сети посреди потока тоже становится ProviderError
+        try:
+            async with pool.client(self.name).stream("POST", url, **kwargs) as r:
+                if r.is_error:
+                    await r.aread()
+                    raise ProviderError.from_status(self.name, r.status_code, _detail(r))
+                yield r
+        except httpx.HTTPError as e:
+            raise self.network_error(e)
+
+    async def complete(self, model: str, messages: list[dict[str, str]], temperature: float) -> str:
+        raise NotImplementedError
+
+    def stream(self, model: str, messages: list[dict[str, str]], temperature: float) -> AsyncIterator[str]:
+        raise NotImplementedError
+
+    def invalidate_cache(self):
+        pass
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+
+def split_prefix(messages: list[dict[str, str]]) -> tuple[Optional[str], list[dict[str, str]], list[dict[str, str]]]:
+    # (cache_key, префикс, остаток); без ключа префикса нет
+    if messages and messages[0].get("role") == "system" and messages[0].get("cache_key"):
+        return messages[0]["cache_key"], messages[:1], messages[1:]
+    return None, [], messages
+
+
+class GeminiPrefixCache:
+    # cachedContents по (cache_key, model); срок жизни считается локально, без запросов к API
+    def __init__(self, provider: "GeminiProvider", ttl_s: int = GEMINI_CACHE_TTL_S):
+        self.provider = provider
+        self.ttl_s = ttl_s
+        self._entries: Dict[tuple[str, str], tuple[str, float]] = {}  # -> (name, monotonic истечения)
+        self._failed: Dict[tuple[str, str], float] = {}  # -> monotonic, до которого не пытаемся
+        self._locks: Dict[tuple[str, str], asyncio.Lock] = {}
+
+    def _valid(self, key: tuple[str, str]) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry and entry[1] - time.monotonic() > GEMINI_CACHE_REFRESH_S:
+            return entry[0]
+        return None
+
+    async def get(self, cache_key: str, model: str, prefix: list[dict[str, str]]) -> Optional[str]:
+        # имя cachedContents или None — тогда промпт уходит inline
+        key = (cache_key, model)
+        name = self._valid(key)
+        if name:
+            prefix_cache.inc(provider="gemini", result="hit")
+            return name
+        if self._failed.get(key, 0) > time.monotonic():
+            prefix_cache.inc(provider="gemini", result="inline")
+            return None
+        if sum(estimate_tokens(m["content"]) for m in prefix) < GEMINI_CACHE_MIN_TOKENS:
+            self._failed[key] = float("inf")  # текст префикса под ключом не меняется
+            prefix_cache.inc(provider="gemini", result="inline")
+            return None
+        # один create на ключ, остальные ходы ждут его результата
+        async with self._locks.setdefault(key, asyncio.Lock()):
+            name = self._valid(key)
+            if name:
+                prefix_cache.inc(provider="gemini", result="hit")
+                return name
+            try:
+                name = await self._create(cache_key, model, prefix)
+            except ProviderError as e:
+                log.warning("gemini: кэш префикса %s для %s не создан, inline: %s", cache_key, model, e)
+                self._failed[key] = time.monotonic() + GEMINI_CACHE_RETRY_S
+                prefix_cache.inc(provider="gemini", result="inline")
+                return None
+            self._entries[key] = (name, time.monotonic() + self.ttl_s)
+            self._failed.pop(key, None)
+            prefix_cache.inc(provider="gemini", result="create")
+            return name
+
+    async def _create(self, cache_key: str, model: str, prefix: list[dict[str, str]]) -> str:
+        data = await self.provider.post_json(
+            "/v1beta/cachedContents",
+            params={"key": self.provider.key},
+            json={
+                "model": f"models/{model}",
+                "displayName": cache_key[:128],
+                "systemInstruction": {"role": "user", "parts": [{"text": m["content"]} for m in prefix]},
+                "ttl": f"{self.ttl_s}s",
+            },
+        )
+        name = data.get("name")
+        if not name:
+            raise ProviderError("gemini", f"нет имени кэша в ответе {str(data)[:300]}", "empty")
+        return name
+
+    def forget(self, name: str):
+        # кэш пропал на стороне API раньше срока (удалён, истёк по другим часам)
+        prefix_cache.inc(provider="gemini", result="stale")
+        for key, entry in list(self._entries.items()):
+            if entry[0] == name:
+                del self._entries[key]
+
+    def invalidate(self) -> list[str]:
+        # персоны или global_prompt изменились: новые ключи создадут свои кэши, старые удаляем
+        names = [name for name, _ in self._entries.values()]
+        self._entries.clear()
+        self._failed.clear()
+        return names
+
+
+class GeminiProvider(Provider):
+    name = "gemini"
+    key_env = "GEMINI_API_KEY"
+
+    def __init__(self, base_url: str, cache: bool = GEMINI_CACHE_ENABLED):
+        super().__init__(base_url)
+        self.prefix_cache = GeminiPrefixCache(self) if cache else None
+        self._tasks: set[asyncio.Task] = set()
+
+    @staticmethod
+    def request(messages: list[dict[str, str]], temperature: float, cached: Optional[str] = None) -> dict:
+        system_parts = [{"text": m["content"]} for m in messages if m.get("role") == "system"]
+        ua_messages = [
+            {
+                "role": "user" if m["role"] == "user" else "model",  # assistant -> model
+                "parts": [{"text": m["content"]}],
+            }
+            for m in to_openai_style(messages)
+            if m["role"] in ("user", "assistant")
+        ]
+        payload = {
+            "contents": ua_messages,
+            "generationConfig": {"temperature": clamp_temperature(temperature)},
+        }
+        if cached:
+            # с cachedContent systemInstruction в запросе запрещён: остальные системные части (summary)
+            # идут в начало первой реплики пользователя
+            payload["cachedContent"] = cached
+            if system_parts:
+                if ua_messages and ua_messages[0]["role"] == "user":
+                    ua_messages[0]["parts"] = system_parts + ua_messages[0]["parts"]
+                else:
+                    ua_messages.insert(0, {"role": "user", "parts": system_parts})
+        elif system_parts:
+            payload["systemInstruction"] = {"role": "user", "parts": system_parts}
+        return payload
+
+    async def _request(self, model, messages, temperature) -> tuple[dict, Optional[str]]:
+        cache_key, prefix, rest = split_prefix(messages)
+        cached = None
+        if cache_key and self.prefix_cache is not None:
+            cached = await self.prefix_cache.get(cache_key, model, prefix)
+        if cached:
+            return self.request(rest, temperature, cached), cached
+        return self.request(messages, temperature), None
+
+    def _stale(self, cached: Optional[str], e: ProviderError) -> bool:
+        # 403/404 на запросе с cachedContent — кэша больше нет; повторяем один раз inline
+        if cached and e.status in (403, 404):
+            self.prefix_cache.forget(cached)
+            return True
+        return False
+
+    @staticmethod
+    def _blocked(data: dict) -> Optional[ProviderError]:
+        block = (data.get("promptFeedback") or {}).get("blockReason")
+        return ProviderError("gemini", f"запрос заблокирован: {block}", "blocked") if block else None
+
+    @staticmethod
+    def _text(candidate: dict) -> str:
+        parts = (candidate.get("content") or {}).get("parts") or []
+        return "".join(p.get("text", "") for p in parts if isinstance(p, dict))
+
+    async def _generate(self, model: str, payload: dict) -> dict:
+        return await self.post_json(f"/v1beta/models/{model}:generateContent", params={"key": self.key}, json=payload)
+
+    async def complete(self, model, messages, temperature):
+        payload, cached = await self._request(model, messages, temperature)
+        try:
+            data = await self._generate(model, payload)
+        except ProviderError as e:
+            if not self._stale(cached, e):
+                raise
+            data = await self._generate(model, self.request(messages, temperature))
+        err = self._blocked(data)
+        if err:
+            raise err
+        candidates = data.get("candidates") or []
+        for c in candidates:
+            out = self._text(c)
+            if out.strip():
+                return out.strip()
+        finish = candidates[0].get("finishReason") if candidates else None
+        raise ProviderError("gemini", f"нет текста в ответе; finishReason={finish}", "empty")
+
+    async def stream(self, model, messages, temperature):
+        payload, cached = await self._request(model, messages, temperature)
+        try:
+            async for delta in self._stream(model, payload):
+                cached = None  # после первой дельты повторять уже нельзя
+                yield delta
+        except ProviderError as e:
+            if not self._stale(cached, e):
+                raise
+            async for delta in self._stream(model, self.request(messages, temperature)):
+                yield delta
+
+    async def _stream(self, model: str, payload: dict) -> AsyncIterator[str]:
+        async with self.open_stream(
+            f"/v1beta/models/{model}:streamGenerateContent",
+            params={"key": self.key, "alt": "sse"}, json=payload,
+        ) as r:
+            async for data in sse_data_lines(r):
+                try:
+                    chunk = json.loads(data)
+                except ValueError:
+                    continue
+                err = self._blocked(chunk)
+                if err:
+                    raise err
+                for c in chunk.get("candidates") or []:
+                    text = self._text(c)
+                    if text:
+                        yield text
+
+    async def _delete_caches(self, names: list[str]):
+        for name in names:
+            try:
+                r = await pool.client(self.name).delete(f"/v1beta/{name}", params={"key": self.key})
+                if r.is_error and r.status_code != 404:
+                    log.warning("gemini: не удалось удалить %s: HTTP %s", name, r.status_code)
+            except httpx.HTTPError as e:
+                log.warning("gemini: не удалось удалить %s: %s", name, e)
+
+    def invalidate_cache(self):
+        # вызывается после изменения персон/global_prompt; удалённые кэши иначе дожили бы до TTL
+        if self.prefix_cache is None:
+            return
+        names = self.prefix_cache.invalidate()
+        if not names:
+            return
+        task = asyncio.get_running_loop().create_task(self._delete_caches(names))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def stop(self):
+        # недоудалённое истечёт по TTL само
+        for t in list(self._tasks):
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+class OpenAIStyleProvider(Provider):
+    # Groq, OpenRouter и любой другой OpenAI-совместимый /chat/completions
+    def __init__(self, name: str, base_url: str, key_env: str, headers: Optional[Dict[str, str]] = None):
+        super().__init__(base_url)
+        self.name = name
+        self.key_env = key_env
+        self.headers = headers or {}
+
+    def _headers(self) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {self.key}", **self.headers}
+
+    def _payload(self, model, messages, temperature, stream: bool) -> dict:
+        payload = {
+            "model": model,
+            "messages": to_openai_style(messages),
+            "temperature": clamp_temperature(temperature),
+        }
+        if stream:
+            payload["stream"] = True
+        return payload
+
+    async def complete(self, model, messages, temperature):
+        data = await self.post_json(
+            "/chat/completions", headers=self._headers(), json=self._payload(model, messages, temperature, False)
+        )
+        try:
+            return (data["choices"][0]["message"]["content"] or "").strip()
+        except (KeyError, IndexError, TypeError):
+            raise ProviderError(self.name, f"неожиданный ответ {str(data)[:300]}", "empty")
+
+    async def stream(self, model, messages, temperature):
+        async with self.open_stream(
+            "/chat/completions", headers=self._headers(), json=self._payload(model, messages, temperature, True)
+        ) as r:
+            async for data in sse_data_lines(r):
+                if data == "[DONE]":
+                    break
+                try:
+                    chunk = json.loads(data)
+                    delta = (chunk["choices"][0].get("delta") or {}).get("content") or ""
+                except (ValueError, KeyError, IndexError):
+                    continue
+                if delta:
+                    yield delta
+
+
+class OllamaProvider(Provider):
+    name = "ollama"
+    timeout = 120.0  # локальная модель на CPU может думать долго
+
+    def __init__(
+        self,
+        base_url: str,
+        keep_alive: str = OLLAMA_KEEP_ALIVE,
+        preload: Optional[list[str]] = None,
+        keep_warm_s: float = OLLAMA_KEEP_WARM_S,
+    ):
+        super().__init__(base_url)
+        self.keep_alive = keep_alive
+        self.preload = list(OLLAMA_PRELOAD_MODELS if preload is None else preload)
+        self.keep_warm_s = keep_warm_s
+        self.last_used: Dict[str, float] = {}  # model -> monotonic последнего запроса
+        self._tasks: list[asyncio.Task] = []
+
+    @property
+    def prewarm(self) -> bool:
+        return False  # локальный сервер может быть не запущен; модели греем отдельно
+
+    def _payload(self, model, messages, temperature, stream: bool) -> dict:
+        self.last_used[model] = time.monotonic()
+        payload = {
+            "model": model,
+            "messages": to_openai_style(messages),
+            "stream": stream,
+            "options": {"temperature": clamp_temperature(temperature)},
+        }
+        if self.keep_alive:
+            payload["keep_alive"] = self.keep_alive
+        return payload
+
+    async def complete(self, model, messages, temperature):
+        data = await self.post_json("/api/chat", json=self._payload(model, messages, temperature, False))
+        if isinstance(data, dict):
+            if data.get("message") and data["message"].get("content"):
+                return data["message"]["content"]
+            if data.get("response"):
+                return data["response"]
+        raise ProviderError("ollama", "пустой ответ", "empty")
+
+    async def stream(self, model, messages, temperature):
+        async with self.open_stream("/api/chat", json=self._payload(model, messages, temperature, True)) as r:
+            # Ollama отдаёт NDJSON: по объекту на строку
+            async for line in r.aiter_lines():
+                if not line.strip():
+                    continue
+                try:
+                    chunk = json.loads(line)
+                except ValueError:
+                    continue
+                delta = (chunk.get("message") or {}).get("content") or chunk.get("response") or ""
+                if delta:
+                    yield delta
+                if chunk.get("done"):
+                    break
+
+    async def warm(self, model: str) -> bool:
+        # /api/generate без prompt только загружает модель в память (и продлевает keep_alive)
+        payload = {"model": model}
+        if self.keep_alive:
+            payload["keep_alive"] = self.keep_alive
+        started = time.monotonic()
+        try:
+            await self.post_json("/api/generate", json=payload)
+        except ProviderError as e:
+            log.warning("ollama: не удалось прогреть %s: %s", model, e)
+            return False
+        log.info("ollama: %s в памяти (%.1fs)", model, time.monotonic() - started)
+        return True
+
+    async def _preload(self):
+        for model in self.preload:
+            await self.warm(model)
+
+    async def _keep_warm(self):
+        while True:
+            await asyncio.sleep(self.keep_warm_s)
+            now = time.monotonic()
+            for model in dict.fromkeys([*self.preload, *self.last_used]):
+                # недавно использованные модели и так в памяти
+                if now - self.last_used.get(model, 0) >= self.keep_warm_s:
+                    await self.warm(model)
+
+    async def start(self):
+        # старт сервера не ждёт загрузки моделей: первые ходы просто попадут в уже идущий прогрев
+        if self.preload:
+            self._tasks.append(asyncio.create_task(self._preload()))
+        if self.keep_warm_s > 0:
+            self._tasks.append(asyncio.create_task(self._keep_warm()))
+
+    async def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+class ProviderRegistry:
+    def __init__(self):
+        self._providers: Dict[str, Provider] = {}
+
+    def register(self, provider: Provider) -> Provider:
+        self._providers[provider.name] = provider
+        pool.register(provider.name, provider.base_url, timeout=provider.timeout, prewarm=provider.prewarm)
+        return provider
+
+    @property
+    def names(self) -> list[str]:
+        return list(self._providers)
+
+    def get(self, name: str) -> Provider:
+        provider = self._providers.get(name)
+        if provider is None:
+            supported = ", ".join(f"{n}:*" for n in self._providers)
+            raise ProviderError(name, f"поддержаны: {supported}", "unsupported")
+        return provider
+
+    def resolve(self, spec: str) -> tuple[Provider, str]:
+        vendor, model = split_provider(spec)
+        provider = self.get(vendor)
+        provider.check()
+        return provider, model
+
+    async def complete(self, spec: str, messages: list[dict[str, str]], temperature: float) -> str:
+        provider, model = self.resolve(spec)
+        return clean_model_output(await provider.complete(model, messages, temperature))
+
+    async def stream(self, spec: str, messages: list[dict[str, str]], temperature: float) -> AsyncIterator[str]:
+        provider, model = self.resolve(spec)
+        async for delta in provider.stream(model, messages, temperature):
+            yield delta
+
+    def invalidate_cache(self):
+        for p in self._providers.values():
+            p.invalidate_cache()
+
+    async def start(self):
+        for p in self._providers.values():
+            await p.start()
+
+    async def stop(self):
+        for p in self._providers.values():
+            await p.stop()
+
+
+providers = ProviderRegistry()
+providers.register(GeminiProvider(GEMINI_URL))
+providers.register(OpenAIStyleProvider("groq", GROQ_URL, "GROQ_API_KEY"))
+providers.register(OpenAIStyleProvider(
+    "openrouter", OPENROUTER_URL, "OPENROUTER_API_KEY",
+    # рекомендуется OpenRouter (для rate limiting/идентификации клиента)
+    headers={"HTTP-Referer": "http://localhost", "X-Title": "Multi-Model Persona Chat"},
+))
+providers.register(OllamaProvider(OLLAMA_URL))
@@ -0,0 +1,236 @@
+from __future__ import annotations
+import os
+import heapq
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import AsyncIterator, Callable, Dict, Optional
+from sqlalchemy import func, select
+
+from db import run_db
+from models import Message, Thread
+
+# Push-канал треда (/ws/threads/{id}): новые сообщения, индикатор «печатает» и изменения summary.
+# Сообщения ловит один опрос на процесс — messages.id > курсора по первичному ключу, дёшево при любом
+# числе подписчиков и видит записи всех процессов (воркеры jobs.py, другие uvicorn-воркеры).
+# Ответ ассистента хранится с deliver_at (имитация печати) и до этого момента скрыт; опрос держит
+# такие строки в куче и выпускает их в срок — ни запрос, ни воркер на время «печати» не заняты.
+
+PUSH_POLL_MS = int(os.getenv("PUSH_POLL_MS", "250"))
+PUSH_SCAN_LIMIT = int(os.getenv("PUSH_SCAN_LIMIT", "1000"))  # строк за один проход опроса
+PUSH_SUMMARY_POLL_S = float(os.getenv("PUSH_SUMMARY_POLL_S", "5"))  # summary из других процессов
+PUSH_QUEUE_MAX = int(os.getenv("PUSH_QUEUE_MAX", "1000"))  # событий в очереди подписчика до отключения
+PUSH_REPLAY_MAX = int(os.getenv("PUSH_REPLAY_MAX", "500"))  # пропущенных сообщений при переподключении (?after=)
+
+log = logging.getLogger(__name__)
+
+Render = Callable[[Message], dict]
+
+
+def delivered(now: datetime):
+    return (Message.deliver_at.is_(None)) | (Message.deliver_at <= now)
+
+
+def _max_id(s) -> int:
+    return s.execute(select(func.max(Message.id))).scalar() or 0
+
+
+def _scan(s, after: int, threads: set[str], render: Render) -> tuple[int, list[tuple]]:
+    rows = s.execute(
+        select(Message).where(Message.id > after).order_by(Message.id).limit(PUSH_SCAN_LIMIT)
+    ).scalars().all()
+    top = rows[-1].id if rows else after
+    return top, [(m.id, m.thread_id, m.deliver_at, render(m)) for m in rows if m.thread_id in threads]
+
+
+def _load(s, ids: list[int], render: Render) -> list[tuple]:
+    rows = s.execute(select(Message).where(Message.id.in_(ids))).scalars().all()
+    return [(m.id, m.thread_id, m.deliver_at, render(m)) for m in rows]
+
+
+def _replay(s, thread_id: str, after: Optional[int], upto: int, render: Render) -> tuple[list[dict], list[tuple]]:
+    # (уже доставленные после after, ещё не доставленные) — всё не новее курсора опроса
+    now = datetime.utcnow()
+    sent = []
+    if after is not None:
+        rows = s.execute(
+            select(Message).where(Message.thread_id == thread_id, Message.id > after, Message.id <= upto, delivered(now))
+            .order_by(Message.id).limit(PUSH_REPLAY_MAX)
+        ).scalars().all()
+        sent = [render(m) for m in rows]
+    pending = s.execute(
+        select(Message).where(Message.thread_id == thread_id, Message.id <= upto, Message.deliver_at > now)
+    ).scalars().all()
+    return sent, [(m.id, m.thread_id, m.deliver_at, render(m)) for m in pending]
+
+
+def _summaries(s, threads: list[str]) -> list[tuple]:
+    return [tuple(r) for r in s.execute(
+        select(Thread.id, Thread.summary_upto, func.length(Thread.summary)).where(Thread.id.in_(threads))
+    )]
+
+
+def _summary(s, thread_id: str) -> str:
+    return s.execute(select(Thread.summary).where(Thread.id == thread_id)).scalar() or ""
+
+
+class ThreadHub:
+    def __init__(self, render: Render):
+        self._render = render
+        self._subs: Dict[str, set[asyncio.Queue]] = {}
+        self._cursor: Optional[int] = None  # последний просмотренный messages.id; None — подписчиков нет
+        self._pending: list[tuple[datetime, int]] = []  # куча (deliver_at, id) отложенных сообщений
+        self._pending_ids: set[int] = set()
+        self._summary_fp: Dict[str, tuple] = {}
+        self._summary_checked = 0.0
+        self._kick: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def subscribers(self) -> int:
+        return sum(len(qs) for qs in self._subs.values())
+
+    # === события ===
+    def publish(self, thread_id: str, event: dict):
+        for q in list(self._subs.get(thread_id, ())):
+            try:
+                q.put_nowait(event)
+            except asyncio.QueueFull:
+                # медленный клиент: отключаем, при переподключении он догонит историю через ?after=
+                self._close(thread_id, q, {"type": "overflow"})
+
+    def typing(self, thread_id: str, active: bool, until: Optional[datetime] = None):
+        event = {"type": "typing", "active": active}
+        if until is not None:
+            event["until"] = until.isoformat()
+        self.publish(thread_id, event)
+
+    def summary(self, thread_id: str, summary: str):
+        self.publish(thread_id, {"type": "summary", "summary": summary})
+
+    def message_deleted(self, thread_id: str, message_id: int):
+        self.publish(thread_id, {"type": "message_deleted", "id": message_id})
+
+    def kick(self):
+        # в этом процессе записано сообщение — опрос не ждёт своего интервала
+        if self._kick is not None:
+            self._kick.set()
+
+    def _close(self, thread_id: str, q: asyncio.Queue, notice: Optional[dict] = None):
+        while not q.empty():
+            q.get_nowait()
+        if notice is not None:
+            q.put_nowait(notice)
+        q.put_nowait(None)
+        self._subs.get(thread_id, set()).discard(q)
+
+    def _emit(self, row: tuple):
+        mid, thread_id, deliver_at, data = row
+        if deliver_at is not None and deliver_at > datetime.utcnow():
+            if mid not in self._pending_ids:
+                self._pending_ids.add(mid)
+                heapq.heappush(self._pending, (deliver_at, mid))
+                if data["role"] == "assistant":
+                    self.typing(thread_id, True, deliver_at)
+            return
+        self.publish(thread_id, {"type": "message", "message": data})
+        if data["role"] == "assistant":
+            self.typing(thread_id, False)
+
+    # === подписка ===
+    @asynccontextmanager
+    async def subscribe(self, thread_id: str, after: Optional[int] = None) -> AsyncIterator[asyncio.Queue]:
+        # очередь событий треда; None в очереди — подписка закрыта сервером
+        q: asyncio.Queue = asyncio.Queue(PUSH_QUEUE_MAX)
+        self._subs.setdefault(thread_id, set()).add(q)
+        try:
+            if self._cursor is None:
+                self._cursor = await run_db(_max_id)
+            # сначала подписка, потом курсор: всё новее курсора придёт из опроса, всё до него — отсюда
+            sent, pending = await run_db(_replay, thread_id, after, self._cursor, self._render)
+            for data in sent:
+                q.put_nowait({"type": "message", "message": data})
+            for row in pending:
+                self._emit(row)
+            yield q
+        finally:
+            subs = self._subs.get(thread_id)
+            if subs is not None:
+                subs.discard(q)
+                if not subs:
+                    del self._subs[thread_id]
+                    self._summary_fp.pop(thread_id, None)
+
+    # === опрос ===
+    async def _poll_messages(self):
+        while True:
+            top, rows = await run_db(_scan, self._cursor, set(self._subs), self._render)
+            self._cursor = top
+            for row in rows:
+                self._emit(row)
+            if len(rows) < PUSH_SCAN_LIMIT:
+                return
+
+    async def _release_due(self):
+        now = datetime.utcnow()
+        due = []
+        while self._pending and self._pending[0][0] <= now:
+            _, mid = heapq.heappop(self._pending)
+            self._pending_ids.discard(mid)
+            due.append(mid)
+        if due:
+            # строку могли удалить или перенести срок — перечитываем
+            for row in await run_db(_load, due, self._render):
+                self._emit(row)
+
+    async def _poll_summaries(self):
+        threads = list(self._subs)
+        for i in range(0, len(threads), 500):
+            for tid, upto, length in await run_db(_summaries, threads[i:i + 500]):
+                fp = (upto, length)
+                prev = self._summary_fp.get(tid)
+                self._summary_fp[tid] = fp
+                if prev is not None and prev != fp and tid in self._subs:
+                    self.summary(tid, await run_db(_summary, tid))
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            timeout = PUSH_POLL_MS / 1000.0
+            if self._pending:
+                timeout = min(timeout, max((self._pending[0][0] - datetime.utcnow()).total_seconds(), 0))
+            try:
+                await asyncio.wait_for(self._kick.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._kick.clear()
+            if not self._subs:
+                # никого нет — курсор не двигаем, при первой подписке он встанет на текущий max(id)
+                self._cursor = None
+                self._pending.clear()
+                self._pending_ids.clear()
+                continue
+            try:
+                if self._cursor is not None:
+                    await self._poll_messages()
+                await self._release_due()
+                if loop.time() - self._summary_checked >= PUSH_SUMMARY_POLL_S:
+                    self._summary_checked = loop.time()
+                    await self._poll_summaries()
+            except Exception:
+                log.exception("push poll failed")
+
+    async def start(self):
+        if self._task is None:
+            self._kick = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for tid, subs in list(self._subs.items()):
+            for q in list(subs):
+                self._close(tid, q)
@@ -0,0 +1,269 @@
+from __future__ import annotations
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional
+
+from metrics import provider_latency, provider_ttfb, provider_errors, blocked_responses, model_label
+
+# Роутер провайдеров: цепочки фолбэков ("groq:x -> openrouter:y"), повторы с джиттером,
+# хеджированные запросы по p95 и circuit breaker на каждого провайдера.
+
+ROUTER_RETRIES = int(os.getenv("ROUTER_RETRIES", "1"))  # повторов на кандидата после первой попытки
+ROUTER_BACKOFF_MS = int(os.getenv("ROUTER_BACKOFF_MS", "250"))
+ROUTER_BACKOFF_MAX_MS = int(os.getenv("ROUTER_BACKOFF_MAX_MS", "2000"))
+# {"groq:qwen/qwen3-32b": ["openrouter:qwen/qwen3-32b:free"]} — фолбэки по умолчанию для spec без "->"
+MODEL_FALLBACKS: Dict[str, list[str]] = json.loads(os.getenv("MODEL_FALLBACKS", "{}") or "{}")
+
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "0") == "1"
+HEDGE_QUANTILE = float(os.getenv("HEDGE_QUANTILE", "0.95"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_MIN_DELAY_MS = int(os.getenv("HEDGE_MIN_DELAY_MS", "300"))
+
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))  # подряд неудач до размыкания
+BREAKER_COOLDOWN_S = float(os.getenv("BREAKER_COOLDOWN_S", "30"))
+
+log = logging.getLogger(__name__)
+
+
+class ProviderError(Exception):
+    # kind: config | http | network | blocked | empty | unsupported
+    def __init__(self, provider: str, message: str, kind: str = "http", status: Optional[int] = None, retryable: bool = False):
+        super().__init__(f"{provider}: {message}")
+        self.provider = provider
+        self.kind = kind
+        self.status = status
+        self.retryable = retryable
+
+    @classmethod
+    def from_status(cls, provider: str, status: int, detail) -> "ProviderError":
+        # 429 и 5xx — временные, остальное (ключ, модель, запрос) повторять бессмысленно
+        return cls(provider, f"HTTP {status}: {str(detail)[:300]}", "http", status, status == 429 or status >= 500)
+
+
+class CircuitBreaker:
+    # closed -> (BREAKER_FAILURES подряд) -> open -> (BREAKER_COOLDOWN_S) -> half-open: одна пробная попытка
+    def __init__(self, failures: int = BREAKER_FAILURES, cooldown: float = BREAKER_COOLDOWN_S):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.consecutive = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def success(self):
+        self.consecutive = 0
+        self.opened_at = None
+        self._probing = False
+
+    def failure(self):
+        self.consecutive += 1
+        self._probing = False
+        if self.opened_at is not None or self.consecutive >= self.failures:
+            self.opened_at = time.monotonic()
+
+    def abort(self):
+        # попытка оборвалась без ответа провайдера (отмена, неожиданное исключение): пробная попытка
+        # half-open считается неудачной, иначе _probing так и останется True и провайдер не откроется;
+        # в closed счётчик не трогаем — уход клиента не говорит о здоровье провайдера
+        if self._probing:
+            self.failure()
+
+
+class LatencyWindow:
+    def __init__(self, size: int = 200):
+        self.samples: deque[float] = deque(maxlen=size)
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if len(self.samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def provider_of(spec: str) -> str:
+    return spec.split(":", 1)[0].strip()
+
+
+def model_of(spec: str) -> str:
+    return spec.split(":", 1)[1].strip() if ":" in spec else ""
+
+
+
+
+def parse_chain(spec: str) -> list[str]:
+    chain = [p.strip() for p in spec.split("->") if p.strip()]
+    if len(chain) == 1:
+        chain += MODEL_FALLBACKS.get(chain[0], [])
+    return chain
+
+
+class Router:
+    def __init__(
+        self,
+        call: Callable[[str, list[dict[str, str]], float], Awaitable[str]],
+        stream: Callable[[str, list[dict[str, str]], float], AsyncIterator[str]],
+        known: Optional[Callable[[str], bool]] = None,
+    ):
+        self._call = call
+        self._stream = stream
+        # провайдер в spec тоже от клиента: в метки метрик попадают только известные
+        self._known = known or (lambda provider: True)
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.latency: Dict[str, LatencyWindow] = {}
+
+    def breaker(self, provider: str) -> CircuitBreaker:
+        b = self.breakers.get(provider)
+        if b is None:
+            b = self.breakers[provider] = CircuitBreaker()
+        return b
+
+    def _provider_label(self, provider: str) -> str:
+        return provider if self._known(provider) else "other"
+
+    def _labels(self, spec: str) -> dict[str, str]:
+        return {"provider": self._provider_label(provider_of(spec)), "model": model_label(model_of(spec))}
+
+    def _count_error(self, e: ProviderError):
+        provider = self._provider_label(e.provider)
+        provider_errors.inc(provider=provider, kind=e.kind)
+        if e.kind == "blocked":
+            blocked_responses.inc(provider=provider)
+
+    def _hedge_delay(self, spec: str) -> Optional[float]:
+        if not HEDGE_ENABLED:
+            return None
+        window = self.latency.get(spec)
+        q = window.quantile(HEDGE_QUANTILE) if window else None
+        if q is None:
+            return None
+        return max(q, HEDGE_MIN_DELAY_MS / 1000.0)
+
+    async def _timed(self, spec: str, messages, temperature: float) -> str:
+        started = time.monotonic()
+        labels = self._labels(spec)
+        try:
+            text = await self._call(spec, messages, temperature)
+        except asyncio.CancelledError:
+            # проигравшая половина хеджированной пары
+            provider_latency.observe(time.monotonic() - started, outcome="cancelled", **labels)
+            raise
+        except Exception:
+            provider_latency.observe(time.monotonic() - started, outcome="error", **labels)
+            raise
+        elapsed = time.monotonic() - started
+        self.latency.setdefault(spec, LatencyWindow()).add(elapsed)
+        provider_latency.observe(elapsed, outcome="ok", **labels)
+        return text
+
+    async def _hedged(self, spec: str, messages, temperature: float) -> str:
+        delay = self._hedge_delay(spec)
+        if delay is None:
+            return await self._timed(spec, messages, temperature)
+        tasks = {asyncio.create_task(self._timed(spec, messages, temperature))}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                # первый запрос медленнее p95 — шлём второй, побеждает первый удачный ответ
+                tasks.add(asyncio.create_task(self._timed(spec, messages, temperature)))
+            last_exc: Optional[BaseException] = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    if t.exception() is None:
+                        return t.result()
+                    last_exc = t.exception()
+            raise last_exc
+        finally:
+            for t in tasks:
+                t.cancel()
+
+    async def complete(self, spec: str, messages: list[dict[str, str]], temperature: float) -> str:
+        last: Optional[ProviderError] = None
+        for candidate in parse_chain(spec):
+            breaker = self.breaker(provider_of(candidate))
+            for attempt in range(ROUTER_RETRIES + 1):
+                if not breaker.allow():
+                    last = last or ProviderError(provider_of(candidate), "circuit open", "network", retryable=True)
+                    break
+                try:
+                    text = await self._hedged(candidate, messages, temperature)
+                except ProviderError as e:
+                    self._count_error(e)
+                    if e.retryable:
+                        breaker.failure()
+                    else:
+                        breaker.success()  # провайдер ответил, просто запрос плохой
+                    last = e
+                    log.warning("provider %s failed (attempt %d): %s", candidate, attempt + 1, e)
+                    if not e.retryable or attempt == ROUTER_RETRIES:
+                        break
+                    # full jitter: случайная пауза до экспоненциальной границы
+                    cap = min(ROUTER_BACKOFF_MAX_MS, ROUTER_BACKOFF_MS * 2 ** attempt)
+                    await asyncio.sleep(random.uniform(0, cap) / 1000.0)
+                    continue
+                except BaseException:
+                    breaker.abort()
+                    raise
+                breaker.success()
+                return text
+        raise last or ProviderError("router", "пустая цепочка моделей", "config")
+
+    async def stream(self, spec: str, messages: list[dict[str, str]], temperature: float) -> AsyncIterator[str]:
+        # фолбэк возможен только до первой дельты: начатый ответ клиенту уже не подменить
+        last: Optional[ProviderError] = None
+        for candidate in parse_chain(spec):
+            breaker = self.breaker(provider_of(candidate))
+            if not breaker.allow():
+                last = last or ProviderError(provider_of(candidate), "circuit open", "network", retryable=True)
+                continue
+            started = False
+            t0 = time.monotonic()
+            try:
+                async for delta in self._stream(candidate, messages, temperature):
+                    if not started:
+                        provider_ttfb.observe(time.monotonic() - t0, **self._labels(candidate))
+                    started = True
+                    yield delta
+            except ProviderError as e:
+                self._count_error(e)
+                if e.retryable:
+                    breaker.failure()
+                else:
+                    breaker.success()
+                last = e
+                log.warning("provider %s stream failed: %s", candidate, e)
+                if started:
+                    raise
+                continue
+            except BaseException:
+                # отмена или закрытие генератора потребителем: начатый ответ — провайдер жив
+                if started:
+                    breaker.success()
+                else:
+                    breaker.abort()
+                raise
+            breaker.success()
+            return
+        raise last or ProviderError("router", "пустая цепочка моделей", "config")
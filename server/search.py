@@ -0,0 +1,236 @@
+from __future__ import annotations
+import os
+import re
+import html
+import logging
+from typing import Optional
+from sqlalchemy import delete, text
+from sqlalchemy.engine import Connection
+
+from models import ArchivedMessage, Thread
+from archive import read_archive
+
+# Полнотекстовый поиск SQLite FTS5 по сообщениям и персонам.
+# Индексы external-content: текст не дублируется, FTS хранит только словарь и позиции;
+# актуальность поддерживают триггеры, первичное наполнение — 'rebuild' из init_db.py.
+# Архивация (archive.py) удаляет строки messages, но не их записи в messages_fts: удаление, отмеченное
+# в archived_messages, триггер пропускает, и поиск продолжает находить архивную историю.
+# 'rebuild' читает только messages — после него архивные записи из индекса пропадают.
+
+SEARCH_PAGE_MAX = int(os.getenv("SEARCH_PAGE_MAX", "100"))
+SEARCH_MAX_OFFSET = int(os.getenv("SEARCH_MAX_OFFSET", "1000"))  # глубже по релевантности — через sort=recent
+# bm25 считается только по SEARCH_RANK_WINDOW самых свежих совпадений (запрос без фильтров):
+# частое слово на миллионах сообщений иначе сортируется целиком; 0 — без ограничения
+SEARCH_RANK_WINDOW = int(os.getenv("SEARCH_RANK_WINDOW", "50000"))
+SNIPPET_TOKENS = int(os.getenv("SEARCH_SNIPPET_TOKENS", "12"))
+HL_OPEN, HL_CLOSE = "<mark>", "</mark>"
+# snippet() FTS5 размечает совпадения этими символами (Private Use Area), текст экранируется,
+# и только потом они заменяются на HL_OPEN/HL_CLOSE: сниппет вставляется во фронте как HTML
+_FTS_OPEN, _FTS_CLOSE = "\ue000", "\ue001"
+
+# unicode61 приводит регистр кириллицы и латиницы; remove_diacritics 2 — «ё» ищется по «е»
+TOKENIZE = "unicode61 remove_diacritics 2"
+
+log = logging.getLogger(__name__)
+
+FTS_DDL = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+        content, content='messages', content_rowid='id', tokenize='{TOKENIZE}'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+    END""",
+    # пересоздаётся при каждом init_db: у баз до архива триггер был без условия
+    "DROP TRIGGER IF EXISTS messages_fts_ad",
+    """CREATE TRIGGER messages_fts_ad AFTER DELETE ON messages
+    WHEN NOT EXISTS (SELECT 1 FROM archived_messages WHERE id = old.id) BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+    END""",
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS personas_fts USING fts5(
+        name, bio, style, goals, content='personas', content_rowid='rowid', tokenize='{TOKENIZE}'
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS personas_fts_ai AFTER INSERT ON personas BEGIN
+        INSERT INTO personas_fts(rowid, name, bio, style, goals) VALUES (new.rowid, new.name, new.bio, new.style, new.goals);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS personas_fts_ad AFTER DELETE ON personas BEGIN
+        INSERT INTO personas_fts(personas_fts, rowid, name, bio, style, goals)
+        VALUES ('delete', old.rowid, old.name, old.bio, old.style, old.goals);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS personas_fts_au AFTER UPDATE ON personas BEGIN
+        INSERT INTO personas_fts(personas_fts, rowid, name, bio, style, goals)
+        VALUES ('delete', old.rowid, old.name, old.bio, old.style, old.goals);
+        INSERT INTO personas_fts(rowid, name, bio, style, goals) VALUES (new.rowid, new.name, new.bio, new.style, new.goals);
+    END""",
+]
+
+
+def ensure_fts(conn: Connection) -> bool:
+    # True — индексы есть (или созданы и наполнены); False — SQLite собран без FTS5
+    existed = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'")).first() is not None
+    try:
+        for ddl in FTS_DDL:
+            conn.execute(text(ddl))
+    except Exception as e:
+        log.warning("FTS5 недоступен, поиск выключен: %s", e)
+        return False
+    if not existed:
+        # переиндексация всех строк content-таблицы одним проходом
+        conn.execute(text("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"))
+        conn.execute(text("INSERT INTO personas_fts(personas_fts) VALUES ('rebuild')"))
+    return True
+
+
+def fts_query(q: str) -> Optional[str]:
+    # пользовательский ввод -> безопасный MATCH: каждое слово в кавычках (никакого синтаксиса FTS5),
+    # все слова обязательны, последнее — префиксом (поиск по мере набора)
+    terms = re.findall(r"\w+", q or "")
+    if not terms:
+        return None
+    quoted = [f'"{t}"' for t in terms]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+
+def _rank_floor(s, match: str) -> Optional[int]:
+    # rowid, начиная с которого лежат SEARCH_RANK_WINDOW последних совпадений (обход FTS по rowid — без ранжирования)
+    if SEARCH_RANK_WINDOW <= 0:
+        return None
+    return s.execute(
+        text("SELECT rowid FROM messages_fts WHERE messages_fts MATCH :match ORDER BY rowid DESC LIMIT 1 OFFSET :n"),
+        {"match": match, "n": SEARCH_RANK_WINDOW - 1},
+    ).scalar()
+
+
+def _fold(text_: str) -> str:
+    return text_.lower().replace("ё", "е")
+
+
+def make_snippet(content: str, q: str, tokens: int = SNIPPET_TOKENS) -> str:
+    # фрагмент вокруг первого совпадения, совпадения обёрнуты в HL_OPEN/HL_CLOSE, остальной текст экранирован.
+    # Считается в Python по тексту строки: snippet() FTS5 для каждого rowid заново читает doclist терма,
+    # а на частых словах и префиксах это сотни миллисекунд на страницу
+    terms = [_fold(t) for t in re.findall(r"\w+", q or "")]
+    words = list(re.finditer(r"\w+", content or ""))
+    if not words:
+        return html.escape(content or "")
+
+    def hit(w) -> bool:
+        word = _fold(w.group())
+        return any(word.startswith(t) if n == len(terms) - 1 else word == t for n, t in enumerate(terms))
+
+    first = next((n for n, w in enumerate(words) if hit(w)), 0)
+    lo = max(0, min(first - tokens // 2, len(words) - tokens))
+    hi = min(len(words), lo + tokens)
+    start = 0 if lo == 0 else words[lo].start()
+    end = len(content) if hi == len(words) else words[hi - 1].end()
+    out, pos = [], start
+    for w in words[lo:hi]:
+        if hit(w):
+            out += [html.escape(content[pos:w.start()]), HL_OPEN, html.escape(w.group()), HL_CLOSE]
+            pos = w.end()
+    out.append(html.escape(content[pos:end]))
+    return ("…" if start > 0 else "") + "".join(out) + ("…" if end < len(content) else "")
+
+
+def _highlight(snippet: Optional[str]) -> str:
+    return html.escape(snippet or "").replace(_FTS_OPEN, HL_OPEN).replace(_FTS_CLOSE, HL_CLOSE)
+
+
+def search_messages(
+    s,
+    q: str,
+    persona_id: Optional[str] = None,
+    thread_id: Optional[str] = None,
+    role: Optional[str] = None,
+    sort: str = "rank",
+    limit: int = 20,
+    offset: int = 0,
+    before: Optional[int] = None,
+) -> list[dict]:
+    # sort=rank — по bm25, страницы через offset; sort=recent — новые первыми, страницы через before=<id>
+    # (rowid-порядок FTS5 отдаёт без сортировки всех совпадений — дёшево и на миллионах строк)
+    match = fts_query(q)
+    if match is None:
+        return []
+    where = ["messages_fts MATCH :match"]
+    params = {"match": match, "limit": limit, "offset": offset}
+    if thread_id:
+        where.append("coalesce(m.thread_id, a.thread_id) = :thread_id")
+        params["thread_id"] = thread_id
+    if persona_id:
+        where.append("t.persona_id = :persona_id")
+        params["persona_id"] = persona_id
+    if role:
+        where.append("coalesce(m.role, a.role) = :role")
+        params["role"] = role
+    if sort == "recent":
+        if before is not None:
+            where.append("messages_fts.rowid < :before")
+            params["before"] = before
+        order = "messages_fts.rowid DESC"
+        params["offset"] = 0
+        # bm25 здесь не нужен, а его подсчёт читает полный doclist каждого терма
+        rank = "NULL"
+    else:
+        floor = None if (thread_id or persona_id or role) else _rank_floor(s, match)
+        if floor is not None:
+            where.append("messages_fts.rowid >= :floor")
+            params["floor"] = floor
+        order = "messages_fts.rank, messages_fts.rowid DESC"
+        rank = "messages_fts.rank"
+    sql = f"""
+        SELECT messages_fts.rowid AS id, coalesce(m.thread_id, a.thread_id) AS thread_id, t.persona_id,
+               coalesce(m.role, a.role) AS role, coalesce(m.created_at, a.created_at) AS created_at,
+               m.content, {rank} AS rank
+        FROM messages_fts
+        LEFT JOIN messages m ON m.id = messages_fts.rowid
+        LEFT JOIN archived_messages a ON a.id = messages_fts.rowid
+        JOIN threads t ON t.id = coalesce(m.thread_id, a.thread_id)
+        WHERE {' AND '.join(where)}
+        ORDER BY {order}
+        LIMIT :limit OFFSET :offset
+    """
+    rows = [dict(r._mapping) for r in s.execute(text(sql), params)]
+    archived: dict[int, str] = {}
+    for tid in {r["thread_id"] for r in rows if r["content"] is None}:
+        # текст архивных совпадений — из архива треда (файл кэшируется в archive._load)
+        archived.update((a["id"], a["content"]) for a in read_archive(s.get(Thread, tid)))
+    for r in rows:
+        content = r.pop("content")
+        r["snippet"] = make_snippet(archived.get(r["id"], "") if content is None else content, q)
+    return rows
+
+
+def forget_archived(s, t: Thread):
+    # удаление треда: записи индекса по его архивным сообщениям убираются по тексту из архива
+    # (external-content FTS5 удаляет запись только по исходному содержимому)
+    for a in read_archive(t):
+        s.execute(
+            text("INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', :id, :content)"),
+            {"id": a["id"], "content": a["content"]},
+        )
+    s.execute(delete(ArchivedMessage).where(ArchivedMessage.thread_id == t.id))
+
+
+def search_personas(s, q: str, limit: int = 20) -> list[dict]:
+    match = fts_query(q)
+    if match is None:
+        return []
+    sql = """
+        SELECT p.id, p.name, personas_fts.rank AS rank,
+               snippet(personas_fts, -1, :hl_open, :hl_close, '…', :snippet_tokens) AS snippet
+        FROM personas_fts
+        JOIN personas p ON p.rowid = personas_fts.rowid
+        WHERE personas_fts MATCH :match
+        ORDER BY personas_fts.rank
+        LIMIT :limit
+    """
+    params = {"match": match, "limit": limit, "hl_open": _FTS_OPEN, "hl_close": _FTS_CLOSE, "snippet_tokens": SNIPPET_TOKENS}
+    rows = [dict(r._mapping) for r in s.execute(text(sql), params)]
+    for r in rows:
+        r["snippet"] = _highlight(r["snippet"])
+    return rows
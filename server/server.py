@@ -1,25 +1,102 @@
 from __future__ import annotations
-import os, json
-from typing import List, Dict
-import httpx
-from fastapi import FastAPI, HTTPException
+import os, json, base64, time
+from datetime import datetime, timedelta
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
-from sqlalchemy import select, delete
-from sqlalchemy.orm import joinedload
+from sqlalchemy import select, delete, func, tuple_
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm import joinedload, defer
 from dotenv import load_dotenv
 from typing import Optional
 from fastapi import APIRouter
-from db import session_scope
-from models import Persona, Thread
 import re
 import asyncio
 
-from db import session_scope
+load_dotenv()  # до локальных модулей: они читают настройки из окружения при импорте
+
+from db import run_db, shutdown_db, engine
+from http_pool import pool
 from models import Persona, Thread, Message, Setting
+from writer import writer
+from prompt_cache import PromptCache, prefix_key
+from summarizer import Summarizer
+from router import Router, ProviderError
+from idempotency import idempotency, purge_expired
+from jobs import jobs, enqueue, get_job, job_by_key, purge_finished, JobFailed, JOB_WAIT_MAX_S
+from turns import turns
+from batch import run_batch, BatchProgress
+from context import estimate_tokens, context_budget, shared_history, fit_history, REPLY_RESERVE_TOKENS
+from metrics import registry, http_requests, http_in_flight, phase, observe_phase, start_span
+from providers import providers, clean_model_output
+from archive import archiver, read_archive, drop_archive
+from memory import memory, recall, drop_memory
+from dump import export_ndjson, import_ndjson, naive_utc, CONFLICT_MODES
+from search import search_messages, search_personas, forget_archived, SEARCH_PAGE_MAX, SEARCH_MAX_OFFSET
+from push import ThreadHub, delivered
+from conditional import conditional, etag
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # поднимаем keep-alive пулы к провайдерам (и прогреваем соединения) один раз на процесс
+    await pool.start()
+    await providers.start()
+    await writer.start()
+    await summarizer.start()
+    await archiver.start()
+    await memory.start()
+    await run_db(purge_expired)
+    await run_db(purge_finished)
+    await hub.start()
+    await jobs.start(chat_job)
+    try:
+        yield
+    finally:
+        # воркеры первыми: незаконченные задачи возвращаются в очередь, пока база и writer живы
+        await jobs.stop()
+        await hub.stop()
+        await memory.stop()
+        await archiver.stop()
+        await summarizer.stop()
+        await writer.stop()
+        await providers.stop()
+        await pool.close()
+        shutdown_db()
+
+
+app = FastAPI(title="Chat API with SQLite", lifespan=lifespan)
+
+registry.gauge("db_pool_checked_out", "SQLAlchemy connections in use", fn=lambda: engine.pool.checkedout())
+registry.gauge("turn_queue_depth", "Chat turns waiting or running across threads", fn=lambda: turns.total_depth)
+registry.gauge("writer_queue_depth", "Messages waiting for the group-commit writer", fn=lambda: writer.pending)
+registry.gauge("idempotency_in_flight", "Idempotent requests being computed", fn=lambda: idempotency.inflight)
+registry.gauge("jobs_running", "Background chat jobs being executed by this process", fn=lambda: jobs.running)
+registry.gauge("ws_subscribers", "Open thread WebSocket subscriptions", fn=lambda: hub.subscribers)
+
+
+@app.middleware("http")
+async def observe_requests(request: Request, call_next):
+    # для стримов время — до отправки заголовков; сам поток меряют фазы и provider_stream_*
+    started = time.perf_counter()
+    http_in_flight.inc()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        http_in_flight.dec()
+        route = request.scope.get("route")
+        http_requests.observe(
+            time.perf_counter() - started,
+            method=request.method,
+            route=getattr(route, "path", "unmatched"),
+            status=str(status),
+        )
 
-load_dotenv()
-app = FastAPI(title="Chat API with SQLite")
 
 app.add_middleware(
     CORSMiddleware,
@@ -27,17 +104,20 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "Last-Modified"],  # UI читает ETag для условных запросов
 )
 
-GEMINI_KEY = os.getenv("GEMINI_API_KEY", "")
-OLLAMA_URL = os.getenv("OLLAMA_URL", "http://127.0.0.1:11434")
 LAST_TURNS = int(os.getenv("LAST_TURNS", "12"))
 TEMP_DEFAULT = float(os.getenv("TEMP_DEFAULT", "0.7"))
-GROQ_KEY = os.getenv("GROQ_API_KEY", "")
 TYPE_SIM_ENABLED = os.getenv("TYPE_SIM_ENABLED", "1") == "1" 
 TYPE_SIM_CPS = float(os.getenv("TYPE_SIM_CPS", "5"))
 TYPE_SIM_MIN_MS = int(os.getenv("TYPE_SIM_MIN_MS", "300"))
 TYPE_SIM_MAX_MS = int(os.getenv("TYPE_SIM_MAX_MS", "10000"))
+# schedule — ответ пишется сразу с deliver_at и выпускается push-каналом в срок; sleep — старое ожидание в запросе
+TYPE_SIM_MODE = os.getenv("TYPE_SIM_MODE", "schedule")
+MESSAGES_PAGE_MAX = int(os.getenv("MESSAGES_PAGE_MAX", "500"))
+FANOUT_MAX_TARGETS = int(os.getenv("FANOUT_MAX_TARGETS", "8"))
+THREADS_PAGE_MAX = int(os.getenv("THREADS_PAGE_MAX", "200"))
 
 class ChatIn(BaseModel):
     model: str          # "gemini:gemini-1.5-flash" | "ollama:llama3"
@@ -46,9 +126,22 @@ class ChatIn(BaseModel):
     threadId: str
     temperature: Optional[float] = None 
     simulateTyping: Optional[bool] = None
+    idempotencyKey: Optional[str] = None  # повтор с тем же ключом вернёт тот же ответ (или заголовок Idempotency-Key)
 
 class ChatOut(BaseModel):
     text: str
+    id: Optional[int] = None
+    deliver_at: Optional[str] = None  # с имитацией печати: раньше этого момента ответ не показывать
+
+class JobOut(BaseModel):
+    id: str
+    thread_id: str
+    status: str  # queued | running | done | failed
+    attempts: int
+    text: Optional[str] = None
+    error: Optional[str] = None
+    created_at: str
+    updated_at: str
 
 # рядом с ChatIn/ChatOut
 class PersonaOut(BaseModel):
@@ -72,12 +165,19 @@ class MessageOut(BaseModel):
     role: str
     content: str
     created_at: str
+    cursor: str  # непрозрачный курсор (created_at, id) для before/after
+    persona_id: Optional[str] = None  # автор ответа в общем треде (fan-out)
 
 class ThreadOut(BaseModel):
     id: str
     persona_id: str
     model: str
-    summary: str
+    summary: Optional[str] = None  # в lite-листинге не отдаётся
+    message_count: int = 0
+    last_message_preview: str = ""
+    created_at: Optional[str] = None
+    updated_at: Optional[str] = None
+    cursor: Optional[str] = None  # курсор для before в листинге
 
 class ThreadUpdateIn(BaseModel):
     persona_id: Optional[str] = None
@@ -93,6 +193,44 @@ class SystemConfigIn(BaseModel):
 class SystemPromptOut(BaseModel):
     prompt: str
 
+class FanoutTarget(BaseModel):
+    personaId: str
+    model: Optional[str] = None  # по умолчанию — model запроса
+    temperature: Optional[float] = None
+
+class FanoutIn(BaseModel):
+    threadId: str
+    message: str
+    model: str
+    targets: list[FanoutTarget]  # порядок задаёт и порядок ответов в истории треда
+    temperature: Optional[float] = None
+    limits: Optional[dict[str, int]] = None  # параллельность на провайдера, как у /api/chat/batch
+
+class BatchIn(BaseModel):
+    items: list[dict]  # как ChatIn + необязательный id; threadId по умолчанию "batch-<id>"
+    limits: Optional[dict[str, int]] = None  # параллельность на провайдера
+
+class MessageHitOut(BaseModel):
+    id: int
+    thread_id: str
+    persona_id: str
+    role: str
+    created_at: str
+    snippet: str  # HTML: текст экранирован, совпадения обёрнуты в <mark>…</mark>
+    score: Optional[float] = None  # bm25, больше — релевантнее; для sort=recent не считается
+
+class PersonaHitOut(BaseModel):
+    id: str
+    name: str
+    snippet: str
+    score: float
+
+class SearchOut(BaseModel):
+    messages: list[MessageHitOut] = []
+    personas: list[PersonaHitOut] = []
+    next_offset: Optional[int] = None  # sort=rank
+    next_before: Optional[int] = None  # sort=recent
+
 class SummaryIn(BaseModel):
     summary: str
 
@@ -117,6 +255,10 @@ def system_prompt(persona: Persona, global_prompt: str) -> str:
         f"Цели: {goals}.\n"
         f"{global_prompt}".strip()
     )
+prompt_cache = PromptCache(system_prompt)
+# персоны/global_prompt изменились — кэши префиксов у провайдеров больше не нужны
+prompt_cache.on_invalidate(providers.invalidate_cache)
+
 def compute_typing_delay_ms(text: str) -> int:
     try:
         n = max(0, len(text or ""))
@@ -129,324 +271,700 @@ def compute_typing_delay_ms(text: str) -> int:
     except Exception:
         return TYPE_SIM_MIN_MS
 
-def to_openai_style(messages: list[dict[str, str]]) -> list[dict[str, str]]:
-    out = []
-    for m in messages:
-        role = (m.get("role") or "user").lower()
-        # допустим только system/user/assistant
-        if role not in ("system", "user", "assistant"):
-            role = "user"
-        out.append({"role": role, "content": m.get("content", "")})
-    return out
-
-def clean_model_output(text: str) -> str:
-    # убираем блоки <think>…</think>
-    cleaned = re.sub(r"<think>.*?</think>", "", text, flags=re.DOTALL)
-    return cleaned.strip()
-
-def split_provider(spec: str):
-    a, b = spec.split(":", 1)
-    return a.strip(), b.strip()
-
-
-def to_gemini_payload(messages: List[Dict[str, str]]) -> Dict:
-    arr = []
-    for m in messages:
-        role = m["role"]
-        arr.append({
-            "role": "user" if role in ("user", "system") else "model",
-            "parts": [{"text": m["content"]}],
-        })
-    return {"contents": arr}
-
-
-async def call_gemini(
-    model: str,
-    messages: list[dict[str, str]],
-    temperature: float = TEMP_DEFAULT,
-) -> str:
-    if not GEMINI_KEY:
-        return "(Не задан GEMINI_API_KEY)"
-
-    url = (
-        f"https://generativelanguage.googleapis.com/v1beta/models/"
-        f"{model}:generateContent?key={GEMINI_KEY}"
-    )
-
-    system_parts = [{"text": m["content"]} for m in messages if m.get("role") == "system"]
-    ua_messages = [
-        {
-            "role": "user" if m["role"] == "user" else "model",  # assistant -> model
-            "parts": [{"text": m["content"]}],
-        }
-        for m in messages
-        if m.get("role") in ("user", "assistant")
-    ]
-
-    gen_cfg = {
-        "temperature": max(0.0, min(2.0, float(temperature))),
-    }
-
-    payload = {
-        "contents": ua_messages,
-        "generationConfig": gen_cfg,
-    }
-    if system_parts:
-
-        payload["systemInstruction"] = {"role": "user", "parts": system_parts}
-
-    try:
-        async with httpx.AsyncClient(timeout=60) as cli:
-            r = await cli.post(url, json=payload)
-            r.raise_for_status()
-            data = r.json()
-    except httpx.HTTPStatusError as e:
-
-        try:
-            detail = e.response.json()
-        except Exception:
-            detail = e.response.text if e.response is not None else str(e)
-        return f"(Gemini HTTP {e.response.status_code if e.response else ''}: {detail})"
-    except Exception as e:
-        return f"(Gemini ошибка сети: {e})"
-    pf = data.get("promptFeedback", {})
-    if pf.get("blockReason"):
-        return f"(Gemini заблокировал запрос: {pf.get('blockReason')})"
-
-
-    candidates = data.get("candidates") or []
-    for c in candidates:
-        content = (c.get("content") or {})
-        parts = content.get("parts") or []
-  
-        out = "".join(p.get("text", "") for p in parts if isinstance(p, dict))
-        if out.strip():
-            return out.strip()
-
-    finish = candidates[0].get("finishReason") if candidates else None
-    return f"(Gemini не вернул текст; finishReason={finish})"
-
-async def call_groq(
-    model: str,
-    messages: list[dict[str, str]],
-    temperature: float = TEMP_DEFAULT,
-) -> str:
-    if not GROQ_KEY:
-        return "(Не задан GROQ_API_KEY)"
-
-    url = f"https://api.groq.com/openai/v1/chat/completions"
-    payload = {
-        "model": model,  # напр.: "llama-3.1-70b-versatile", "mixtral-8x7b-32768", "llama-3.2-11b-text-preview"
-        "messages": to_openai_style(messages),
-        "temperature": max(0.0, min(2.0, float(temperature))),
-        # опционально:
-        # "max_tokens": int(os.getenv("GROQ_MAX_TOKENS", "512")),
-        # "top_p": 0.95,
-        # "stop": ["</s>"],
-    }
-    headers = {
-        "Authorization": f"Bearer {GROQ_KEY}",
-        "Content-Type": "application/json",
-    }
-
-    try:
-        async with httpx.AsyncClient(timeout=60) as cli:
-            r = await cli.post(url, json=payload, headers=headers)
-            r.raise_for_status()
-            data = r.json()
-    except httpx.HTTPStatusError as e:
-        try:
-            detail = e.response.json()
-        except Exception:
-            detail = e.response.text if e.response is not None else str(e)
-        return f"(Groq HTTP {e.response.status_code if e.response else ''}: {detail})"
-    except Exception as e:
-        return f"(Groq ошибка сети: {e})"
+def encode_cursor(ts: datetime, key) -> str:
+    raw = f"{ts.isoformat()}|{key}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
 
+def decode_cursor(cursor: str, key_type=int) -> tuple[datetime, object]:
     try:
-        raw = (data["choices"][0]["message"]["content"] or "").strip()
-        return clean_model_output(raw)
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        ts, key = raw.split("|", 1)
+        return datetime.fromisoformat(ts), key_type(key)
     except Exception:
-        return f"(Groq: неожиданный ответ {str(data)[:300]}...)"
-
-
-async def call_openrouter(
-    model: str,
-    messages: list[dict[str, str]],
-    temperature: float = TEMP_DEFAULT
-) -> str:
-    key = os.getenv("OPENROUTER_API_KEY", "")
-    if not key:
-        return "(Не задан OPENROUTER_API_KEY)"
-
-    url = f"{os.getenv('OPENROUTER_URL', 'https://openrouter.ai/api/v1')}/chat/completions"
-
-    # Нормализация ролей под OpenAI-стиль (OpenRouter его понимает)
-    norm_msgs = []
-    for m in messages:
-        role = (m.get("role") or "user").lower()
-        if role not in ("system", "user", "assistant"):
-            role = "user"
-        norm_msgs.append({"role": role, "content": m.get("content", "")})
-
-    payload = {
-        "model": model,  # напр. "openai/gpt-oss-20b"
-        "messages": norm_msgs,
-        "temperature": max(0.0, min(2.0, float(temperature))),
-    }
-
-    headers = {
-        "Authorization": f"Bearer {key}",
-        "Content-Type": "application/json",
-        # Рекомендуется OpenRouter (для rate limiting/идентификации клиента)
-        "HTTP-Referer": "http://localhost",
-        "X-Title": "Multi-Model Persona Chat",
-    }
-
-    try:
-        async with httpx.AsyncClient(timeout=60) as cli:
-            r = await cli.post(url, headers=headers, json=payload)
-            r.raise_for_status()
-            data = r.json()
-    except httpx.HTTPStatusError as e:
-        try:
-            detail = e.response.json()
-        except Exception:
-            detail = e.response.text if e.response is not None else str(e)
-        return f"(OpenRouter HTTP {e.response.status_code if e.response else ''}: {detail})"
-    except Exception as e:
-        return f"(OpenRouter ошибка сети: {e})"
+        raise HTTPException(400, "bad cursor")
 
-    try:
-        raw = (data["choices"][0]["message"]["content"] or "").strip()
-        return clean_model_output(raw)
-    except Exception:
-        return f"(OpenRouter: неожиданный ответ {str(data)[:300]}...)"
+def message_out(m: Message) -> MessageOut:
+    return MessageOut(
+        id=m.id, role=m.role, content=m.content, persona_id=m.persona_id,
+        created_at=m.created_at.isoformat(), cursor=encode_cursor(m.created_at, m.id),
+    )
 
+def archived_message_out(r: dict) -> MessageOut:
+    return MessageOut(
+        id=r["id"], role=r["role"], content=r["content"], persona_id=r.get("persona_id"),
+        created_at=r["created_at"].isoformat(), cursor=encode_cursor(r["created_at"], r["id"]),
+    )
 
+def thread_out(t: Thread, lite: bool = False, sort: str = "updated") -> ThreadOut:
+    ts = t.created_at if sort == "created" else t.updated_at
+    return ThreadOut(
+        id=t.id, persona_id=t.persona_id, model=t.model or "",
+        summary=None if lite else (t.summary or ""),
+        message_count=(t.message_count or 0) + (t.archived_count or 0), last_message_preview=t.last_message_preview or "",
+        created_at=t.created_at.isoformat() if t.created_at else None,
+        updated_at=t.updated_at.isoformat() if t.updated_at else None,
+        cursor=encode_cursor(ts, t.id) if ts else None,
+    )
 
+# === Streaming ===
+class ThinkFilter:
+    # вырезает <think>…</think> из потока дельт, теги могут быть разрезаны между чанками
+    OPEN, CLOSE = "<think>", "</think>"
+
+    def __init__(self):
+        self.buf = ""
+        self.inside = False
+
+    @staticmethod
+    def _partial_tail(buf: str, tag: str) -> int:
+        for n in range(min(len(tag) - 1, len(buf)), 0, -1):
+            if buf.endswith(tag[:n]):
+                return n
+        return 0
+
+    def feed(self, chunk: str) -> str:
+        self.buf += chunk
+        out = []
+        while True:
+            tag = self.CLOSE if self.inside else self.OPEN
+            i = self.buf.find(tag)
+            if i < 0:
+                keep = self._partial_tail(self.buf, tag)
+                if not self.inside:
+                    out.append(self.buf[:len(self.buf) - keep])
+                self.buf = self.buf[len(self.buf) - keep:]
+                return "".join(out)
+            if not self.inside:
+                out.append(self.buf[:i])
+            self.buf = self.buf[i + len(tag):]
+            self.inside = not self.inside
+
+    def flush(self) -> str:
+        rest = "" if self.inside else self.buf
+        self.buf = ""
+        return rest
+
+
+class TypingPacer:
+    # имитация печати: не блокирующий sleep в конце, а темп выдачи дельт (TYPE_SIM_CPS)
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.started = asyncio.get_running_loop().time()
+        self.chars = 0
+
+    async def pace(self, delta: str):
+        if not self.enabled:
+            return
+        self.chars += len(delta)
+        target_ms = TYPE_SIM_MIN_MS
+        if TYPE_SIM_CPS > 0:
+            target_ms = max(TYPE_SIM_MIN_MS, int(self.chars / TYPE_SIM_CPS * 1000))
+        target_ms = min(TYPE_SIM_MAX_MS, target_ms)
+        elapsed_ms = (asyncio.get_running_loop().time() - self.started) * 1000
+        if target_ms > elapsed_ms:
+            await asyncio.sleep((target_ms - elapsed_ms) / 1000.0)
+
+
+router = Router(providers.complete, providers.stream, known=lambda p: p in providers.names)
+summarizer = Summarizer(router.complete, keep_last=LAST_TURNS)
+# push-канал тредов: сообщения (в т.ч. отложенные deliver_at), «печатает», summary
+hub = ThreadHub(lambda m: message_out(m).model_dump())
+summarizer.on_update(hub.summary)
+
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def ensure_thread(s, inp: ChatIn):
+    # персона — из кэша, без запросов к БД; тред создаётся при первом сообщении
+    if prompt_cache.persona(s, inp.personaId) is None:
+        raise HTTPException(404, "persona not found")
+    if not s.get(Thread, inp.threadId):
+        s.add(Thread(id=inp.threadId, persona_id=inp.personaId, model=inp.model, summary=""))
+
+
+def build_context(s, inp: ChatIn) -> list[dict[str, str]]:
+    # собирает контекст для модели (в потоке run_db); входящие сообщения к этому моменту уже записаны
+    prompt = prompt_cache.system_prompt(s, inp.personaId)
+    if prompt is None:
+        raise HTTPException(404, "persona not found")
+    thread = s.get(Thread, inp.threadId)
+
+    # персона + global_prompt — байт-в-байт одинаковый префикс для всех ходов с этой персоной
+    # (кэш префикса у провайдера); всё, что меняется от хода к ходу, идёт после него
+    head = [
+        {"role": "system", "content": prompt, "cache_key": prefix_key(inp.personaId, prompt)},
+        {"role": "system", "content": f"Контекст: {thread.summary or 'пока пусто'}"},
+    ]
+    # история — сколько влезает в бюджет модели после системных сообщений и резерва под ответ
+    budget = context_budget(inp.model) - REPLY_RESERVE_TOKENS - sum(estimate_tokens(m["content"]) for m in head)
+    rows = shared_history(s, thread.id, budget, after_id=thread.summary_upto or 0)
+    # долгая память: похожие на вопрос реплики старше окна истории (memory.py); место — за счёт самых старых ходов
+    note = recall(s, thread.id, inp.message, rows[0][4] if rows else None)
+    if note:
+        head.append({"role": "system", "content": note})
+        rows = fit_history(rows, budget - estimate_tokens(note))
+    return head + [{"role": role, "content": content} for role, content, *_ in rows]
 
 
+@app.post("/api/chat", response_model=ChatOut)
+async def chat(
+    inp: ChatIn,
+    idempotency_key: Optional[str] = Header(None),
+    prefer: Optional[str] = Header(None),
+    mode: Optional[str] = Query(None, pattern="^(sync|async)$"),
+):
+    # mode=async (или Prefer: respond-async) — 202 с id задачи сразу после записи сообщения, ответ — GET /api/jobs/{id}
+    key = inp.idempotencyKey or idempotency_key
+    if mode == "async" or (mode is None and "respond-async" in (prefer or "")):
+        job = await submit_chat_job(inp, key)
+        return JSONResponse(job.model_dump(), status_code=202, headers={"Location": f"/api/jobs/{job.id}"})
+
+    span = start_span("chat")
+    span.attrs.update(thread=inp.threadId, model=inp.model)
+    outcome = "error"
+    try:
+        if not key:
+            out = await run_chat(inp)
+        else:
+            # ключ живёт в пространстве треда: одинаковые ключи разных тредов не пересекаются
+            tkey = f"{inp.threadId}:{key}"
+
+            async def turn() -> dict:
+                return (await run_chat(inp, key=tkey)).model_dump()
+
+            out = ChatOut(**await idempotency.run(tkey, turn))
+        outcome = "ok"
+        return out
+    finally:
+        span.finish(outcome=outcome)
+
+
+def job_out(j: dict) -> JobOut:
+    result = json.loads(j["result"]) if j.get("result") else {}
+    return JobOut(
+        id=j["id"], thread_id=j["thread_id"], status=j["status"], attempts=j["attempts"],
+        text=result.get("text"), error=j.get("error"),
+        created_at=j["created_at"].isoformat(), updated_at=j["updated_at"].isoformat(),
+    )
 
-async def call_ollama(model: str, messages: list[dict[str, str]], temperature: float = TEMP_DEFAULT) -> str:
-    url = f"{OLLAMA_URL}/api/chat"
-    payload = {
-        "model": model,
-        "messages": messages,
-        "stream": False,
-        "options": {
-            "temperature": max(0.0, min(2.0, float(temperature)))
-        }
-    }
-    async with httpx.AsyncClient(timeout=120) as cli:
-        r = await cli.post(url, json=payload)
-        r.raise_for_status()
-        data = r.json()
-        if isinstance(data, dict):
-            if data.get("message") and data["message"].get("content"):
-                return data["message"]["content"]
-            return data.get("response", "")
-        return "(пустой ответ ollama)"
 
+async def submit_chat_job(inp: ChatIn, key: Optional[str]) -> JobOut:
+    # сообщение пользователя и задача — одна транзакция: после 202 ход уже не потеряется при рестарте
+    jkey = f"{inp.threadId}:{key}" if key else None
 
+    def q(s):
+        if jkey:
+            existing = job_by_key(s, jkey)
+            if existing is not None:
+                return job_out(get_job(s, existing.id))
+        ensure_thread(s, inp)
+        m = Message(thread_id=inp.threadId, role="user", content=inp.message,
+                    tokens=estimate_tokens(inp.message), created_at=datetime.utcnow())
+        s.add(m)
+        s.flush()
+        job = enqueue(s, inp.threadId, inp.model_dump(), message_id=m.id, key=jkey)
+        return job_out(get_job(s, job.id))
 
-@app.post("/api/chat", response_model=ChatOut)
-async def chat(inp: ChatIn):
-    with session_scope() as s:
-        persona = s.get(Persona, inp.personaId)
-        if not persona:
-            raise HTTPException(404, "persona not found")
-        
-        global_prompt = get_setting(s, "global_prompt", "")
+    try:
+        out = await run_db(q)
+    except IntegrityError:
+        # тот же ключ пришёл параллельно — отдаём задачу победителя
+        out = await run_db(lambda s: job_out(get_job(s, job_by_key(s, jkey).id)))
+    jobs.notify()
+    return out
 
-        thread = s.get(Thread, inp.threadId)
-        if not thread:
-            thread = Thread(id=inp.threadId, persona_id=persona.id, model=inp.model, summary="")
-            s.add(thread)
-            s.flush()
 
-        # записываем входящее сообщение
-        s.add(Message(thread_id=thread.id, role="user", content=inp.message))
-        s.flush()
+async def chat_job(job: dict) -> dict:
+    # выполнение задачи воркером очереди: обычный ход, ответ коммитится до того, как задача станет done
+    inp = ChatIn(**json.loads(job["payload"]))
+
+    def answered(s):
+        # ответ новее сообщения задачи уже есть: прошлая попытка записала его и упала до _finish,
+        # или сообщение попало в контекст чужого хода — второй ответ не пишем
+        return s.execute(
+            select(Message.id, Message.content, Message.deliver_at)
+            .where(Message.thread_id == inp.threadId, Message.role == "assistant", Message.id > job["message_id"])
+            .order_by(Message.id).limit(1)
+        ).first()
+
+    async with turns.exclusive(inp.threadId):
+        row = await run_db(answered) if job.get("message_id") else None
+        if row is not None:
+            return ChatOut(
+                text=row.content, id=row.id, deliver_at=row.deliver_at.isoformat() if row.deliver_at else None,
+            ).model_dump()
+        try:
+            return (await answer_turn(inp, durable=True)).model_dump()
+        except HTTPException as e:
+            if e.status_code < 500:
+                raise JobFailed(e.detail)
+            raise
+
+
+async def run_chat(inp: ChatIn, coalesce: bool = True, key: Optional[str] = None) -> ChatOut:
+    with phase("thread"):
+        await run_db(ensure_thread, inp)
+    queued_at = time.perf_counter()
+
+    async def write_user() -> dict:
+        return {"messageId": await writer.add(inp.threadId, "user", inp.message, wait=True)}
+
+    async def write_incoming():
+        nonlocal queued_at
+        with phase("write_user"):
+            if key:
+                # повтор с ключом после неудачного хода: сообщение уже в истории, отвечаем на него
+                await idempotency.once(f"{key}:user", write_user)
+            else:
+                await write_user()
+        queued_at = time.perf_counter()
+
+    async def turn():
+        # ожидание своей очереди в треде
+        observe_phase("queue", time.perf_counter() - queued_at)
+        return await answer_turn(inp)
+
+    # ходы треда идут по очереди; сообщения, пришедшие пока тред занят, получат один общий ответ
+    return await turns.submit(
+        inp.threadId,
+        write_incoming,
+        turn,
+        # склеиваются только ходы с одинаковыми настройками ответа
+        key=(inp.personaId, inp.model, inp.temperature, inp.simulateTyping) if coalesce else None,
+    )
 
-        # собираем short-context последних LAST_TURNS
-        last_msgs = s.execute(
-            select(Message).where(Message.thread_id == thread.id).order_by(Message.created_at.desc()).limit(LAST_TURNS)
-        ).scalars().all()[::-1]
 
-        messages = [
-            {"role": "system", "content": system_prompt(persona, global_prompt)},
+async def answer_turn(inp: ChatIn, durable: bool = False) -> ChatOut:
+    with phase("context"):
+        messages = await run_db(build_context, inp)
+    hub.typing(inp.threadId, True)
+    written = False
+    try:
+        # вызываем модель вне транзакции
+        temp = inp.temperature if inp.temperature is not None else TEMP_DEFAULT
+        try:
+            with phase("provider"):
+                out_text = await router.complete(inp.model, messages, temp)
+        except ProviderError as e:
+            # ошибка провайдера — это ответ API, а не реплика ассистента: в историю не пишем
+            raise HTTPException(502, f"model unavailable: {e}")
+        should_simulate = TYPE_SIM_ENABLED if inp.simulateTyping is None else bool(inp.simulateTyping)
+        extra = {}
+        if should_simulate:
+            delay_ms = compute_typing_delay_ms(out_text)
+            if TYPE_SIM_MODE == "sleep":
+                with phase("typing"):
+                    await asyncio.sleep(delay_ms / 1000.0)
+            else:
+                # ход не держит ни запрос, ни воркер: строка скрыта до deliver_at, push.py выпустит её в срок
+                extra["deliver_at"] = datetime.utcnow() + timedelta(milliseconds=delay_ms)
+
+        # сохраняем ответ ассистента
+        with phase("write_reply"):
+            mid = await writer.add(inp.threadId, "assistant", out_text, wait=True if durable or extra else None, **extra)
+        written = True
+    finally:
+        # ответ записан — индикатор снимет push.py вместе с выпуском строки; иначе (ошибка, отмена) — сейчас
+        if not written:
+            hub.typing(inp.threadId, False)
+    hub.kick()
+    summarizer.notify(inp.threadId)
+    deliver_at = extra.get("deliver_at")
+    return ChatOut(text=out_text, id=mid, deliver_at=deliver_at.isoformat() if deliver_at else None)
+
+
+async def batch_reply(item: dict) -> dict:
+    # строка батча — обычный ход чата без имитации печати; повтор готовых строк отсекает
+    # --resume по файлу результатов, серверного кэша ответов по id строки нет: id не уникален между батчами.
+    # Тред по умолчанию — свой на прогон (runId от run_batch), иначе второй прогон продолжит треды первого
+    rid = str(item["id"])
+    inp = ChatIn(**{"threadId": f"batch-{item['runId']}-{rid}", **item, "simulateTyping": False})
+    out = (await run_chat(inp, coalesce=False)).model_dump()
+    out["messageId"] = out.pop("id")  # "id" в строке результата — id строки батча
+    return {"threadId": inp.threadId, **out}
+
+
+@app.post("/api/chat/batch")
+async def chat_batch(data: BatchIn):
+    # NDJSON: строка на каждый готовый результат (в порядке готовности), в конце — {"summary": ...}
+    progress = BatchProgress(len(data.items))
+
+    async def lines():
+        async for row in run_batch(data.items, batch_reply, data.limits, progress=progress):
+            yield json.dumps(row, ensure_ascii=False) + "\n"
+        yield json.dumps({"summary": progress.as_dict()}) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+def fanout_contexts(s, inp: FanoutIn) -> list[list[dict[str, str]]]:
+    # история треда читается один раз (под самый большой бюджет), дальше у каждой персоны — своя голова
+    # и своя обрезка. Реплики других персон для персоны — реплики собеседников: "Имя: текст" от user
+    thread = s.get(Thread, inp.threadId)
+    heads, budgets = [], []
+    for t in inp.targets:
+        prompt = prompt_cache.system_prompt(s, t.personaId)
+        head = [
+            {"role": "system", "content": prompt, "cache_key": prefix_key(t.personaId, prompt)},
             {"role": "system", "content": f"Контекст: {thread.summary or 'пока пусто'}"},
-        ] + [{"role": m.role, "content": m.content} for m in last_msgs]
+        ]
+        heads.append(head)
+        budgets.append(context_budget(t.model or inp.model) - REPLY_RESERVE_TOKENS - sum(estimate_tokens(m["content"]) for m in head))
+    rows = shared_history(s, thread.id, max(budgets), after_id=thread.summary_upto or 0)
+    names = {p.id: p.name for p in prompt_cache.personas(s)}
+    out = []
+    for t, head, budget in zip(inp.targets, heads, budgets):
+        history = []
+        for role, content, _, author, _ in fit_history(rows, budget):
+            author = author or thread.persona_id
+            if role == "assistant" and author != t.personaId:
+                history.append({"role": "user", "content": f"{names.get(author, author)}: {content}"})
+            else:
+                history.append({"role": role, "content": content})
+        out.append(head + history)
+    return out
 
-    # вызываем модель вне транзакции
-    vendor, model_name = split_provider(inp.model)
-    temp = inp.temperature if inp.temperature is not None else TEMP_DEFAULT
 
-    if vendor == "gemini":
-        out_text = await call_gemini(model_name, messages, temperature=temp)
-    elif vendor == "openrouter":
-        out_text = await call_openrouter(model_name, messages, temperature=temp)
-    elif vendor == "groq":
-        out_text = await call_groq(model_name, messages, temperature=temp)
-    else:
-        out_text = "(поддержаны: gemini:*, openrouter:*, groq:*)"
+@app.post("/api/chat/fanout")
+async def chat_fanout(inp: FanoutIn):
+    # одно сообщение — ответы нескольких персон (и/или моделей) в общем треде. Провайдеры вызываются
+    # параллельно с ограничением на провайдера (run_batch); NDJSON-строка на каждый ответ по готовности,
+    # в конце {"summary": ...}. Ответы пишутся в историю одной пачкой, в порядке targets
+    if not inp.targets or len(inp.targets) > FANOUT_MAX_TARGETS:
+        raise HTTPException(400, f"targets: from 1 to {FANOUT_MAX_TARGETS}")
+    first = inp.targets[0]
+
+    def check(s):
+        for t in inp.targets:
+            if prompt_cache.persona(s, t.personaId) is None:
+                raise HTTPException(404, f"persona not found: {t.personaId}")
+        ensure_thread(s, ChatIn(model=first.model or inp.model, personaId=first.personaId, message=inp.message, threadId=inp.threadId))
+    await run_db(check)
+    progress = BatchProgress(len(inp.targets))
+
+    async def reply(item: dict) -> dict:
+        t = inp.targets[int(item["id"])]
+        temp = next(x for x in (t.temperature, inp.temperature, TEMP_DEFAULT) if x is not None)
+        try:
+            text = await router.complete(item["model"], item["messages"], temp)
+        except ProviderError as e:
+            raise HTTPException(502, f"model unavailable: {e}")
+        return {"text": text}
+
+    async def save(replies: dict[int, dict]) -> list[int]:
+        rows = [
+            {"role": "assistant", "content": r["text"], "persona_id": r["personaId"]}
+            for _, r in sorted(replies.items())
+        ]
+        with phase("write_reply"):
+            ids = await writer.add_many(inp.threadId, rows, wait=True)
+        hub.kick()
+        summarizer.notify(inp.threadId)
+        return ids
+
+    async def lines():
+        replies: dict[int, dict] = {}
+        saved = False
+        try:
+            async with turns.exclusive(inp.threadId):
+                await writer.add(inp.threadId, "user", inp.message, wait=True)
+                hub.kick()
+                contexts = await run_db(fanout_contexts, inp)
+                items = [
+                    {"id": str(i), "model": t.model or inp.model, "messages": ctx}
+                    for i, (t, ctx) in enumerate(zip(inp.targets, contexts))
+                ]
+                async for row in run_batch(items, reply, inp.limits, progress=progress):
+                    i = int(row["id"])
+                    row = {**row, "personaId": inp.targets[i].personaId, "model": items[i]["model"]}
+                    if row["ok"]:
+                        replies[i] = row
+                    yield json.dumps(row, ensure_ascii=False) + "\n"
+                saved = True  # строки попадают в очередь writer сразу: повторно в finally не пишем
+                ids = await save(replies) if replies else []
+            yield json.dumps({"summary": {**progress.as_dict(), "ids": ids}}) + "\n"
+        finally:
+            # клиент отключился посреди ответа — уже полученные реплики всё равно сохраняем
+            if replies and not saved:
+                await asyncio.shield(save(replies))
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.post("/api/chat/stream")
+async def chat_stream(inp: ChatIn):
+    # тот же ход, что /api/chat, но дельты уходят клиенту как Server-Sent Events
+    await run_db(ensure_thread, inp)
+    temp = inp.temperature if inp.temperature is not None else TEMP_DEFAULT
     should_simulate = TYPE_SIM_ENABLED if inp.simulateTyping is None else bool(inp.simulateTyping)
-    if should_simulate:
-        delay_ms = compute_typing_delay_ms(out_text)
-        await asyncio.sleep(delay_ms / 1000.0)
 
+    async def events():
+        async with turns.exclusive(inp.threadId):
+            await writer.add(inp.threadId, "user", inp.message, wait=True)
+            hub.kick()
+            messages = await run_db(build_context, inp)
+            async for event in stream_turn(messages):
+                yield event
+
+    async def stream_turn(messages: list[dict[str, str]]):
+        pacer = TypingPacer(should_simulate)
+        think = ThinkFilter()
+        parts: list[str] = []
+        failed = False
+        try:
+            async for raw in router.stream(inp.model, messages, temp):
+                delta = think.feed(raw)
+                if not delta:
+                    continue
+                await pacer.pace(delta)
+                parts.append(delta)
+                yield sse_event("delta", {"text": delta})
+            tail = think.flush()
+            if tail:
+                parts.append(tail)
+                yield sse_event("delta", {"text": tail})
+            yield sse_event("done", {"text": clean_model_output("".join(parts))})
+        except ProviderError as e:
+            failed = True
+            yield sse_event("error", {"detail": f"model unavailable: {e}"})
+        finally:
+            # сохраняем собранный ответ, даже если клиент отключился посреди потока (но не оборванный ошибкой)
+            out_text = clean_model_output("".join(parts))
+            if out_text and not failed:
+                # wait: подписчики push-канала получают ответ сразу после коммита, а не со следующим опросом
+                await asyncio.shield(writer.add(inp.threadId, "assistant", out_text, wait=True))
+                hub.kick()
+                summarizer.notify(inp.threadId)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 
-    # сохраняем ответ ассистента
-    with session_scope() as s:
-        s.add(Message(thread_id=inp.threadId, role="assistant", content=out_text))
-    return ChatOut(text=out_text)
+# === Admin/CRUD endpoints ===
+@app.get("/api/threads", response_model=list[ThreadOut], response_model_exclude_none=True)
+async def list_threads(
+    sort: str = Query("updated", pattern="^(updated|created)$"),
+    before: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=THREADS_PAGE_MAX),
+    persona_id: Optional[str] = None,
+    lite: bool = False,
+):
+    # новые первыми по индексу (updated_at|created_at, id); следующая страница — before=<cursor последнего>.
+    # lite=1 — без summary (колонка даже не читается)
+    def q(s):
+        col = Thread.created_at if sort == "created" else Thread.updated_at
+        stmt = select(Thread).order_by(col.desc(), Thread.id.desc())
+        if lite:
+            stmt = stmt.options(defer(Thread.summary))
+        if persona_id:
+            stmt = stmt.where(Thread.persona_id == persona_id)
+        if before:
+            stmt = stmt.where(tuple_(col, Thread.id) < tuple_(*decode_cursor(before, str)))
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        return [thread_out(t, lite, sort) for t in s.execute(stmt).scalars()]
+    return await run_db(q)
+
+@app.get("/api/search", response_model=SearchOut)
+async def search(
+    q: str = Query(..., min_length=1),
+    scope: str = Query("messages", pattern="^(messages|personas)$"),
+    persona_id: Optional[str] = None,
+    thread_id: Optional[str] = None,
+    role: Optional[str] = None,
+    sort: str = Query("rank", pattern="^(rank|recent)$"),
+    limit: int = Query(20, ge=1, le=SEARCH_PAGE_MAX),
+    offset: int = Query(0, ge=0, le=SEARCH_MAX_OFFSET),
+    before: Optional[int] = None,
+):
+    def q_(s):
+        if scope == "personas":
+            rows = search_personas(s, q, limit)
+            return SearchOut(personas=[
+                PersonaHitOut(id=r["id"], name=r["name"], snippet=r["snippet"] or "", score=-r["rank"]) for r in rows
+            ])
+        rows = search_messages(s, q, persona_id, thread_id, role, sort, limit, offset, before)
+        out = SearchOut(messages=[
+            MessageHitOut(
+                id=r["id"], thread_id=r["thread_id"], persona_id=r["persona_id"], role=r["role"],
+                created_at=datetime.fromisoformat(str(r["created_at"])).isoformat(),
+                snippet=r["snippet"] or "", score=None if r["rank"] is None else -r["rank"],
+            ) for r in rows
+        ])
+        if len(rows) == limit:
+            if sort == "recent":
+                out.next_before = rows[-1]["id"]
+            elif offset + limit <= SEARCH_MAX_OFFSET:
+                out.next_offset = offset + limit
+        return out
 
+    try:
+        return await run_db(q_)
+    except OperationalError as e:
+        # нет FTS-таблиц (init_db.py не запускался или SQLite без FTS5)
+        raise HTTPException(503, f"search unavailable: {e.orig}")
+
+@app.get("/api/jobs/{job_id}", response_model=JobOut, response_model_exclude_none=True)
+async def get_job_result(job_id: str, wait: float = Query(0, ge=0, le=JOB_WAIT_MAX_S)):
+    # long-poll: ?wait=N держит запрос до N секунд, пока задача не завершится; незавершённая отдаётся как есть
+    j = await jobs.wait(job_id, wait)
+    if j is None:
+        raise HTTPException(404, "job not found")
+    return job_out(j)
+
+@app.get("/api/threads/{thread_id}/queue")
+async def get_thread_queue(thread_id: str):
+    # глубина очереди ходов треда в этом процессе
+    return {"depth": turns.depth(thread_id), "running": turns.running(thread_id)}
+
+def thread_validator(s, thread_id: str) -> Optional[tuple]:
+    # (version, modified_at) без загрузки строки треда в ORM; None — треда нет
+    row = s.execute(
+        select(Thread.version, func.coalesce(Thread.modified_at, Thread.updated_at)).where(Thread.id == thread_id)
+    ).first()
+    return tuple(row) if row else None
 
-# === Admin/CRUD endpoints ===
-@app.get("/api/threads", response_model=list[ThreadOut])
-def list_threads():
-    with session_scope() as s:
-        rows = s.execute(select(Thread)).scalars().all()
-        return [ThreadOut(
-            id=t.id, persona_id=t.persona_id, model=t.model or "", summary=t.summary or ""
-        ) for t in rows]
 
 @app.get("/api/threads/{thread_id}", response_model=ThreadOut)
-def get_thread(thread_id: str):
-    with session_scope() as s:
-        t = s.get(Thread, thread_id)
-        if not t: raise HTTPException(404, "thread not found")
-        return ThreadOut(
-            id=t.id, persona_id=t.persona_id, model=t.model or "", summary=t.summary or ""
-        )
+async def get_thread(thread_id: str, request: Request, response: Response):
+    def q(s):
+        v = thread_validator(s, thread_id)
+        if not v: raise HTTPException(404, "thread not found")
+        cached = conditional(request, response, etag("thread", thread_id, v[0]), v[1])
+        if cached is not None:
+            return cached
+        return thread_out(s.get(Thread, thread_id))
+    return await run_db(q)
 
 
 @app.get("/api/threads/{thread_id}/messages", response_model=list[MessageOut])
-def get_messages(thread_id: str):
-    with session_scope() as s:
-        rows = s.execute(select(Message).where(Message.thread_id==thread_id).order_by(Message.created_at)).scalars().all()
-        return [MessageOut(id=m.id, role=m.role, content=m.content, created_at=m.created_at.isoformat()) for m in rows]
+async def get_messages(
+    thread_id: str,
+    request: Request,
+    response: Response,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=MESSAGES_PAGE_MAX),
+):
+    # без параметров — вся история (как раньше); с курсорами/limit — страница по индексу (thread_id, created_at, id).
+    # Сообщения всегда в хронологическом порядке; ?limit=N без курсоров — последние N.
+    # Старый префикс истории может лежать в архиве (archive.py) — он дочитывается, только если страница до него доходит.
+    def q(s):
+        now = datetime.utcnow()
+        v = thread_validator(s, thread_id)
+        if v:
+            # видимая история меняется и без записи — когда наступает deliver_at: ближайший срок входит в ETag,
+            # Last-Modified не старше последнего выпущенного ответа, а пока выпуск ждёт — не отдаём его вовсе
+            # (секундная точность If-Modified-Since не отличит ответ до срока от ответа после)
+            pending = s.execute(
+                select(func.min(Message.deliver_at)).where(Message.thread_id == thread_id, Message.deliver_at > now)
+            ).scalar()
+            modified = None
+            if pending is None:
+                released = s.execute(
+                    select(func.max(Message.deliver_at)).where(Message.thread_id == thread_id, Message.deliver_at <= now)
+                ).scalar()
+                modified = max(v[1], released) if v[1] and released else v[1] or released
+            cached = conditional(request, response, etag("messages", thread_id, v[0], pending), modified)
+            if cached is not None:
+                return cached
+        # ответы, ещё «печатающиеся» (deliver_at в будущем), не показываем
+        stmt = select(Message).where(Message.thread_id == thread_id, delivered(now))
+        key = tuple_(Message.created_at, Message.id)
+        lo = decode_cursor(after) if after else None
+        hi = decode_cursor(before) if before else None
+        if hi:
+            stmt = stmt.where(key < tuple_(*hi))
+        if lo:
+            stmt = stmt.where(key > tuple_(*lo))
+        newest_first = limit is not None and not after
+        if newest_first:
+            stmt = stmt.order_by(Message.created_at.desc(), Message.id.desc())
+        else:
+            stmt = stmt.order_by(Message.created_at, Message.id)
+        if limit is not None:
+            stmt = stmt.limit(limit)
+        rows = [message_out(m) for m in s.execute(stmt).scalars()]
+        if newest_first:
+            rows = rows[::-1]
+
+        t = s.get(Thread, thread_id)
+        if t is None or not t.archived_count:
+            return rows
+        boundary = (t.archived_until, t.archived_until_id)
+        if newest_first and len(rows) >= limit:
+            return rows  # страница целиком из горячих строк
+        if lo and lo >= boundary:
+            return rows  # курсор уже за архивом
+        cold = [
+            archived_message_out(r) for r in read_archive(t)
+            if (lo is None or (r["created_at"], r["id"]) > lo) and (hi is None or (r["created_at"], r["id"]) < hi)
+        ]
+        if newest_first:
+            return cold[max(0, len(cold) - (limit - len(rows))):] + rows
+        rows = cold + rows
+        return rows[:limit] if limit is not None else rows
+    return await run_db(q)
+
+@app.websocket("/ws/threads/{thread_id}")
+async def thread_events(ws: WebSocket, thread_id: str, after: Optional[int] = None):
+    # события треда: {"type": "message"|"typing"|"summary"|"message_deleted"|"overflow", ...};
+    # ?after=<id последнего полученного сообщения> — при переподключении дослать пропущенное
+    await ws.accept()
+    async with hub.subscribe(thread_id, after) as events:
+        async def pump():
+            while True:
+                event = await events.get()
+                if event is None:
+                    await ws.close()
+                    return
+                await ws.send_json(event)
+
+        sender = asyncio.create_task(pump())
+        try:
+            # входящие кадры не нужны — ждём отключения клиента (после ws.close() сервером тоже придёт disconnect)
+            while True:
+                await ws.receive_text()
+        except WebSocketDisconnect:
+            pass
+        finally:
+            sender.cancel()
 
 @app.get("/api/system", response_model=SystemConfigOut)
-def get_system_config():
-    with session_scope() as s:
-        gp = get_setting(s, "global_prompt", "")
+async def get_system_config(request: Request, response: Response):
+    def q(s):
+        version, loaded_at = prompt_cache.validator(s)
+        cached = conditional(request, response, etag("system", version), loaded_at)
+        if cached is not None:
+            return cached
+        gp = prompt_cache.setting(s, "global_prompt", "")
         return SystemConfigOut(global_prompt=gp)
+    return await run_db(q)
 
 @app.patch("/api/system", response_model=SystemConfigOut)
-def update_system_config(data: SystemConfigIn):
-    with session_scope() as s:
+async def update_system_config(data: SystemConfigIn):
+    def q(s):
         set_setting(s, "global_prompt", data.global_prompt or "")
+        prompt_cache.bump(s)
         gp = get_setting(s, "global_prompt", "")
         return SystemConfigOut(global_prompt=gp)
+    out = await run_db(q)
+    prompt_cache.invalidate()
+    return out
 
 @app.patch("/api/threads/{thread_id}")
-def update_thread(thread_id: str, inp: ThreadUpdateIn):
-    with session_scope() as s:
+async def update_thread(thread_id: str, inp: ThreadUpdateIn):
+    def q(s):
         t = s.get(Thread, thread_id)
         if not t: raise HTTPException(404, "thread not found")
         if inp.persona_id is not None:
@@ -458,38 +976,54 @@ def update_thread(thread_id: str, inp: ThreadUpdateIn):
         if inp.summary is not None:
             t.summary = inp.summary
         return {"ok": True}
+    out = await run_db(q)
+    if inp.summary is not None:
+        hub.summary(thread_id, inp.summary)
+    return out
 
 @app.delete("/api/messages/{msg_id}")
-def delete_message(msg_id: int):
-    with session_scope() as s:
-        res = s.execute(delete(Message).where(Message.id==msg_id))
-        if res.rowcount == 0:
+async def delete_message(msg_id: int):
+    def q(s):
+        thread_id = s.execute(delete(Message).where(Message.id==msg_id).returning(Message.thread_id)).scalar()
+        if thread_id is None:
             raise HTTPException(404, "message not found")
-        return {"ok": True}
+        return thread_id
+    hub.message_deleted(await run_db(q), msg_id)
+    return {"ok": True}
     
 # === Personas API ===
 @app.get("/api/personas", response_model=list[PersonaOut])
-def list_personas():
-    with session_scope() as s:
-        rows = s.execute(select(Persona)).scalars().all()
+async def list_personas(request: Request, response: Response):
+    def q(s):
+        version, loaded_at = prompt_cache.validator(s)
+        cached = conditional(request, response, etag("personas", version), loaded_at)
+        if cached is not None:
+            return cached
+        rows = prompt_cache.personas(s)
         return [PersonaOut(
             id=p.id, name=p.name, bio=p.bio, style=p.style,
             boundaries=p.boundaries, goals=p.goals or ""
         ) for p in rows]
+    return await run_db(q)
 
 @app.get("/api/personas/{pid}", response_model=PersonaOut)
-def get_persona(pid: str):
-    with session_scope() as s:
-        p = s.get(Persona, pid)
+async def get_persona(pid: str, request: Request, response: Response):
+    def q(s):
+        version, loaded_at = prompt_cache.validator(s)
+        p = prompt_cache.persona(s, pid)
         if not p: raise HTTPException(404, "persona not found")
+        cached = conditional(request, response, etag("persona", pid, version), loaded_at)
+        if cached is not None:
+            return cached
         return PersonaOut(
             id=p.id, name=p.name, bio=p.bio, style=p.style,
             boundaries=p.boundaries, goals=p.goals or ""
         )
+    return await run_db(q)
 
 @app.patch("/api/personas/{pid}", response_model=PersonaOut)
-def update_persona(pid: str, data: PersonaIn):
-    with session_scope() as s:
+async def update_persona(pid: str, data: PersonaIn):
+    def q(s):
         p = s.get(Persona, pid)
         if not p: raise HTTPException(404, "persona not found")
         p.name = data.name
@@ -497,48 +1031,88 @@ def update_persona(pid: str, data: PersonaIn):
         p.style = data.style
         p.boundaries = data.boundaries
         p.goals = data.goals  # строка CSV
+        prompt_cache.bump(s)
         s.flush()
         return PersonaOut(
             id=p.id, name=p.name, bio=p.bio, style=p.style,
             boundaries=p.boundaries, goals=p.goals or ""
         )
+    out = await run_db(q)
+    prompt_cache.invalidate()
+    return out
     
 @app.get("/api/personas/{pid}/system_prompt")
-def get_persona_system_prompt(pid: str):
-    with session_scope() as s:
-        p = s.get(Persona, pid)
-        if not p:
+async def get_persona_system_prompt(pid: str, request: Request, response: Response):
+    def q(s):
+        version, loaded_at = prompt_cache.validator(s)
+        if prompt_cache.persona(s, pid) is None:
             raise HTTPException(404, "persona not found")
-        gp = get_setting(s, "global_prompt", "")
-        return SystemPromptOut(prompt=system_prompt(p, gp))
+        cached = conditional(request, response, etag("system_prompt", pid, version), loaded_at)
+        if cached is not None:
+            return cached
+        prompt = prompt_cache.system_prompt(s, pid)
+        return SystemPromptOut(prompt=prompt)
+    return await run_db(q)
 
 
 @app.delete("/api/threads/{thread_id}")
-def delete_thread(thread_id: str):
-    with session_scope() as s:
-        # сначала удаляем сообщения треда
-        s.execute(delete(Message).where(Message.thread_id == thread_id))
+async def delete_thread(thread_id: str):
+    def q(s):
         t = s.get(Thread, thread_id)
-        if not t:
+        if t is None:
             raise HTTPException(404, "thread not found")
-        s.delete(t)
+        if t.archived_count:
+            forget_archived(s, t)
+        # сначала строка треда (Core delete, без загрузки relationship): триггер статистики
+        # на каждое удалённое сообщение тогда ничего не обновляет
+        s.execute(delete(Thread).where(Thread.id == thread_id))
+        s.execute(delete(Message).where(Message.thread_id == thread_id))
         return {"ok": True}
+    await run_db(q)
+    drop_archive(thread_id)
+    drop_memory(thread_id)
+    return {"ok": True}
     
 @app.get("/api/threads/{thread_id}/system_messages")
-def get_thread_system_messages(thread_id: str):
-    with session_scope() as s:
+async def get_thread_system_messages(thread_id: str):
+    def q(s):
         t = s.get(Thread, thread_id)
         if not t:
             raise HTTPException(404, "thread not found")
-        p = s.get(Persona, t.persona_id)
-        if not p:
+        prompt = prompt_cache.system_prompt(s, t.persona_id)
+        if prompt is None:
             raise HTTPException(404, "persona not found")
         return {
             "messages": [
-                {"role": "system", "content": system_prompt(p)},
+                {"role": "system", "content": prompt},
                 {"role": "system", "content": f"Контекст: {t.summary or 'пока пусто'}"},
             ]
         }
+    return await run_db(q)
+
+
+# === Export / import ===
+@app.get("/api/export")
+async def export_data(since: Optional[datetime] = None, gzip: bool = False):
+    # потоковая NDJSON-выгрузка (см. dump.py); since — инкрементальная копия изменённого после момента
+    stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+    filename = f"chat-export-{stamp}.ndjson" + (".gz" if gzip else "")
+    return StreamingResponse(
+        export_ndjson(naive_utc(since), gzip),
+        media_type="application/gzip" if gzip else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"', "Cache-Control": "no-cache"},
+    )
 
-
-
+@app.post("/api/import")
+async def import_data(request: Request, on_conflict: str = Query("skip", pattern=f"^({'|'.join(CONFLICT_MODES)})$")):
+    # тело — NDJSON или NDJSON.gz, читается потоком; каждая пачка — своя транзакция,
+    # при ошибке уже записанные пачки остаются
+    try:
+        stats = await import_ndjson(request.stream(), on_conflict)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    except IntegrityError as e:
+        raise HTTPException(409, f"conflict: {e.orig}")
+    finally:
+        prompt_cache.invalidate()
+    return stats
@@ -0,0 +1,148 @@
+from __future__ import annotations
+import os
+import asyncio
+import logging
+from typing import Awaitable, Callable, Optional
+from sqlalchemy import select, tuple_, update
+
+from db import run_db
+from models import Message, Thread
+
+# Фоновая инкрементальная свёртка старых сообщений треда в Thread.summary.
+# Сообщения, выпавшие из окна контекста, дешёвой моделью дописываются в summary;
+# Thread.summary_upto — id последнего свёрнутого сообщения, чтобы каждое сворачивалось один раз.
+
+SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "1") == "1"
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", "groq:llama-3.1-8b-instant")
+SUMMARY_TRIGGER = int(os.getenv("SUMMARY_TRIGGER", "8"))  # сколько выпавших сообщений копить до свёртки
+SUMMARY_BATCH_MAX = int(os.getenv("SUMMARY_BATCH_MAX", "60"))
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", "2"))
+SUMMARY_MAX_CHARS = int(os.getenv("SUMMARY_MAX_CHARS", "1500"))
+SUMMARY_TEMPERATURE = float(os.getenv("SUMMARY_TEMPERATURE", "0.2"))
+
+SUMMARY_PROMPT = (
+    "Ты ведёшь краткую память переписки. Обнови сводку с учётом новых сообщений: "
+    "сохрани факты о собеседнике (имя, занятия, планы, предпочтения), договорённости, "
+    "важные темы и настроение разговора. Старое не выбрасывай без причины. "
+    f"Пиши по-русски, сжато, не длиннее {SUMMARY_MAX_CHARS} символов, без вступлений и пояснений."
+)
+
+ROLE_LABELS = {"user": "Собеседник", "assistant": "Персона"}
+
+log = logging.getLogger(__name__)
+
+
+def _pending_batch(s, thread_id: str, keep_last: int):
+    t = s.get(Thread, thread_id)
+    if not t:
+        return None
+    # граница окна контекста: keep_last-е с конца сообщение, всё что старше — выпало из контекста
+    boundary = s.execute(
+        select(Message.created_at, Message.id)
+        .where(Message.thread_id == thread_id)
+        .order_by(Message.created_at.desc(), Message.id.desc())
+        .offset(max(keep_last, 1) - 1)
+        .limit(1)
+    ).first()
+    if boundary is None:
+        return None
+    rows = s.execute(
+        select(Message.id, Message.role, Message.content)
+        .where(
+            Message.thread_id == thread_id,
+            Message.id > (t.summary_upto or 0),
+            tuple_(Message.created_at, Message.id) < tuple_(*boundary),
+        )
+        .order_by(Message.created_at, Message.id)
+        .limit(SUMMARY_BATCH_MAX)
+    ).all()
+    if len(rows) < SUMMARY_TRIGGER:
+        return None
+    return t.summary or "", t.summary_upto or 0, [tuple(r) for r in rows]
+
+
+def _store_summary(s, thread_id: str, summary: str, upto: int, prev_upto: int) -> bool:
+    # compare-and-set: если другой воркер уже сдвинул high-water mark, ничего не пишем
+    res = s.execute(
+        update(Thread)
+        .where(Thread.id == thread_id, Thread.summary_upto == prev_upto)
+        .values(summary=summary, summary_upto=upto)
+    )
+    return res.rowcount > 0
+
+
+class Summarizer:
+    def __init__(
+        self,
+        call: Callable[[str, list[dict[str, str]], float], Awaitable[str]],
+        keep_last: int,
+    ):
+        self._call = call
+        self.keep_last = keep_last
+        self._queue: Optional[asyncio.Queue] = None
+        self._pending: set[str] = set()
+        self._workers: list[asyncio.Task] = []
+        self._listeners: list[Callable[[str, str], None]] = []
+
+    def on_update(self, fn: Callable[[str, str], None]):
+        # fn(thread_id, summary) — после коммита новой сводки
+        self._listeners.append(fn)
+
+    async def start(self):
+        if not SUMMARY_ENABLED or self._workers:
+            return
+        self._queue = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(max(1, SUMMARY_CONCURRENCY))]
+
+    async def stop(self):
+        workers, self._workers = self._workers, []
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        self._pending.clear()
+
+    def notify(self, thread_id: str):
+        # дёшево: без запросов к БД; один тред в очереди не больше одного раза
+        if not self._workers or thread_id in self._pending:
+            return
+        self._pending.add(thread_id)
+        self._queue.put_nowait(thread_id)
+
+    async def _worker(self):
+        while True:
+            thread_id = await self._queue.get()
+            try:
+                # после свёртки пачки могли остаться ещё выпавшие — крутим, пока есть что сворачивать
+                while await self.summarize(thread_id):
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("summarize failed for thread %s", thread_id)
+            finally:
+                self._pending.discard(thread_id)
+
+    async def summarize(self, thread_id: str) -> bool:
+        job = await run_db(_pending_batch, thread_id, self.keep_last)
+        if job is None:
+            return False
+        summary, prev_upto, rows = job
+        transcript = "\n".join(f"{ROLE_LABELS.get(role, role)}: {content}" for _, role, content in rows)
+        messages = [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": f"Текущая сводка:\n{summary or 'пусто'}\n\nНовые сообщения:\n{transcript}"},
+        ]
+        try:
+            out = (await self._call(SUMMARY_MODEL, messages, SUMMARY_TEMPERATURE)).strip()
+        except Exception as e:
+            # ошибка модели никогда не попадает в summary; тред свернётся на следующем ходе
+            log.warning("summary model failed for thread %s: %s", thread_id, e)
+            return False
+        if not out:
+            return False
+        summary = out[:SUMMARY_MAX_CHARS]
+        stored = await run_db(_store_summary, thread_id, summary, rows[-1][0], prev_upto)
+        if stored:
+            for fn in self._listeners:
+                fn(thread_id, summary)
+        return stored
@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# модули сервера лежат плоско в server/ и импортируются по имени, как при запуске uvicorn из этой папки
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# отдельная база на прогон: DB_PATH читается при импорте db
+os.environ.setdefault("DB_PATH", os.path.join(tempfile.mkdtemp(prefix="chat-tests-"), "chat.db"))
+os.environ.setdefault("GROQ_API_KEY", "test")
@@ -0,0 +1,66 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import func, select, update
+
+import archive
+import init_db
+import server
+from db import session_scope
+from models import ArchivedMessage, Message, Thread
+from search import search_messages
+
+PERSONA = init_db.DEFAULT_PERSONAS[0]["id"]
+
+
+@pytest.fixture
+def archived_thread(monkeypatch):
+    init_db.main()
+    monkeypatch.setattr(archive, "ARCHIVE_IDLE_DAYS", 1)
+    monkeypatch.setattr(archive, "ARCHIVE_KEEP_LAST", 1)
+    monkeypatch.setattr(archive, "ARCHIVE_REQUIRE_SUMMARY", False)
+    old = datetime.utcnow() - timedelta(days=30)
+    with session_scope() as s:
+        s.add(Thread(id="arch-1", persona_id=PERSONA, model="groq:test"))
+        s.flush()
+        s.add_all([
+            Message(thread_id="arch-1", role="user", content="где купить квазиутку недорого", tokens=5, created_at=old),
+            Message(thread_id="arch-1", role="assistant", content="квазиутки бывают разные", tokens=5, created_at=old),
+            Message(thread_id="arch-1", role="user", content="спасибо", tokens=2, created_at=old),
+        ])
+        s.flush()
+        s.execute(update(Thread).where(Thread.id == "arch-1").values(updated_at=old))
+    with session_scope() as s:
+        assert archive.archive_thread(s, "arch-1") == 2
+    yield "arch-1"
+    with session_scope() as s:
+        exists = s.get(Thread, "arch-1") is not None
+    if exists:
+        asyncio.run(server.delete_thread("arch-1"))
+
+
+def test_archive_moves_prefix_to_cold_storage(archived_thread):
+    with session_scope() as s:
+        hot = s.execute(select(Message.content).where(Message.thread_id == archived_thread)).scalars().all()
+        t = s.get(Thread, archived_thread)
+        cold = [r["content"] for r in archive.read_archive(t)]
+        counts = t.archived_count, t.message_count
+    assert hot == ["спасибо"]
+    assert cold == ["где купить квазиутку недорого", "квазиутки бывают разные"]
+    assert counts == (2, 1)
+
+
+def test_archived_messages_stay_searchable(archived_thread):
+    with session_scope() as s:
+        hits = search_messages(s, "квазиутк")
+    assert {h["thread_id"] for h in hits} == {archived_thread}
+    assert sorted(h["role"] for h in hits) == ["assistant", "user"]
+    assert any("<mark>квазиутку</mark>" in h["snippet"] for h in hits)
+
+
+def test_deleting_thread_drops_archived_search_rows(archived_thread):
+    asyncio.run(server.delete_thread(archived_thread))
+    with session_scope() as s:
+        assert search_messages(s, "квазиутк") == []
+        assert s.scalar(select(func.count()).select_from(ArchivedMessage)) == 0
@@ -0,0 +1,69 @@
+import asyncio
+import json
+
+from batch import _done_ids, run_batch
+
+
+def _collect(items, reply, skip=frozenset()):
+    async def go():
+        return [row async for row in run_batch(items, reply, skip=skip)]
+    return asyncio.run(go())
+
+
+def test_reply_id_does_not_replace_item_id():
+    async def reply(item):
+        return {"id": 1000 + int(item["id"]), "text": "ok"}
+
+    rows = _collect([{"id": "1"}, {"id": "2"}], reply)
+    assert sorted(r["id"] for r in rows) == ["1", "2"]
+
+
+def test_resume_skips_finished_items(tmp_path):
+    seen = []
+
+    async def reply(item):
+        seen.append(item["id"])
+        if item["id"] == "b":
+            raise RuntimeError("boom")
+        return {"id": 42, "text": item["id"]}
+
+    items = [{"id": "a"}, {"id": "b"}, {"id": "c"}]
+    out = tmp_path / "results.jsonl"
+    with open(out, "w", encoding="utf-8") as f:
+        for row in _collect(items, reply):
+            f.write(json.dumps(row) + "\n")
+
+    done = _done_ids(str(out))
+    assert done == {"a", "c"}
+
+    seen.clear()
+    _collect(items, reply, skip=done)
+    assert seen == ["b"]
+
+
+def test_reply_gets_a_fresh_run_id_per_batch():
+    seen = []
+
+    async def reply(item):
+        seen.append(item["runId"])
+        return {"text": "ok"}
+
+    _collect([{"id": "1"}, {"id": "2"}], reply)
+    _collect([{"id": "1"}], reply)
+    assert seen[0] == seen[1] != seen[2]
+
+
+def test_batch_threads_do_not_collide_across_runs(monkeypatch):
+    import server
+
+    threads = []
+
+    async def run_chat(inp, coalesce=True, key=None):
+        threads.append(inp.threadId)
+        return server.ChatOut(text="ok", id=1)
+
+    monkeypatch.setattr(server, "run_chat", run_chat)
+    item = {"id": "1", "model": "groq:test", "personaId": "p", "message": "вопрос"}
+    _collect([item], server.batch_reply)
+    _collect([item], server.batch_reply)
+    assert len(set(threads)) == 2
@@ -0,0 +1,43 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+import bench
+import mock_llm
+
+
+@pytest.fixture
+def mock(monkeypatch):
+    monkeypatch.setattr(mock_llm, "cfg", mock_llm.MockConfig(latency_ms=0, jitter_ms=0, tokens_per_s=0, reply="раз два три"))
+    with TestClient(mock_llm.app) as c:
+        yield c
+
+
+def test_openai_stream_reassembles_reply(mock):
+    r = mock.post("/openai/v1/chat/completions", json={"model": "m", "stream": True, "messages": []})
+    lines = [l.removeprefix("data: ") for l in r.text.split("\n\n") if l]
+    assert lines[-1] == "[DONE]"
+    assert "".join(json.loads(l)["choices"][0]["delta"]["content"] for l in lines[:-1]) == "раз два три"
+
+
+def test_ollama_ndjson_ends_with_done(mock):
+    rows = [json.loads(l) for l in mock.post("/api/chat", json={"model": "m", "messages": []}).text.splitlines()]
+    assert "".join(r["message"]["content"] for r in rows) == "раз два три"
+    assert rows[-1]["done"] and not any(r["done"] for r in rows[:-1])
+
+
+def test_injected_errors_follow_config(mock):
+    mock.patch("/__mock/config", json={"error_rate": 1, "error_status": 429})
+    assert mock.post("/v1beta/models/x:generateContent", json={}).status_code == 429
+    assert mock.get("/__mock/stats").json()["errors"] >= 1
+
+
+def test_compare_flags_regressions_against_baseline(tmp_path):
+    base = tmp_path / "baseline.json"
+    base.write_text(json.dumps([{"size": 1000, "scenario": "chat", "p95": 100, "rps": 50}]))
+    ok = [{"size": 1000, "scenario": "chat", "p95": 110, "rps": 48}]
+    slow = [{"size": 1000, "scenario": "chat", "p95": 150, "rps": 30}]
+    assert bench.compare(ok, str(base), 0.2) == []
+    assert len(bench.compare(slow, str(base), 0.2)) == 2
+    assert bench.percentile([5, 1, 3, 2, 4], 0.5) == 3
@@ -0,0 +1,74 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import func, select
+
+import init_db
+import server
+from db import session_scope
+from idempotency import IdempotencyStore
+from models import Message
+from router import ProviderError
+
+PERSONA = init_db.DEFAULT_PERSONAS[0]["id"]
+
+
+@pytest.fixture(scope="module")
+def client():
+    init_db.main()
+    with TestClient(server.app) as c:
+        yield c
+
+
+def _user_messages(thread_id: str) -> int:
+    with session_scope() as s:
+        return s.scalar(
+            select(func.count()).select_from(Message).where(Message.thread_id == thread_id, Message.role == "user")
+        )
+
+
+def test_retry_with_same_key_writes_user_message_once(client, monkeypatch):
+    calls = []
+
+    async def complete(model, messages, temperature):
+        calls.append(messages)
+        if len(calls) < 3:
+            raise ProviderError("groq", "upstream 503", status=503, retryable=True)
+        return "ответ"
+
+    monkeypatch.setattr(server.router, "complete", complete)
+    body = {"threadId": "retry-1", "model": "groq:test", "personaId": PERSONA, "message": "привет",
+            "simulateTyping": False, "idempotencyKey": "k1"}
+    assert client.post("/api/chat", json=body).status_code == 502
+    assert client.post("/api/chat", json=body).status_code == 502
+    res = client.post("/api/chat", json=body)
+    assert res.status_code == 200 and res.json()["text"] == "ответ"
+    assert _user_messages("retry-1") == 1
+    assert [m["content"] for m in calls[-1] if m["role"] == "user"] == ["привет"]
+
+    # ключ отработал: повтор отдаёт сохранённый ответ без провайдера и новых записей
+    assert client.post("/api/chat", json=body).json()["text"] == "ответ"
+    assert len(calls) == 3 and _user_messages("retry-1") == 1
+
+
+def test_leader_disconnect_does_not_cancel_duplicates(client):
+    async def go():
+        store = IdempotencyStore()
+        release = asyncio.Event()
+
+        async def fn():
+            await release.wait()
+            return {"text": "готово"}
+
+        leader = asyncio.create_task(store.run("t:dup", fn))
+        await asyncio.sleep(0.01)
+        dup = asyncio.create_task(store.run("t:dup", fn))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        await asyncio.sleep(0.01)
+        release.set()
+        return await dup, leader.cancelled(), store.inflight
+
+    result, leader_cancelled, inflight = asyncio.run(go())
+    assert result == {"text": "готово"} and leader_cancelled and inflight == 0
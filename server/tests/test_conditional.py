@@ -0,0 +1,59 @@
+import time
+from datetime import datetime
+
+import pytest
+from fastapi.testclient import TestClient
+
+import init_db
+import server
+
+PERSONA = init_db.DEFAULT_PERSONAS[0]["id"]
+
+
+@pytest.fixture(scope="module")
+def client():
+    init_db.main()
+    with TestClient(server.app) as c:
+        yield c
+
+
+def _body(thread_id: str, **extra) -> dict:
+    return {"threadId": thread_id, "model": "groq:test", "personaId": PERSONA, "message": "привет", **extra}
+
+
+@pytest.fixture
+def reply(monkeypatch):
+    async def complete(model, messages, temperature):
+        return "ответ"
+
+    monkeypatch.setattr(server.router, "complete", complete)
+
+
+def test_unchanged_history_is_not_modified(client, reply):
+    client.post("/api/chat", json=_body("cond-1", simulateTyping=False))
+    first = client.get("/api/threads/cond-1/messages")
+    tag, modified = first.headers["etag"], first.headers["last-modified"]
+    assert client.get("/api/threads/cond-1/messages", headers={"If-None-Match": tag}).status_code == 304
+    assert client.get("/api/threads/cond-1/messages", headers={"If-Modified-Since": modified}).status_code == 304
+    # новая запись меняет валидатор
+    client.post("/api/chat", json=_body("cond-1", simulateTyping=False))
+    again = client.get("/api/threads/cond-1/messages", headers={"If-None-Match": tag})
+    assert again.status_code == 200 and len(again.json()) == 4
+
+
+def test_reply_released_by_deliver_at_is_not_hidden_by_304(client, reply, monkeypatch):
+    monkeypatch.setattr(server, "TYPE_SIM_MODE", "schedule")
+    out = client.post("/api/chat", json=_body("cond-2", simulateTyping=True)).json()
+    first = client.get("/api/threads/cond-2/messages")
+    assert [m["role"] for m in first.json()] == ["user"]
+    # пока ответ ждёт срока, Last-Modified нет — If-Modified-Since не спрячет его выпуск
+    assert "last-modified" not in first.headers
+    wait = (datetime.fromisoformat(out["deliver_at"]) - datetime.utcnow()).total_seconds()
+    time.sleep(max(wait, 0) + 0.05)
+    # ни одной записи после выпуска, но валидатор другой
+    after = client.get("/api/threads/cond-2/messages", headers={"If-None-Match": first.headers["etag"]})
+    assert after.status_code == 200
+    assert [m["role"] for m in after.json()] == ["user", "assistant"]
+    assert client.get(
+        "/api/threads/cond-2/messages", headers={"If-Modified-Since": after.headers["last-modified"]}
+    ).status_code == 304
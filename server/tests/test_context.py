@@ -0,0 +1,44 @@
+from sqlalchemy import update
+
+import init_db
+import server
+from db import session_scope
+from models import Message, Thread
+
+PERSONA = init_db.DEFAULT_PERSONAS[0]["id"]
+
+
+def test_context_skips_messages_folded_into_summary():
+    init_db.main()
+    with session_scope() as s:
+        s.add(Thread(id="ctx-summary", persona_id=PERSONA, model="groq:test"))
+        s.flush()
+        msgs = [
+            Message(thread_id="ctx-summary", role="user" if i % 2 == 0 else "assistant", content=f"реплика {i}", tokens=8)
+            for i in range(10)
+        ]
+        s.add_all(msgs)
+        s.flush()
+        s.execute(update(Thread).where(Thread.id == "ctx-summary").values(summary="свёрнуто", summary_upto=msgs[5].id))
+
+    inp = server.ChatIn(model="groq:test", personaId=PERSONA, message="реплика 9", threadId="ctx-summary")
+    with session_scope() as s:
+        context = server.build_context(s, inp)
+    history = [m["content"] for m in context if m["role"] != "system"]
+    assert history == [f"реплика {i}" for i in range(6, 10)]
+    assert any(m["content"] == "Контекст: свёрнуто" for m in context)
+
+
+def test_history_fits_token_budget_newest_first():
+    from context import estimate_tokens, fit_history, shared_history
+
+    init_db.main()
+    with session_scope() as s:
+        s.add(Thread(id="ctx-budget", persona_id=PERSONA, model="groq:test"))
+        s.flush()
+        s.add_all([Message(thread_id="ctx-budget", role="user", content=f"m{i}", tokens=10) for i in range(6)])
+    with session_scope() as s:
+        rows = shared_history(s, "ctx-budget", budget=35)
+    assert [r[1] for r in rows] == ["m3", "m4", "m5"]
+    assert [r[1] for r in fit_history(rows, 20)] == ["m4", "m5"]
+    assert estimate_tokens("привет мир") < estimate_tokens("привет мир" * 10)
@@ -0,0 +1,57 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import init_db
+from db import run_db
+from models import Setting
+
+
+def test_run_db_keeps_event_loop_free():
+    def slow(s):
+        time.sleep(0.3)
+        return threading.current_thread().name
+
+    async def go():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.create_task(tick())
+        name = await run_db(slow)
+        ticker.cancel()
+        return name, ticks
+
+    name, ticks = asyncio.run(go())
+    assert name.startswith("db")
+    # пока запрос «висел» в пуле, loop продолжал крутиться
+    assert ticks >= 10
+
+
+def test_run_db_commits_or_rolls_back():
+    init_db.main()
+
+    def fail(s):
+        s.add(Setting(key="test.run_db", value="x"))
+        s.flush()
+        raise RuntimeError("boom")
+
+    def ok(s):
+        s.merge(Setting(key="test.run_db", value="y"))
+
+    async def go():
+        with pytest.raises(RuntimeError):
+            await run_db(fail)
+        assert await run_db(lambda s: s.get(Setting, "test.run_db")) is None
+        await run_db(ok)
+        value = await run_db(lambda s: s.get(Setting, "test.run_db").value)
+        await run_db(lambda s: s.delete(s.get(Setting, "test.run_db")))
+        return value
+
+    assert asyncio.run(go()) == "y"
@@ -0,0 +1,71 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select, update
+
+import init_db
+from db import session_scope
+from dump import Importer, export_records
+from models import Message, Thread
+
+PERSONA = init_db.DEFAULT_PERSONAS[0]["id"]
+
+
+def _export(since=None) -> list[dict]:
+    async def go():
+        return [r async for r in export_records(since)]
+    return asyncio.run(go())
+
+
+def _import(records: list[dict]):
+    async def go():
+        importer = Importer("skip")
+        for r in records:
+            await importer.add(r)
+        await importer.flush()
+    asyncio.run(go())
+
+
+def _setup() -> datetime:
+    init_db.main()
+    old = datetime.utcnow() - timedelta(days=30)
+    deliver = datetime.utcnow() + timedelta(seconds=30)
+    with session_scope() as s:
+        s.add(Thread(id="dump-1", persona_id=PERSONA, model="groq:test"))
+        s.flush()
+        s.add_all([
+            Message(thread_id="dump-1", role="user", content="привет", tokens=5, created_at=old),
+            Message(thread_id="dump-1", role="assistant", content="здравствуй", tokens=5, created_at=old,
+                    persona_id=PERSONA, deliver_at=deliver),
+        ])
+        s.flush()
+        s.execute(update(Thread).where(Thread.id == "dump-1").values(updated_at=old, modified_at=old))
+    return deliver
+
+
+def test_since_picks_up_summary_change_and_messages_round_trip():
+    deliver = _setup()
+    since = datetime.utcnow() - timedelta(minutes=1)
+    assert not [r for r in _export(since) if r["type"] == "thread" and r["id"] == "dump-1"]
+
+    # правка summary не трогает updated_at, но сдвигает modified_at
+    with session_scope() as s:
+        s.execute(update(Thread).where(Thread.id == "dump-1").values(summary="новое"))
+    threads = [r for r in _export(since) if r["type"] == "thread" and r["id"] == "dump-1"]
+    assert len(threads) == 1 and threads[0]["summary"] == "новое"
+
+    records = [r for r in _export() if r["type"] in ("meta", "thread") or r.get("thread_id") == "dump-1"]
+    records = [r for r in records if r["type"] != "thread" or r["id"] == "dump-1"]
+    with session_scope() as s:
+        s.execute(delete(Message).where(Message.thread_id == "dump-1"))
+        s.execute(delete(Thread).where(Thread.id == "dump-1"))
+    _import(records)
+
+    with session_scope() as s:
+        rows = s.execute(
+            select(Message.role, Message.persona_id, Message.deliver_at)
+            .where(Message.thread_id == "dump-1").order_by(Message.id)
+        ).all()
+        summary = s.get(Thread, "dump-1").summary
+    assert [tuple(r) for r in rows] == [("user", None, None), ("assistant", PERSONA, deliver)]
+    assert summary == "новое"
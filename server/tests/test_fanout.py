@@ -0,0 +1,67 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+import init_db
+import server
+from router import ProviderError
+
+
+@pytest.fixture(scope="module")
+def client():
+    init_db.main()
+    with TestClient(server.app) as c:
+        yield c
+
+
+@pytest.fixture
+def seen(monkeypatch):
+    contexts = {}
+
+    async def complete(model, messages, temperature):
+        if model == "groq:bad":
+            raise ProviderError("groq", "down", "network", retryable=True)
+        persona = messages[0]["cache_key"].split(":")[1]
+        contexts[persona] = messages
+        return f"ответ {persona}"
+
+    monkeypatch.setattr(server.router, "complete", complete)
+    return contexts
+
+
+def _fanout(client, thread_id: str, targets: list[dict]) -> list[dict]:
+    r = client.post("/api/chat/fanout", json={"threadId": thread_id, "message": "всем привет", "model": "groq:test", "targets": targets})
+    assert r.status_code == 200
+    return [json.loads(l) for l in r.text.splitlines()]
+
+
+def test_replies_stream_as_ndjson_and_are_stored_in_target_order(client, seen):
+    rows = _fanout(client, "fan-1", [
+        {"personaId": "friendly"}, {"personaId": "neutral", "model": "groq:bad"}, {"personaId": "romantic"},
+    ])
+    summary = rows[-1]["summary"]
+    assert summary["done"] == 3 and summary["failed"] == 1 and len(summary["ids"]) == 2
+    by_persona = {r["personaId"]: r for r in rows[:-1]}
+    assert not by_persona["neutral"]["ok"]
+    assert by_persona["friendly"]["text"] == "ответ friendly"
+    history = client.get("/api/threads/fan-1/messages").json()
+    assert [(m["role"], m["persona_id"], m["content"]) for m in history] == [
+        ("user", None, "всем привет"),
+        ("assistant", "friendly", "ответ friendly"),
+        ("assistant", "romantic", "ответ romantic"),
+    ]
+
+
+def test_other_personas_replies_are_user_turns_in_context(client, seen):
+    _fanout(client, "fan-2", [{"personaId": "friendly"}, {"personaId": "romantic"}])
+    _fanout(client, "fan-2", [{"personaId": "friendly"}])
+    history = [m for m in seen["friendly"] if m["role"] != "system"]
+    assert {"role": "assistant", "content": "ответ friendly"} in history
+    assert any(m["role"] == "user" and m["content"].endswith(": ответ romantic") for m in history)
+
+
+def test_unknown_persona_is_404(client, seen):
+    r = client.post("/api/chat/fanout", json={"threadId": "fan-3", "message": "x", "model": "groq:test",
+                                              "targets": [{"personaId": "нет-такой"}]})
+    assert r.status_code == 404
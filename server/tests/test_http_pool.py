@@ -0,0 +1,23 @@
+import asyncio
+
+from http_pool import ProviderPool
+
+
+def test_provider_reuses_one_client_until_closed():
+    async def go():
+        pool = ProviderPool()
+        pool.register("groq", "https://api.groq.test/", timeout=30)
+        await pool.start(prewarm=False)
+        first = pool.client("groq")
+        assert pool.client("groq") is first
+        assert str(first.base_url) == "https://api.groq.test"
+        assert first.timeout.read == 30
+        await pool.close()
+        assert first.is_closed
+        # после закрытия (или без lifespan) клиент создаётся заново
+        again = pool.client("groq")
+        assert again is not first and not again.is_closed
+        await pool.close()
+
+    asyncio.run(go())
+
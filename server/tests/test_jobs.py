@@ -0,0 +1,89 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import delete, func, select, update
+
+import init_db
+import jobs as jobs_mod
+import server
+from db import session_scope
+from jobs import JobQueue, _claim, _fail, enqueue, get_job
+from models import Job, Message, Thread
+
+PERSONA = init_db.DEFAULT_PERSONAS[0]["id"]
+
+
+@pytest.fixture
+def thread():
+    init_db.main()
+    with session_scope() as s:
+        s.execute(delete(Job))
+        s.add(Thread(id="jobs-1", persona_id=PERSONA, model="groq:test"))
+    yield "jobs-1"
+    with session_scope() as s:
+        s.execute(delete(Job))
+        s.execute(delete(Message).where(Message.thread_id == "jobs-1"))
+        s.execute(delete(Thread).where(Thread.id == "jobs-1"))
+
+
+def _job(thread_id: str, text: str = "привет") -> tuple[str, int]:
+    payload = {"model": "groq:test", "personaId": PERSONA, "message": text, "threadId": thread_id, "simulateTyping": False}
+    with session_scope() as s:
+        m = Message(thread_id=thread_id, role="user", content=text, tokens=3)
+        s.add(m)
+        s.flush()
+        return enqueue(s, thread_id, payload, message_id=m.id).id, m.id
+
+
+def test_expired_lease_is_reclaimed_and_retries_are_bounded(thread, monkeypatch):
+    jid, _ = _job(thread)
+    with session_scope() as s:
+        first = _claim(s, "a")
+        assert first["id"] == jid and first["attempts"] == 1
+        assert _claim(s, "b") is None  # тред занят живой арендой
+        s.execute(update(Job).where(Job.id == jid).values(lease_until=datetime.utcnow() - timedelta(seconds=1)))
+        second = _claim(s, "b")
+        assert second["id"] == jid and second["attempts"] == 2
+        # старый владелец аренду потерял: его отчёт об ошибке ничего не меняет
+        _fail(s, first, "a", "late", retry=True)
+        assert get_job(s, jid)["status"] == "running"
+        monkeypatch.setattr(jobs_mod, "JOB_MAX_ATTEMPTS", 2)
+        assert _fail(s, second, "b", "boom", retry=True) == "failed"
+
+
+def test_long_poll_does_not_leak_events_for_jobs_finished_elsewhere(thread):
+    jid, _ = _job(thread)
+    queue = JobQueue(workers=0)
+
+    async def go():
+        waiter = asyncio.create_task(queue.wait(jid, 5))
+        await asyncio.sleep(0.05)
+        assert jid in queue._done
+        # задачу завершил другой процесс: этот узнаёт об этом только опросом
+        with session_scope() as s:
+            s.execute(update(Job).where(Job.id == jid).values(status="done", result='{"text": "ok"}'))
+        return await waiter
+
+    assert asyncio.run(go())["status"] == "done"
+    assert queue._done == {} and queue._waiters == {}
+    assert asyncio.run(queue.wait(jid, 0))["status"] == "done"
+    assert queue._done == {}
+
+
+def test_retry_after_crash_does_not_write_second_reply(thread, monkeypatch):
+    jid, mid = _job(thread)
+    with session_scope() as s:
+        job = _claim(s, "a")
+        # прошлая попытка успела записать ответ и упала до _finish
+        s.add(Message(thread_id=thread, role="assistant", content="уже отвечено", tokens=3))
+
+    async def complete(model, messages, temperature):
+        raise AssertionError("провайдер не должен вызываться")
+
+    monkeypatch.setattr(server.router, "complete", complete)
+    out = asyncio.run(server.chat_job(job))
+    assert out["text"] == "уже отвечено"
+    with session_scope() as s:
+        n = s.scalar(select(func.count()).select_from(Message).where(Message.thread_id == thread, Message.role == "assistant"))
+    assert n == 1
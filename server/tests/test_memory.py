@@ -0,0 +1,64 @@
+import threading
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import update
+
+import archive
+import init_db
+import memory
+from db import session_scope
+from models import Message, Thread
+
+PERSONA = init_db.DEFAULT_PERSONAS[0]["id"]
+
+
+def _thread(thread_id: str, texts: list[str]) -> list[int]:
+    init_db.main()
+    old = datetime.utcnow() - timedelta(days=30)
+    with session_scope() as s:
+        s.add(Thread(id=thread_id, persona_id=PERSONA, model="groq:test"))
+        s.flush()
+        msgs = [Message(thread_id=thread_id, role="user", content=t, tokens=10, created_at=old) for t in texts]
+        s.add_all(msgs)
+        s.flush()
+        s.execute(update(Thread).where(Thread.id == thread_id).values(updated_at=old))
+        return [m.id for m in msgs]
+
+
+def test_recall_reads_archived_messages(monkeypatch):
+    texts = [
+        "Мою собаку зовут Барбос, она породы бигль",
+        "Сегодня на работе обсуждали квартальный отчёт",
+        "Завтра собираюсь в поход на выходные",
+    ]
+    ids = _thread("mem-archived", texts)
+    memory.index_rows([(mid, "mem-archived", t) for mid, t in zip(ids, texts)])
+
+    monkeypatch.setattr(archive, "ARCHIVE_IDLE_DAYS", 1)
+    monkeypatch.setattr(archive, "ARCHIVE_KEEP_LAST", 1)
+    monkeypatch.setattr(archive, "ARCHIVE_REQUIRE_SUMMARY", False)
+    with session_scope() as s:
+        assert archive.archive_thread(s, "mem-archived") == 2
+    with session_scope() as s:
+        assert s.get(Message, ids[0]) is None
+        note = memory.recall(s, "mem-archived", "как зовут мою собаку бигль?", ids[-1])
+    assert note is not None and "Барбос" in note
+
+
+def test_concurrent_indexers_do_not_duplicate_rows():
+    texts = [f"Сообщение номер {i} про разные длинные темы" for i in range(50)]
+    ids = _thread("mem-concurrent", texts)
+    rows = [(mid, "mem-concurrent", t) for mid, t in zip(ids, texts)]
+    memory._write_cursor(ids[0] - 1)
+
+    workers = [threading.Thread(target=memory._index_batch, args=(rows,)) for _ in range(4)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+    _, ids_path = memory.index_paths("mem-concurrent")
+    stored = np.fromfile(ids_path, dtype=np.int64)
+    assert stored.tolist() == ids
+    assert memory._read_cursor() == ids[-1]
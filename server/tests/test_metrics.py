@@ -0,0 +1,51 @@
+import json
+import logging
+
+import pytest
+from fastapi.testclient import TestClient
+
+import init_db
+import metrics
+import server
+
+PERSONA = init_db.DEFAULT_PERSONAS[0]["id"]
+
+
+@pytest.fixture(scope="module")
+def client():
+    init_db.main()
+    with TestClient(server.app) as c:
+        yield c
+
+
+def test_metrics_expose_phases_and_route_templates(client, monkeypatch):
+    async def complete(model, messages, temperature):
+        return "ответ"
+
+    monkeypatch.setattr(server.router, "complete", complete)
+    client.post("/api/chat", json={"threadId": "met-1", "model": "groq:test", "personaId": PERSONA,
+                                   "message": "привет", "simulateTyping": False})
+    client.get("/api/threads/met-1/messages")
+    r = client.get("/metrics")
+    assert r.headers["content-type"].startswith("text/plain; version=0.0.4")
+    text = r.text
+    for name in ("thread", "context", "provider", "write_reply"):
+        assert f'chat_phase_duration_seconds_count{{phase="{name}"}}' in text
+    # метка route — шаблон пути, а не сам путь с id треда
+    assert 'route="/api/threads/{thread_id}/messages"' in text
+    assert "met-1" not in text
+    assert "writer_queue_depth" in text
+
+
+def test_sampled_span_logs_phase_timings(client, monkeypatch, caplog):
+    async def complete(model, messages, temperature):
+        return "ответ"
+
+    monkeypatch.setattr(server.router, "complete", complete)
+    monkeypatch.setattr(metrics, "TRACE_SAMPLE_RATE", 1.0)
+    with caplog.at_level(logging.INFO, logger="trace"):
+        client.post("/api/chat", json={"threadId": "met-2", "model": "groq:test", "personaId": PERSONA,
+                                       "message": "привет", "simulateTyping": False})
+    records = [json.loads(r.getMessage()) for r in caplog.records if r.name == "trace"]
+    assert records and records[-1]["span"] == "chat"
+    assert {"context", "provider"} <= set(records[-1]["phases"])
@@ -0,0 +1,54 @@
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+
+import init_db
+import server
+from db import session_scope
+from models import Message, Thread
+
+PERSONA = init_db.DEFAULT_PERSONAS[0]["id"]
+
+
+@pytest.fixture(scope="module")
+def client():
+    init_db.main()
+    t0 = datetime.utcnow() - timedelta(hours=1)
+    with session_scope() as s:
+        s.add(Thread(id="page-1", persona_id=PERSONA))
+        # две реплики с одинаковым created_at — порядок по id
+        s.add_all(Message(thread_id="page-1", role="user", content=f"m{i}", created_at=t0 + timedelta(seconds=min(i, 5)))
+                  for i in range(7))
+    with TestClient(server.app) as c:
+        yield c
+
+
+def _contents(r) -> list[str]:
+    assert r.status_code == 200
+    return [m["content"] for m in r.json()]
+
+
+def test_limit_without_cursor_returns_newest_in_order(client):
+    assert _contents(client.get("/api/threads/page-1/messages?limit=3")) == ["m4", "m5", "m6"]
+
+
+def test_before_and_after_walk_the_whole_history(client):
+    url = "/api/threads/page-1/messages"
+    seen, before = [], None
+    while True:
+        page = client.get(url, params={"limit": 2, **({"before": before} if before else {})}).json()
+        if not page:
+            break
+        seen = [m["content"] for m in page] + seen
+        before = page[0]["cursor"]
+    assert seen == [f"m{i}" for i in range(7)]
+
+    first = client.get(url, params={"limit": 1, "before": client.get(url).json()[1]["cursor"]}).json()
+    assert [m["content"] for m in first] == ["m0"]
+    rest = _contents(client.get(url, params={"after": first[0]["cursor"], "limit": 10}))
+    assert rest == [f"m{i}" for i in range(1, 7)]
+
+
+def test_bad_cursor_is_400(client):
+    assert client.get("/api/threads/page-1/messages?before=***").status_code == 400
@@ -0,0 +1,72 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+import providers
+from http_pool import pool
+from prompt_cache import prefix_key
+from providers import GeminiProvider
+
+
+def _messages(prompt: str) -> list[dict]:
+    return [
+        {"role": "system", "content": prompt, "cache_key": prefix_key("p1", prompt)},
+        {"role": "user", "content": "привет"},
+    ]
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    monkeypatch.setenv("GEMINI_API_KEY", "test")
+    monkeypatch.setattr(providers, "GEMINI_CACHE_MIN_TOKENS", 0)
+    calls = []
+    stale = set()
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content or b"{}")
+        calls.append((request.url.path, body))
+        if request.url.path.endswith("/cachedContents"):
+            return httpx.Response(200, json={"name": f"cachedContents/c{len(calls)}"})
+        if body.get("cachedContent") in stale:
+            return httpx.Response(404, json={"error": {"message": "not found"}})
+        return httpx.Response(200, json={"candidates": [{"content": {"parts": [{"text": "ответ"}]}}]})
+
+    monkeypatch.setitem(pool._clients, "gemini", httpx.AsyncClient(
+        transport=httpx.MockTransport(handle), base_url="http://gemini.test"
+    ))
+    yield GeminiProvider("http://gemini.test", cache=True), calls, stale
+    asyncio.run(pool._clients["gemini"].aclose())
+
+
+def test_prefix_is_created_once_and_sent_by_name(gemini):
+    provider, calls, _ = gemini
+
+    async def go():
+        for _ in range(3):
+            assert await provider.complete("flash", _messages("ты персона"), 0.7) == "ответ"
+
+    asyncio.run(go())
+    creates = [b for p, b in calls if p.endswith("/cachedContents")]
+    generates = [b for p, b in calls if p.endswith(":generateContent")]
+    assert len(creates) == 1 and len(generates) == 3
+    assert all(b["cachedContent"] == "cachedContents/c1" and "systemInstruction" not in b for b in generates)
+
+
+def test_changed_prompt_gets_new_key_and_stale_cache_falls_back_inline(gemini):
+    provider, calls, stale = gemini
+    assert prefix_key("p1", "старый") != prefix_key("p1", "новый")
+
+    async def go():
+        await provider.complete("flash", _messages("старый"), 0.7)
+        stale.add("cachedContents/c1")
+        # кэш пропал на стороне API: один повтор inline, следующий ход создаёт кэш заново
+        assert await provider.complete("flash", _messages("старый"), 0.7) == "ответ"
+        await provider.complete("flash", _messages("старый"), 0.7)
+
+    asyncio.run(go())
+    paths = [p.rsplit("/", 1)[-1] for p, _ in calls]
+    assert paths == ["cachedContents", "flash:generateContent", "flash:generateContent", "flash:generateContent",
+                     "cachedContents", "flash:generateContent"]
+    assert calls[3][1]["systemInstruction"]["parts"] == [{"text": "старый"}]
@@ -0,0 +1,50 @@
+import pytest
+
+import init_db
+import prompt_cache
+from db import session_scope
+from models import Persona
+from prompt_cache import PromptCache
+
+PERSONA = init_db.DEFAULT_PERSONAS[0]["id"]
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    init_db.main()
+    monkeypatch.setattr(prompt_cache, "CACHE_VERSION_CHECK_S", 0)
+    renders = []
+
+    def render(p, global_prompt):
+        renders.append(p.id)
+        return f"{p.name}: {p.bio}"
+
+    return PromptCache(render), renders
+
+
+def test_system_prompt_is_rendered_once_per_version(cache):
+    cache, renders = cache
+    with session_scope() as s:
+        first = cache.system_prompt(s, PERSONA)
+        assert cache.system_prompt(s, PERSONA) == first
+        assert cache.system_prompt(s, "нет-такой") is None
+    assert renders == [PERSONA]
+
+
+def test_change_from_another_process_is_picked_up_by_version(cache):
+    cache, _ = cache
+    with session_scope() as s:
+        s.add(Persona(id="cache-1", name="Кэш", bio="старое"))
+    try:
+        with session_scope() as s:
+            assert cache.system_prompt(s, "cache-1") == "Кэш: старое"
+        # запись «из другого процесса»: invalidate() здесь не вызывается, только версия в settings
+        with session_scope() as s:
+            s.get(Persona, "cache-1").bio = "новое"
+            PromptCache.bump(s)
+        with session_scope() as s:
+            assert cache.system_prompt(s, "cache-1") == "Кэш: новое"
+    finally:
+        with session_scope() as s:
+            s.delete(s.get(Persona, "cache-1"))
+            PromptCache.bump(s)
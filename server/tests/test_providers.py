@@ -0,0 +1,53 @@
+import asyncio
+
+import httpx
+import pytest
+
+import mock_llm
+from http_pool import pool
+from providers import OllamaProvider, OpenAIStyleProvider, ProviderRegistry
+from router import ProviderError
+
+MESSAGES = [{"role": "system", "content": "ты персона"}, {"role": "user", "content": "привет"}]
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    monkeypatch.setattr(mock_llm, "cfg", mock_llm.MockConfig(latency_ms=0, jitter_ms=0, tokens_per_s=0, reply="локальный ответ"))
+    # register() записывает адреса в общий пул — после теста вернуть настоящие
+    monkeypatch.setattr(pool, "_specs", dict(pool._specs))
+    reg = ProviderRegistry()
+    reg.register(OllamaProvider("http://ollama.test", preload=[], keep_warm_s=0))
+    reg.register(OpenAIStyleProvider("openrouter", "http://openrouter.test", "OPENROUTER_API_KEY"))
+    # запросы провайдера уходят в mock_llm в памяти, а не в сеть
+    monkeypatch.setitem(pool._clients, "ollama", httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=mock_llm.app), base_url="http://ollama.test"
+    ))
+    yield reg
+    asyncio.run(pool._clients["ollama"].aclose())
+
+
+def test_ollama_complete_stream_and_warm_up(registry):
+    async def go():
+        text = await registry.complete("ollama:llama3", MESSAGES, 0.7)
+        parts = [d async for d in registry.stream("ollama:llama3", MESSAGES, 0.7)]
+        warmed = await registry.get("ollama").warm("llama3")
+        return text, parts, warmed
+
+    text, parts, warmed = asyncio.run(go())
+    assert text == "локальный ответ"
+    assert len(parts) > 1 and "".join(parts) == "локальный ответ"
+    assert warmed
+    assert "llama3" in registry.get("ollama").last_used
+
+
+def test_resolve_reports_unknown_vendor_and_missing_key(registry, monkeypatch):
+    monkeypatch.delenv("OPENROUTER_API_KEY", raising=False)
+    with pytest.raises(ProviderError) as e:
+        registry.resolve("nope:model")
+    assert e.value.kind == "unsupported"
+    with pytest.raises(ProviderError) as e:
+        registry.resolve("openrouter:some/model")
+    assert e.value.kind == "config"
+    provider, model = registry.resolve("ollama:qwen2.5:7b")
+    assert provider.name == "ollama" and model == "qwen2.5:7b"
@@ -0,0 +1,76 @@
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import init_db
+import push
+import server
+
+PERSONA = init_db.DEFAULT_PERSONAS[0]["id"]
+
+
+@pytest.fixture(scope="module")
+def client():
+    init_db.main()
+    with TestClient(server.app) as c:
+        yield c
+
+
+def _body(thread_id: str, **extra) -> dict:
+    return {"threadId": thread_id, "model": "groq:test", "personaId": PERSONA, "message": "привет", **extra}
+
+
+def _until(ws, pred, limit: int = 20) -> list[dict]:
+    events = []
+    for _ in range(limit):
+        events.append(ws.receive_json())
+        if pred(events[-1]):
+            return events
+    raise AssertionError(events)
+
+
+def test_scheduled_reply_is_pushed_at_deliver_at(client, monkeypatch):
+    async def complete(model, messages, temperature):
+        return "короткий ответ"
+
+    monkeypatch.setattr(server.router, "complete", complete)
+    monkeypatch.setattr(server, "TYPE_SIM_MODE", "schedule")
+    with client.websocket_connect("/ws/threads/push-1") as ws:
+        out = client.post("/api/chat", json=_body("push-1", simulateTyping=True)).json()
+        assert out["deliver_at"]
+        # до deliver_at строка скрыта и в истории
+        assert [m["role"] for m in client.get("/api/threads/push-1/messages").json()] == ["user"]
+        events = _until(ws, lambda e: e["type"] == "message" and e["message"]["role"] == "assistant")
+    assert {"type": "typing", "active": True, "until": out["deliver_at"]} in events
+    assert events[-1]["message"]["content"] == "короткий ответ"
+    assert len(client.get("/api/threads/push-1/messages").json()) == 2
+
+
+def test_typing_is_cleared_when_turn_fails_unexpectedly(client, monkeypatch):
+    async def complete(model, messages, temperature):
+        raise RuntimeError("bug")
+
+    monkeypatch.setattr(server.router, "complete", complete)
+    with client.websocket_connect("/ws/threads/push-2") as ws:
+        with pytest.raises(RuntimeError):
+            client.post("/api/chat", json=_body("push-2", simulateTyping=False))
+        # summary — метка конца: без сброса индикатора тест не зависнет на receive
+        client.patch("/api/threads/push-2", json={"summary": "конец"})
+        events = _until(ws, lambda e: e["type"] == "summary")
+    assert {"type": "typing", "active": True} in events
+    assert {"type": "typing", "active": False} in events
+
+
+def test_streamed_reply_is_pushed_without_waiting_for_poll(client, monkeypatch):
+    async def stream(model, messages, temperature):
+        yield "потоковый ответ"
+
+    monkeypatch.setattr(server.router, "stream", stream)
+    monkeypatch.setattr(push, "PUSH_POLL_MS", 3000)
+    with client.websocket_connect("/ws/threads/push-3") as ws:
+        time.sleep(0.3)  # опрос успевает уйти в долгое ожидание
+        started = time.monotonic()
+        client.post("/api/chat/stream", json=_body("push-3", simulateTyping=False))
+        _until(ws, lambda e: e["type"] == "message" and e["message"]["role"] == "assistant")
+        assert time.monotonic() - started < 2
@@ -0,0 +1,111 @@
+import asyncio
+import time
+
+import pytest
+
+from router import CircuitBreaker, Router
+
+
+def _half_open(router: Router, provider: str) -> CircuitBreaker:
+    b = router.breaker(provider)
+    b.consecutive = b.failures
+    b.opened_at = time.monotonic() - b.cooldown
+    assert b.state == "half-open"
+    return b
+
+
+async def _hang(spec, messages, temperature):
+    await asyncio.Event().wait()
+
+
+async def _hang_stream(spec, messages, temperature):
+    await asyncio.Event().wait()
+    yield ""
+
+
+def test_cancelled_probe_releases_half_open_breaker():
+    async def go():
+        router = Router(_hang, _hang_stream)
+        b = _half_open(router, "groq")
+        task = asyncio.create_task(router.complete("groq:m", [], 0.5))
+        await asyncio.sleep(0.01)
+        assert b._probing
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert not b._probing
+        assert b.state == "open"  # проба не удалась: снова ждём cooldown
+        b.opened_at -= b.cooldown
+        assert b.allow()
+
+    asyncio.run(go())
+
+
+def test_cancelled_stream_probe_releases_half_open_breaker():
+    async def go():
+        router = Router(_hang, _hang_stream)
+        b = _half_open(router, "groq")
+
+        async def consume():
+            async for _ in router.stream("groq:m", [], 0.5):
+                pass
+
+        task = asyncio.create_task(consume())
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert not b._probing and b.state == "open"
+
+    asyncio.run(go())
+
+
+def test_unexpected_error_in_probe_releases_breaker():
+    async def boom(spec, messages, temperature):
+        raise RuntimeError("bug")
+
+    async def go():
+        router = Router(boom, _hang_stream)
+        b = _half_open(router, "groq")
+        with pytest.raises(RuntimeError):
+            await router.complete("groq:m", [], 0.5)
+        assert not b._probing
+
+    asyncio.run(go())
+
+
+def test_cancel_in_closed_state_does_not_count_as_failure():
+    async def go():
+        router = Router(_hang, _hang_stream)
+        b = router.breaker("groq")
+        task = asyncio.create_task(router.complete("groq:m", [], 0.5))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert b.state == "closed" and b.consecutive == 0
+
+    asyncio.run(go())
+
+
+def test_metric_labels_are_bounded(monkeypatch):
+    import metrics
+
+    monkeypatch.setattr(metrics, "METRICS_MODELS", frozenset({"llama3"}))
+    router = Router(_hang, _hang_stream, known=lambda p: p in ("groq", "ollama"))
+    assert router._labels("groq:llama3") == {"provider": "groq", "model": "llama3"}
+    assert router._labels("groq:user-made-up-model-123") == {"provider": "groq", "model": "other"}
+    assert router._labels("evil:anything") == {"provider": "other", "model": "other"}
+
+
+def test_latency_histogram_uses_bounded_labels():
+    import metrics
+
+    async def ok(spec, messages, temperature):
+        return "ok"
+
+    router = Router(ok, _hang_stream, known=lambda p: p == "groq")
+    asyncio.run(router.complete("groq:random-model-xyz", [], 0.5))
+    text = metrics.registry.render()
+    assert "random-model-xyz" not in text
+    assert 'provider_request_duration_seconds_count{provider="groq",model="other",outcome="ok"}' in text
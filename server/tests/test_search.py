@@ -0,0 +1,45 @@
+import pytest
+
+import init_db
+from db import session_scope
+from models import Persona
+from search import make_snippet, search_personas
+
+
+def test_snippet_escapes_text_around_matches():
+    out = make_snippet('смотри <script>alert("x")</script> привет & пока', "привет")
+    assert "<script>" not in out
+    assert "&lt;script&gt;" in out and "&amp;" in out
+    assert "<mark>привет</mark>" in out
+
+
+def test_snippet_without_words_is_escaped():
+    assert make_snippet("<>", "x") == "&lt;&gt;"
+
+
+@pytest.fixture
+def xss_persona():
+    init_db.main()
+    with session_scope() as s:
+        s.add(Persona(id="xss", name="Злодей", bio='<script>alert(1)</script> любит ромашки <img src=x onerror=alert(2)>'))
+    yield "xss"
+    # база общая на прогон: чужая персона не должна попадать в другие тесты (строку из индекса уберёт триггер)
+    with session_scope() as s:
+        p = s.get(Persona, "xss")
+        if p is not None:
+            s.delete(p)
+
+
+def test_persona_snippet_is_escaped(xss_persona):
+    with session_scope() as s:
+        hits = search_personas(s, "ромашки")
+    snippet = next(h["snippet"] for h in hits if h["id"] == xss_persona)
+    assert "<script>" not in snippet and "<img" not in snippet
+    assert "<mark>ромашки</mark>" in snippet
+
+
+def test_deleted_persona_leaves_search(xss_persona):
+    with session_scope() as s:
+        s.delete(s.get(Persona, xss_persona))
+    with session_scope() as s:
+        assert all(h["id"] != xss_persona for h in search_personas(s, "ромашки"))
@@ -0,0 +1,55 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+import init_db
+import server
+from router import ProviderError
+
+PERSONA = init_db.DEFAULT_PERSONAS[0]["id"]
+
+
+@pytest.fixture(scope="module")
+def client():
+    init_db.main()
+    with TestClient(server.app) as c:
+        yield c
+
+
+def _body(thread_id: str) -> dict:
+    return {"threadId": thread_id, "model": "groq:test", "personaId": PERSONA, "message": "привет", "simulateTyping": False}
+
+
+def _events(text: str) -> list[tuple[str, dict]]:
+    out = []
+    for block in text.strip().split("\n\n"):
+        event, data = block.split("\n")
+        out.append((event.removeprefix("event: "), json.loads(data.removeprefix("data: "))))
+    return out
+
+
+def test_stream_sends_deltas_without_think_and_stores_reply(client, monkeypatch):
+    async def stream(model, messages, temperature):
+        for chunk in ["<thi", "nk>скрыто</think>При", "вет", "!"]:
+            yield chunk
+
+    monkeypatch.setattr(server.router, "stream", stream)
+    r = client.post("/api/chat/stream", json=_body("sse-1"))
+    assert r.headers["content-type"].startswith("text/event-stream")
+    events = _events(r.text)
+    assert "".join(d["text"] for e, d in events if e == "delta") == "Привет!"
+    assert events[-1] == ("done", {"text": "Привет!"})
+    history = client.get("/api/threads/sse-1/messages").json()
+    assert [(m["role"], m["content"]) for m in history] == [("user", "привет"), ("assistant", "Привет!")]
+
+
+def test_stream_error_is_an_event_and_nothing_is_stored(client, monkeypatch):
+    async def stream(model, messages, temperature):
+        raise ProviderError("groq", "down", "network", retryable=True)
+        yield
+
+    monkeypatch.setattr(server.router, "stream", stream)
+    events = _events(client.post("/api/chat/stream", json=_body("sse-2")).text)
+    assert [e for e, _ in events] == ["error"]
+    assert [m["role"] for m in client.get("/api/threads/sse-2/messages").json()] == ["user"]
@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+import init_db
+from db import session_scope
+from models import Message, Thread
+from summarizer import Summarizer
+
+PERSONA = init_db.DEFAULT_PERSONAS[0]["id"]
+
+
+@pytest.fixture
+def thread():
+    init_db.main()
+    with session_scope() as s:
+        s.add(Thread(id="sum-1", persona_id=PERSONA))
+        s.flush()
+        msgs = [Message(thread_id="sum-1", role="user", content=f"реплика {i}") for i in range(12)]
+        s.add_all(msgs)
+        s.flush()
+        ids = [m.id for m in msgs]
+    yield ids
+    with session_scope() as s:
+        s.query(Message).filter(Message.thread_id == "sum-1").delete()
+        s.delete(s.get(Thread, "sum-1"))
+
+
+def _state() -> tuple:
+    with session_scope() as s:
+        t = s.get(Thread, "sum-1")
+        return t.summary, t.summary_upto
+
+
+def test_evicted_messages_are_folded_once(thread):
+    calls = []
+
+    async def call(model, messages, temperature):
+        calls.append(messages[-1]["content"])
+        return "сводка"
+
+    updates = []
+    summ = Summarizer(call, keep_last=4)
+    summ.on_update(lambda tid, text: updates.append((tid, text)))
+    assert asyncio.run(summ.summarize("sum-1"))
+    # из окна выпали первые 8, последние 4 остаются в контексте
+    assert _state() == ("сводка", thread[7])
+    assert "реплика 7" in calls[0] and "реплика 8" not in calls[0]
+    assert updates == [("sum-1", "сводка")]
+    assert not asyncio.run(summ.summarize("sum-1"))
+    assert len(calls) == 1
+
+
+def test_model_error_never_lands_in_summary(thread):
+    async def call(model, messages, temperature):
+        raise RuntimeError("модель недоступна")
+
+    assert not asyncio.run(Summarizer(call, keep_last=4).summarize("sum-1"))
+    assert _state() == ("", 0)
@@ -0,0 +1,55 @@
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.testclient import TestClient
+
+import init_db
+import server
+from db import session_scope
+from models import Message, Persona, Thread
+
+
+@pytest.fixture(scope="module")
+def client():
+    init_db.main()
+    t0 = datetime.utcnow() - timedelta(days=1)
+    with session_scope() as s:
+        s.add(Persona(id="list-p", name="Листинг"))
+        for i in range(3):
+            s.add(Thread(id=f"list-{i}", persona_id="list-p", created_at=t0, updated_at=t0))
+        s.flush()
+        # активность в порядке 2, 0, 1 — сверху должен быть list-1
+        for n, tid in enumerate(["list-2", "list-0", "list-1"]):
+            s.add(Message(thread_id=tid, role="user", content=f"первое в {tid}", created_at=t0 + timedelta(minutes=n)))
+        s.add(Message(thread_id="list-1", role="assistant", content="x" * 500, created_at=t0 + timedelta(minutes=5)))
+    with TestClient(server.app) as c:
+        yield c
+    with session_scope() as s:
+        s.query(Message).filter(Message.thread_id.like("list-%")).delete(synchronize_session=False)
+        s.query(Thread).filter(Thread.persona_id == "list-p").delete(synchronize_session=False)
+        s.delete(s.get(Persona, "list-p"))
+
+
+def test_triggers_keep_count_preview_and_updated_at(client):
+    by_id = {t["id"]: t for t in client.get("/api/threads", params={"persona_id": "list-p"}).json()}
+    assert by_id["list-1"]["message_count"] == 2
+    assert by_id["list-1"]["last_message_preview"] == "x" * 200
+    assert by_id["list-0"]["last_message_preview"] == "первое в list-0"
+    # удаление последней реплики возвращает превью на предыдущую
+    with session_scope() as s:
+        s.query(Message).filter(Message.thread_id == "list-1", Message.role == "assistant").delete()
+    t = next(t for t in client.get("/api/threads", params={"persona_id": "list-p"}).json() if t["id"] == "list-1")
+    assert t["message_count"] == 1 and t["last_message_preview"] == "первое в list-1"
+
+
+def test_listing_pages_by_recent_activity(client):
+    seen, before = [], None
+    while True:
+        params = {"persona_id": "list-p", "limit": 2, "lite": True, **({"before": before} if before else {})}
+        page = client.get("/api/threads", params=params).json()
+        if not page:
+            break
+        assert all("summary" not in t for t in page)
+        seen += [t["id"] for t in page]
+        before = page[-1]["cursor"]
+    assert seen == ["list-1", "list-0", "list-2"]
@@ -0,0 +1,70 @@
+import asyncio
+import time
+
+from turns import TurnScheduler
+
+
+async def _noop():
+    pass
+
+
+def test_idle_thread_answers_without_waiting():
+    async def go():
+        turns = TurnScheduler()
+
+        async def turn():
+            return "ok"
+
+        started = time.perf_counter()
+        assert await turns.submit("t", _noop, turn, key="k") == "ok"
+        return time.perf_counter() - started
+
+    assert asyncio.run(go()) < 0.05
+
+
+def test_messages_queued_during_a_turn_share_one_answer_only_with_same_key():
+    async def go():
+        turns = TurnScheduler()
+        release = asyncio.Event()
+        calls = []
+
+        def turn(name):
+            async def run():
+                calls.append(name)
+                if name == "first":
+                    await release.wait()
+                return name
+            return run
+
+        first = asyncio.create_task(turns.submit("t", _noop, turn("first"), key="a"))
+        await asyncio.sleep(0)
+        same1 = asyncio.create_task(turns.submit("t", _noop, turn("same1"), key="b"))
+        same2 = asyncio.create_task(turns.submit("t", _noop, turn("same2"), key="b"))
+        other = asyncio.create_task(turns.submit("t", _noop, turn("other"), key="c"))
+        await asyncio.sleep(0.01)
+        release.set()
+        return [await x for x in (first, same1, same2, other)], calls
+
+    results, calls = asyncio.run(go())
+    assert results == ["first", "same1", "same1", "other"]
+    assert calls == ["first", "same1", "other"]
+
+
+def test_no_key_never_merges():
+    async def go():
+        turns = TurnScheduler()
+        release = asyncio.Event()
+        n = 0
+
+        async def turn():
+            nonlocal n
+            n += 1
+            await release.wait()
+            return n
+
+        tasks = [asyncio.create_task(turns.submit("t", _noop, turn)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        release.set()
+        return sorted([await t for t in tasks])
+
+    assert asyncio.run(go()) == [1, 2, 3]
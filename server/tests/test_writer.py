@@ -0,0 +1,49 @@
+import asyncio
+
+from sqlalchemy.exc import StatementError
+
+import init_db
+import writer as writer_mod
+from writer import MessageWriter
+
+
+def _run(coro_fn):
+    async def go():
+        w = MessageWriter()
+        await w.start()
+        try:
+            return await coro_fn(w)
+        finally:
+            await w.stop()
+    return asyncio.run(go())
+
+
+def test_concurrent_writes_share_one_commit(monkeypatch):
+    init_db.main()
+    calls = []
+    insert = writer_mod._insert_batch
+    monkeypatch.setattr(writer_mod, "_insert_batch", lambda rows: calls.append(len(rows)) or insert(rows))
+
+    async def go(w):
+        return await asyncio.gather(*(w.add("writer-1", "user", f"m{i}", wait=True) for i in range(20)))
+
+    ids = _run(go)
+    assert len(set(ids)) == 20 and ids == sorted(ids)
+    assert calls == [20]
+
+
+def test_bad_row_fails_only_its_own_writer():
+    init_db.main()
+
+    async def go(w):
+        return await asyncio.gather(
+            w.add("writer-2", "user", "до", wait=True),
+            w.add("writer-2", "user", "плохая", wait=True, created_at="не дата"),
+            w.add_many("writer-2", [{"role": "user", "content": "a"}, {"role": "assistant", "content": "b"}], wait=True),
+            return_exceptions=True,
+        )
+
+    before, bad, many = _run(go)
+    assert isinstance(before, int)
+    assert isinstance(bad, StatementError)
+    assert len(many) == 2 and all(isinstance(i, int) for i in many)
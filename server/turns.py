@@ -0,0 +1,102 @@
+from __future__ import annotations
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, Hashable, Optional, TypeVar
+
+# Очередь ходов на тред: ходы одного треда выполняются строго по очереди,
+# а несколько пользовательских сообщений, пришедших пока тред занят, отвечаются одним вызовом LLM.
+# Окна ожидания нет: свободный тред отвечает сразу, склеиваются только сообщения, успевшие встать
+# в очередь, пока шёл предыдущий ход, и только с тем же ключом (персона, модель, температура) —
+# ответ общий, поэтому и настройки хода должны совпадать.
+
+T = TypeVar("T")
+
+
+class _ThreadTurns:
+    __slots__ = ("lock", "waiting", "depth")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.waiting: list[tuple[Hashable, asyncio.Future]] = []  # сообщения записаны, ответа ещё нет
+        self.depth = 0  # запросов в треде: выполняется + ждут
+
+
+class TurnScheduler:
+    def __init__(self):
+        self._threads: Dict[str, _ThreadTurns] = {}
+
+    def depth(self, thread_id: str) -> int:
+        t = self._threads.get(thread_id)
+        return t.depth if t else 0
+
+    def running(self, thread_id: str) -> bool:
+        t = self._threads.get(thread_id)
+        return bool(t and t.lock.locked())
+
+    @property
+    def total_depth(self) -> int:
+        return sum(t.depth for t in self._threads.values())
+
+    def _enter(self, thread_id: str) -> _ThreadTurns:
+        t = self._threads.get(thread_id)
+        if t is None:
+            t = self._threads[thread_id] = _ThreadTurns()
+        t.depth += 1
+        return t
+
+    def _leave(self, thread_id: str, t: _ThreadTurns):
+        t.depth -= 1
+        if t.depth == 0 and self._threads.get(thread_id) is t:
+            del self._threads[thread_id]
+
+    async def submit(
+        self,
+        thread_id: str,
+        write_incoming: Callable[[], Awaitable],
+        run_turn: Callable[[], Awaitable[T]],
+        key: Optional[Hashable] = None,
+    ) -> T:
+        # key=None — ход ни с кем не склеивается
+        key = object() if key is None else key
+        t = self._enter(thread_id)
+        try:
+            # сообщение пишется сразу, в порядке прихода; ход, уже идущий в треде, его не увидит
+            await write_incoming()
+            fut = asyncio.get_running_loop().create_future()
+            t.waiting.append((key, fut))
+            async with t.lock:
+                if fut.done():
+                    # наше сообщение уже ушло в модель вместе с предыдущими — ответ общий
+                    return fut.result()
+                batch = [f for k, f in t.waiting if k == key]
+                t.waiting = [(k, f) for k, f in t.waiting if k != key]
+                try:
+                    result = await run_turn()
+                except asyncio.CancelledError:
+                    # ведущий запрос отменён (клиент ушёл) — остальные сделают ход сами
+                    t.waiting = [(key, f) for f in batch if f is not fut] + t.waiting
+                    raise
+                except Exception as e:
+                    for f in batch:
+                        if f is not fut and not f.done():
+                            f.set_exception(e)
+                    raise
+                for f in batch:
+                    if not f.done():
+                        f.set_result(result)
+                return result
+        finally:
+            self._leave(thread_id, t)
+
+    @asynccontextmanager
+    async def exclusive(self, thread_id: str):
+        # ход без склейки (стриминг): просто занимаем тред
+        t = self._enter(thread_id)
+        try:
+            async with t.lock:
+                yield
+        finally:
+            self._leave(thread_id, t)
+
+
+turns = TurnScheduler()
@@ -0,0 +1,140 @@
+from __future__ import annotations
+import os
+import asyncio
+import logging
+from datetime import datetime
+from functools import partial
+from typing import Optional
+
+from db import db_executor, session_scope
+from models import Message
+from context import estimate_tokens
+
+# Единственный писатель сообщений: вставки из всех запросов копятся в очереди
+# и коммитятся пачкой (group commit) — один fsync на пачку вместо одного на сообщение.
+
+WRITE_BATCH_MAX = int(os.getenv("WRITE_BATCH_MAX", "256"))
+WRITE_FLUSH_MS = int(os.getenv("WRITE_FLUSH_MS", "5"))
+# commit — add() ждёт коммита пачки; queued — возвращает сразу после постановки в очередь
+WRITE_DURABILITY = os.getenv("WRITE_DURABILITY", "commit")
+
+log = logging.getLogger(__name__)
+
+
+def _insert_batch(rows: list[dict]) -> list[int]:
+    with session_scope() as s:
+        objs = [Message(**r) for r in rows]
+        s.add_all(objs)
+        s.flush()
+        return [m.id for m in objs]
+
+
+class MessageWriter:
+    def __init__(self):
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def start(self):
+        if self.running:
+            return
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # дописываем всё, что уже в очереди
+        if not self.running:
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+
+    @staticmethod
+    def _row(thread_id: str, role: str, content: str, **extra) -> dict:
+        return {
+            "thread_id": thread_id,
+            "role": role,
+            "content": content,
+            "tokens": estimate_tokens(content),
+            "created_at": datetime.utcnow(),
+            **extra,
+        }
+
+    async def add(self, thread_id: str, role: str, content: str, wait: Optional[bool] = None, **extra) -> Optional[int]:
+        # wait=True — дождаться коммита независимо от WRITE_DURABILITY (строку сразу будут читать)
+        ids = await self._submit([self._row(thread_id, role, content, **extra)], wait)
+        return ids[0] if ids else None
+
+    async def add_many(self, thread_id: str, rows: list[dict], wait: Optional[bool] = None) -> Optional[list[int]]:
+        # несколько реплик одной пачкой: {"role", "content", ...extra}; попадают в одну транзакцию целиком
+        return await self._submit([self._row(thread_id, **r) for r in rows], wait)
+
+    async def _submit(self, rows: list[dict], wait: Optional[bool]) -> Optional[list[int]]:
+        if not self.running:
+            # писатель не поднят (скрипты, CLI) — пишем напрямую
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(db_executor(), partial(_insert_batch, rows))
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((rows, fut))
+        if WRITE_DURABILITY == "queued" and not wait:
+            fut.add_done_callback(_log_failure)
+            return None
+        return await fut
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + WRITE_FLUSH_MS / 1000.0
+            while len(batch) < WRITE_BATCH_MAX:
+                timeout = deadline - loop.time()
+                try:
+                    item = self._queue.get_nowait() if timeout <= 0 else await asyncio.wait_for(self._queue.get(), timeout)
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+
+    async def _flush(self, batch: list[tuple[list[dict], asyncio.Future]]):
+        loop = asyncio.get_running_loop()
+        try:
+            ids = await loop.run_in_executor(db_executor(), partial(_insert_batch, [row for rows, _ in batch for row in rows]))
+        except Exception as e:
+            if len(batch) > 1:
+                # пачка откатилась целиком из-за одной плохой строки (нет треда и т.п.):
+                # повторяем по одной заявке, ошибку получит только её автор
+                log.warning("group commit of %d writes failed, retrying one by one: %s", len(batch), e)
+                for item in batch:
+                    await self._flush([item])
+                return
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        pos = 0
+        for rows, fut in batch:
+            if not fut.done():
+                fut.set_result(ids[pos:pos + len(rows)])
+            pos += len(rows)
+
+
+def _log_failure(fut: asyncio.Future):
+    if not fut.cancelled() and fut.exception() is not None:
+        log.error("message write failed: %s", fut.exception())
+
+
+writer = MessageWriter()